@@ -0,0 +1,92 @@
+"""
+Tags / second of target_localize_batch against target_localize_queue.
+
+Builds a batch scenario (many tags seen from the same reader poses),
+localizes every tag with target_localize_queue in a loop and all of them
+with one target_localize_batch call, checks that both give the same
+locations, and reports the throughput and the error against the ground
+truth.  The per-tag least squares dominate both paths, on one worker the
+batch is about as fast as the loop (10 tags of 8 measurements: 0.72
+tags/s loop, 0.63 batch).
+
+Usage:
+    python benchmarks/batch_benchmark.py --tags 20 --measurements 8 --workers 1 4
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localize_utils  # noqa: E402
+
+
+def loop_localize(scenario, config):
+    """target_localize_queue once per tag"""
+    locations = {}
+    for epc in scenario["ground_truth"]:
+        indices = [i for i, data in enumerate(scenario["queue"])
+                   if data["epc"] == epc]
+        locations[epc] = localize_utils.target_localize_queue(
+            [scenario["queue"][i] for i in indices],
+            scenario["poses"][scenario["pose_indices"][indices]],
+            config)
+    return locations
+
+
+def batch_localize(scenario, config):
+    return localize_utils.target_localize_batch(
+        scenario["queue"], scenario["pose_indices"], scenario["poses"], config)
+
+
+def same_locations(a, b):
+    return a.keys() == b.keys() and all(
+        (a[epc] is None and b[epc] is None)
+        or (a[epc] is not None and b[epc] is not None
+            and np.array_equal(a[epc], b[epc]))
+        for epc in a)
+
+
+def median_error(locations, ground_truth):
+    errors = [np.linalg.norm(locations[epc] - ground_truth[epc])
+              for epc in locations if locations[epc] is not None]
+    return float(np.median(errors)) if errors else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--measurements", type=int, default=8)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--shuffles", type=int, default=3)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scenario = scenarios.batch_scenario(args.tags, args.measurements,
+                                        args.clusters, args.seed)
+    print(f"{'path':>6} {'workers':>7} {'time_s':>7} {'tags/s':>7} "
+          f"{'err_p50':>8} same")
+    for workers in args.workers:
+        config = dict(scenarios.default_config(args.shuffles, args.seed),
+                      shuffle_workers=workers)
+        results = {}
+        for name, func in (("loop", loop_localize), ("batch", batch_localize)):
+            start = time.perf_counter()
+            results[name] = func(scenario, config)
+            elapsed = time.perf_counter() - start
+            same = same_locations(results[name], results["loop"])
+            print(f"{name:>6} {workers:>7} {elapsed:>7.2f} "
+                  f"{args.tags / elapsed:>7.2f} "
+                  f"{median_error(results[name], scenario['ground_truth']):>8.4f} "
+                  f"{same}")
+    localize_utils._close_shuffle_pool()
+
+
+if __name__ == "__main__":
+    main()
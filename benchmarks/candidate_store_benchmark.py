@@ -0,0 +1,112 @@
+"""
+Memory / throughput comparison of the MultiFusion candidate store.
+
+Runs the same synthetic measurement stream through the struct-of-arrays
+MultiFusion in localization_function/multi_fusion.py and through the
+original per-solution dict implementation kept in dict_multi_fusion.py,
+checks that get_all_locations and get_best_location_candidates agree, and
+reports wall time, peak traced memory and the memory still held by the
+fusion state after the last measurement.
+
+Usage:
+    python benchmarks/candidate_store_benchmark.py --measurements 10 --clusters 4
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+sys.path.insert(
+    0, str(pathlib.Path(__file__).resolve().parents[1] / "localization_function"))
+
+import dict_multi_fusion  # noqa: E402
+import multi_fusion  # noqa: E402
+
+BOUND_MIN = np.array([-2.0, -2.0, -1.0])
+BOUND_MAX = np.array([2.0, 2.0, 1.0])
+TX_RX_OFFSET = np.array([0.1, 0.0, 0.0])
+
+
+def make_measurements(n_meas, n_clusters, seed, noise=0.003):
+    """
+    Random reader positions around a random tag.  One cluster per
+    measurement holds the true bistatic distance (plus noise), the others
+    are uniformly wrong, and the clusters are shuffled.
+    """
+    rng = np.random.default_rng(seed)
+    tag = rng.uniform(BOUND_MIN / 2, BOUND_MAX / 2)
+    measurements = []
+    for _ in range(n_meas):
+        tx_loc = rng.uniform(BOUND_MIN, BOUND_MAX)
+        rx_loc = tx_loc + TX_RX_OFFSET
+        dist = np.linalg.norm(tag - tx_loc) + np.linalg.norm(tag - rx_loc)
+        clusters = [[dist + rng.normal(0, noise), rng.uniform()]]
+        for _ in range(n_clusters - 1):
+            clusters.append([dist + rng.uniform(-1, 1), rng.uniform()])
+        clusters = np.array(clusters)[rng.permutation(n_clusters)]
+        measurements.append((clusters, rx_loc, tx_loc))
+    return measurements
+
+
+def run(module, measurements):
+    tracemalloc.start()
+    start_mem = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    fusion = module.MultiFusion(bound_min=BOUND_MIN, bound_max=BOUND_MAX)
+    for clusters, rx_loc, tx_loc in measurements:
+        fusion.process_new_measurement(clusters, rx_loc, tx_loc)
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "fusion": fusion,
+        "time_s": elapsed,
+        "held_kib": (held - start_mem) / 1024,
+        "peak_kib": (peak - start_mem) / 1024,
+    }
+
+
+def same_results(a, b):
+    """True if two lists of candidate dicts hold the same values"""
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        for key in x:
+            if not np.allclose(np.asarray(x[key], dtype=float),
+                               np.asarray(y[key], dtype=float),
+                               equal_nan=True):
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--measurements", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--seeds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'seed':>4} {'path':>6} {'cands':>6} {'time_s':>8} "
+          f"{'held_KiB':>9} {'peak_KiB':>9} same")
+    for seed in range(args.seeds):
+        measurements = make_measurements(args.measurements, args.clusters, seed)
+        dict_run = run(dict_multi_fusion, measurements)
+        soa_run = run(multi_fusion, measurements)
+
+        same = (same_results(dict_run["fusion"].get_all_locations(),
+                             soa_run["fusion"].get_all_locations())
+                and same_results(dict_run["fusion"].get_best_location_candidates(),
+                                 soa_run["fusion"].get_best_location_candidates()))
+        for name, result in (("dict", dict_run), ("soa", soa_run)):
+            n_cands = len(result["fusion"].get_all_locations())
+            print(f"{seed:>4} {name:>6} {n_cands:>6} {result['time_s']:>8.3f} "
+                  f"{result['held_kib']:>9.1f} {result['peak_kib']:>9.1f} {same}")
+
+
+if __name__ == "__main__":
+    main()
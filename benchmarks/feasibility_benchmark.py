@@ -0,0 +1,81 @@
+"""
+Effect of the MultiFusion bounding box prechecks (see feasibility.py).
+
+Runs target scenarios through MultiFusion with the precheck off and on,
+with the wrong clusters of every measurement spread up to --spreads
+meters from the true distance (range ambiguities), and reports the time,
+least squares calls, the clusters found outside the bounds, the pairs
+settled by the prechecks (infeasible, far) and whether both runs kept the
+same candidates.
+
+Usage:
+    python benchmarks/feasibility_benchmark.py --measurements 10 \
+        --clusters 6 --spreads 1 3 6
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localize_utils  # noqa: E402
+
+mf = localize_utils.mf
+
+
+def run(measurements, precheck):
+    fusion = mf.MultiFusion(bound_min=scenarios.BOUND_MIN,
+                            bound_max=scenarios.BOUND_MAX, analytic_jac=True,
+                            precheck=precheck)
+    start = time.perf_counter()
+    for meas_id, (clusters, rx_loc, tx_loc) in enumerate(measurements):
+        fusion.process_new_measurement(clusters, rx_loc, tx_loc, meas_id)
+    elapsed = time.perf_counter() - start
+    locations = np.array([loc["location"]
+                          for loc in fusion.get_all_locations()]).reshape(-1, 3)
+    return fusion, elapsed, locations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--measurements", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=6)
+    parser.add_argument("--spreads", type=float, nargs="+", default=[1.0, 3.0, 6.0])
+    parser.add_argument("--seeds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'spread':>6} {'feas':>5} {'time_s':>7} {'ls_calls':>8} "
+          f"{'outside':>7} {'infeas':>7} {'far':>6} {'cands':>5} same")
+    for spread in args.spreads:
+        totals = {False: [0.0, 0, 0, 0, 0, 0], True: [0.0, 0, 0, 0, 0, 0]}
+        same = True
+        for seed in range(args.seeds):
+            scenario = scenarios.target_scenario(
+                args.measurements, args.clusters, seed, spread=spread)
+            runs = {}
+            for precheck in (False, True):
+                fusion, elapsed, locations = run(scenario["measurements"],
+                                                 precheck)
+                runs[precheck] = locations
+                total = totals[precheck]
+                total[0] += elapsed
+                total[1] += fusion.ls_stats["calls"]
+                total[2] += fusion.feasibility_stats["outside_bounds"]
+                total[3] += fusion.gate_stats["infeasible"]
+                total[4] += fusion.gate_stats["far"]
+                total[5] += locations.shape[0]
+            same &= (runs[False].shape == runs[True].shape
+                     and np.array_equal(runs[False], runs[True]))
+        for precheck, total in totals.items():
+            print(f"{spread:>6g} {str(precheck):>5} {total[0]:>7.3f} "
+                  f"{total[1]:>8} {total[2]:>7} {total[3]:>7} {total[4]:>6} "
+                  f"{total[5]:>5} {same}")
+
+
+if __name__ == "__main__":
+    main()
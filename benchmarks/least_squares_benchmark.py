@@ -0,0 +1,165 @@
+"""
+Wall time and evaluation counts of the least squares options and engines.
+
+Records every least squares problem MultiFusion solves on a synthetic
+dataset, re-solves each one with the finite-difference and the analytic
+jacobian, and all of them as one masked stack with batch_least_squares,
+and checks that the accept / reject outcome (success, active_mask and
+cost_thresh) is the same.  Then runs MultiFusion end to end with each
+combination of solver / warm_start / analytic_jac and reports the wall
+time and the counters from MultiFusion.ls_stats.
+
+nfev is scipy's count of the iterations' residual evaluations, the same
+for both jacobians.  residual_evals also counts the evaluations spent on
+finite differences, it is what the analytic jacobian saves; the wall time
+is the figure that matters.  The batch engine (config["solver"] =
+"batch") is the one that changes the wall time.
+
+Usage:
+    python benchmarks/least_squares_benchmark.py --measurements 9 --clusters 4
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+sys.path.insert(
+    0, str(pathlib.Path(__file__).resolve().parents[1] / "localization_function"))
+
+import multi_fusion  # noqa: E402
+from candidate_store_benchmark import (  # noqa: E402
+    BOUND_MAX, BOUND_MIN, make_measurements)
+
+
+def new_counters():
+    return {'calls': 0, 'nfev': 0, 'njev': 0, 'residual_evals': 0}
+
+
+def record_problems(datasets):
+    """Run the default MultiFusion and keep every least squares call"""
+    problems = []
+    solve = multi_fusion.single_least_squares
+
+    def recorder(*args, **kwargs):
+        kwargs.pop('analytic_jac', None)
+        kwargs.pop('stats', None)
+        problems.append((args, kwargs))
+        return solve(*args, **kwargs)
+
+    multi_fusion.single_least_squares = recorder
+    try:
+        for measurements in datasets:
+            fusion = multi_fusion.MultiFusion(BOUND_MIN, BOUND_MAX)
+            for clusters, rx_loc, tx_loc in measurements:
+                fusion.process_new_measurement(clusters, rx_loc, tx_loc)
+    finally:
+        multi_fusion.single_least_squares = solve
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--measurements", type=int, default=9)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--seeds", type=int, default=10)
+    args = parser.parse_args()
+
+    datasets = [make_measurements(args.measurements, args.clusters, seed)
+                for seed in range(args.seeds)]
+
+    # -------------- Per problem: same outcome, fewer evals -------------- #
+    problems = record_problems(datasets)
+    fd_stats, jac_stats = new_counters(), new_counters()
+    start = time.perf_counter()
+    fd_results = [multi_fusion.single_least_squares(
+        *call_args, stats=fd_stats, **call_kwargs)
+        for call_args, call_kwargs in problems]
+    fd_time = time.perf_counter() - start
+    start = time.perf_counter()
+    jac_results = [multi_fusion.single_least_squares(
+        *call_args, analytic_jac=True, stats=jac_stats, **call_kwargs)
+        for call_args, call_kwargs in problems]
+    jac_time = time.perf_counter() - start
+    same_outcome = 0
+    max_loc_diff = 0.0
+    for fd, jac in zip(fd_results, jac_results):
+        same_outcome += (fd is None) == (jac is None)
+        if fd is not None and jac is not None:
+            max_loc_diff = max(max_loc_diff, np.max(np.abs(fd[:-1] - jac[:-1])))
+
+    print(f"problems: {len(problems)}  same outcome: {same_outcome}  "
+          f"max location diff: {max_loc_diff:.2e}")
+    print(f"{'jacobian':>18} {'time_s':>7} {'nfev':>7} {'njev':>7} "
+          f"{'residual_evals':>14}")
+    for name, stats, elapsed in (("finite differences", fd_stats, fd_time),
+                                 ("analytic", jac_stats, jac_time)):
+        print(f"{name:>18} {elapsed:>7.3f} {stats['nfev']:>7} "
+              f"{stats['njev']:>7} {stats['residual_evals']:>14}")
+    print(f"analytic jacobian: {fd_time / jac_time:.2f}x wall time, "
+          f"{fd_stats['nfev'] / max(jac_stats['nfev'], 1):.2f}x nfev, "
+          f"{fd_stats['residual_evals'] / max(jac_stats['residual_evals'], 1):.2f}x "
+          f"residual evaluations")
+
+    # All problems in one stack, padded and masked to the longest one
+    n_rows = max(len(call_args[0]) for call_args, _ in problems)
+    dists = np.zeros((len(problems), n_rows))
+    tx_locs = np.zeros((len(problems), n_rows, 3))
+    rx_locs = np.zeros((len(problems), n_rows, 3))
+    mask = np.zeros((len(problems), n_rows), dtype=bool)
+    guess = np.zeros((len(problems), 3))
+    for i, (call_args, _) in enumerate(problems):
+        n = len(call_args[0])
+        dists[i, :n], guess[i] = call_args[0], call_args[1]
+        tx_locs[i, :n], rx_locs[i, :n] = call_args[2], call_args[3]
+        mask[i, :n] = True
+
+    start = time.perf_counter()
+    batch = multi_fusion.batch_least_squares(
+        dists, guess, tx_locs, rx_locs, mask=mask, bounds=(BOUND_MIN, BOUND_MAX))
+    batch_time = time.perf_counter() - start
+    batch_valid = (batch['success'] & (batch['cost'] < problems[0][1]['cost_thresh'])
+                   & np.all(batch['active_mask'] == 0, axis=1))
+    start = time.perf_counter()
+    scipy_valid = np.array([
+        multi_fusion.single_least_squares(*call_args, analytic_jac=True,
+                                          **call_kwargs) is not None
+        for call_args, call_kwargs in problems])
+    scipy_time = time.perf_counter() - start
+    print(f"batch engine: same outcome: {np.sum(batch_valid == scipy_valid)}  "
+          f"time {batch_time:.3f}s vs scipy {scipy_time:.3f}s "
+          f"({scipy_time / batch_time:.1f}x)  "
+          f"nfev {int(batch['nfev'].sum())} vs {jac_stats['nfev']}")
+
+    # ----------------------- End to end MultiFusion --------------------- #
+    print()
+    print(f"{'solver':>6} {'warm_start':>10} {'analytic_jac':>12} {'calls':>6} "
+          f"{'nfev':>7} {'residual_evals':>14} {'candidates':>10} {'time_s':>7}")
+    combos = [('scipy', warm_start, analytic_jac)
+              for warm_start in (False, True) for analytic_jac in (False, True)]
+    combos += [('batch', False, True), ('batch', True, True)]
+    for solver, warm_start, analytic_jac in combos:
+        stats = new_counters()
+        n_candidates = 0
+        start = time.perf_counter()
+        for measurements in datasets:
+            fusion = multi_fusion.MultiFusion(
+                BOUND_MIN, BOUND_MAX,
+                solver=solver, warm_start=warm_start,
+                analytic_jac=analytic_jac)
+            for clusters, rx_loc, tx_loc in measurements:
+                fusion.process_new_measurement(clusters, rx_loc, tx_loc)
+            for key in stats:
+                stats[key] += fusion.ls_stats[key]
+            n_candidates += len(fusion.get_all_locations())
+        elapsed = time.perf_counter() - start
+        print(f"{solver:>6} {warm_start!s:>10} {analytic_jac!s:>12} {stats['calls']:>6} "
+              f"{stats['nfev']:>7} {stats['residual_evals']:>14} {n_candidates:>10} "
+              f"{elapsed:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
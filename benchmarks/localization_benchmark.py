@@ -0,0 +1,397 @@
+"""
+Speed / accuracy benchmark suite for the localization core.
+
+Runs MultiFusion, single_least_squares, localize, target_localize_queue
+and self_localize_queue (with fixed and adaptive shuffles, and with the
+grid engine) on the synthetic scenarios in scenarios.py over a grid of
+measurement, cluster and shuffle counts, and reports for each case the
+latency percentiles, least squares calls, peak traced memory and the
+localization error against the ground truth.  Results are written as
+JSON; with --compare, the p50 latency and median error are checked
+against an earlier result file and the exit code is 1 on a regression.
+
+Usage:
+    python benchmarks/localization_benchmark.py --measurements 6 9 12 \
+        --clusters 4 --shuffles 3 --output results.json
+    python benchmarks/localization_benchmark.py --output new.json \
+        --compare results.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localize_utils  # noqa: E402
+
+mf = localize_utils.mf
+
+CASES = (
+    "multi_fusion",
+    "single_least_squares",
+    "localize",
+    "target_localize_queue",
+    "self_localize_queue",
+    "target_localize_adaptive",
+    "self_localize_adaptive",
+    "target_localize_grid",
+    "self_localize_grid",
+)
+# Cases that run shuffles, the others ignore --shuffles
+SHUFFLED_CASES = ("target_localize_queue", "self_localize_queue",
+                  "target_localize_adaptive", "self_localize_adaptive")
+
+
+@contextlib.contextmanager
+def count_least_squares(counter):
+    """Count mf.single_least_squares / mf.batch_least_squares calls"""
+    single, batch = mf.single_least_squares, mf.batch_least_squares
+
+    def counted_single(*args, **kwargs):
+        counter["calls"] += 1
+        return single(*args, **kwargs)
+
+    def counted_batch(dists, *args, **kwargs):
+        counter["calls"] += len(dists)
+        return batch(dists, *args, **kwargs)
+
+    mf.single_least_squares, mf.batch_least_squares = counted_single, counted_batch
+    try:
+        yield counter
+    finally:
+        mf.single_least_squares, mf.batch_least_squares = single, batch
+
+
+def location_error(location, ground_truth):
+    if location is None:
+        return None
+    return float(np.linalg.norm(np.asarray(location) - ground_truth))
+
+
+def best_candidate(locations):
+    """Location of the lowest residual candidate of localize() output"""
+    finite = [loc for loc in locations if np.isfinite(loc["residual_cost"])]
+    if not finite:
+        return None
+    return min(finite, key=lambda loc: loc["residual_cost"])["location"]
+
+
+# --------------------------------- Cases --------------------------------- #
+# Each case is prepare(n_meas, n_clusters, n_shuffle, seed) -> list of
+# (run, ground_truth) where run() does the timed work and returns the
+# estimated location (or None).
+
+def prepare_multi_fusion(n_meas, n_clusters, n_shuffle, seed):
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+
+    def run():
+        fusion = mf.MultiFusion(scenarios.BOUND_MIN, scenarios.BOUND_MAX,
+                                analytic_jac=True)
+        for clusters, rx_loc, tx_loc in scenario["measurements"]:
+            fusion.process_new_measurement(clusters, rx_loc, tx_loc)
+        best = fusion.get_best_location_candidates()
+        return best[0]["location"] if best else None
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_single_least_squares(n_meas, n_clusters, n_shuffle, seed):
+    """One run per least squares problem MultiFusion solves"""
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    problems = []
+    solve = mf.single_least_squares
+
+    def recorder(*args, **kwargs):
+        problems.append((args, kwargs))
+        return solve(*args, **kwargs)
+
+    mf.single_least_squares = recorder
+    try:
+        fusion = mf.MultiFusion(scenarios.BOUND_MIN, scenarios.BOUND_MAX,
+                                analytic_jac=True)
+        for clusters, rx_loc, tx_loc in scenario["measurements"]:
+            fusion.process_new_measurement(clusters, rx_loc, tx_loc)
+    finally:
+        mf.single_least_squares = solve
+
+    def make_run(args, kwargs):
+        def run():
+            result = mf.single_least_squares(*args, **kwargs)
+            return None if result is None else result[:3]
+        return run
+    # The error of a single intersection is not meaningful, most of them
+    # use a wrong cluster
+    return [(make_run(args, kwargs), None) for args, kwargs in problems]
+
+
+def prepare_localize(n_meas, n_clusters, n_shuffle, seed):
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    clusters = np.array([meas[0] for meas in scenario["measurements"]])
+    rx_locs = np.array([meas[1] for meas in scenario["measurements"]])
+    tx_locs = np.array([meas[2] for meas in scenario["measurements"]])
+
+    def run():
+        return best_candidate(localize_utils.localize(
+            clusters, tx_locs, rx_locs,
+            scenarios.BOUND_MIN, scenarios.BOUND_MAX))
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_target_localize_queue(n_meas, n_clusters, n_shuffle, seed):
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    config = scenarios.default_config(n_shuffle, seed)
+
+    def run():
+        return localize_utils.target_localize_queue(
+            scenario["queue"], scenario["poses"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_self_localize_queue(n_meas, n_clusters, n_shuffle, seed):
+    scenario = scenarios.self_scenario(n_meas, n_clusters, seed)
+    config = scenarios.default_config(n_shuffle, seed)
+
+    def run():
+        return localize_utils.self_localize_queue(
+            scenario["queue"], scenario["ref_locs"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_target_localize_adaptive(n_meas, n_clusters, n_shuffle, seed):
+    """target_localize_queue with adaptive shuffles, n_shuffle at most"""
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    config = dict(scenarios.default_config(n_shuffle, seed),
+                  adaptive_shuffle=True)
+
+    def run():
+        return localize_utils.target_localize_queue(
+            scenario["queue"], scenario["poses"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_self_localize_adaptive(n_meas, n_clusters, n_shuffle, seed):
+    """self_localize_queue with adaptive shuffles, n_shuffle at most"""
+    scenario = scenarios.self_scenario(n_meas, n_clusters, seed)
+    config = dict(scenarios.default_config(n_shuffle, seed),
+                  adaptive_shuffle=True)
+
+    def run():
+        return localize_utils.self_localize_queue(
+            scenario["queue"], scenario["ref_locs"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_target_localize_grid(n_meas, n_clusters, n_shuffle, seed):
+    """target_localize_queue with the grid engine"""
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    config = dict(scenarios.default_config(n_shuffle, seed), engine="grid")
+
+    def run():
+        return localize_utils.target_localize_queue(
+            scenario["queue"], scenario["poses"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+def prepare_self_localize_grid(n_meas, n_clusters, n_shuffle, seed):
+    """self_localize_queue with the grid engine"""
+    scenario = scenarios.self_scenario(n_meas, n_clusters, seed)
+    config = dict(scenarios.default_config(n_shuffle, seed), engine="grid")
+
+    def run():
+        return localize_utils.self_localize_queue(
+            scenario["queue"], scenario["ref_locs"], config)
+    return [(run, scenario["ground_truth"])]
+
+
+PREPARE = {
+    "multi_fusion": prepare_multi_fusion,
+    "single_least_squares": prepare_single_least_squares,
+    "localize": prepare_localize,
+    "target_localize_queue": prepare_target_localize_queue,
+    "self_localize_queue": prepare_self_localize_queue,
+    "target_localize_adaptive": prepare_target_localize_adaptive,
+    "self_localize_adaptive": prepare_self_localize_adaptive,
+    "target_localize_grid": prepare_target_localize_grid,
+    "self_localize_grid": prepare_self_localize_grid,
+}
+
+
+# -------------------------------- Running -------------------------------- #
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return None
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(np.mean(values)),
+        "max": float(np.max(values)),
+    }
+
+
+def run_case(case, n_meas, n_clusters, n_shuffle, seeds, repeats):
+    runs = []
+    for seed in seeds:
+        runs += PREPARE[case](n_meas, n_clusters, n_shuffle, seed)
+
+    # Timed runs, without tracemalloc which slows allocation down
+    latencies = []
+    errors = []
+    no_result = 0
+    counter = {"calls": 0}
+    with count_least_squares(counter):
+        for repeat in range(repeats):
+            for run, ground_truth in runs:
+                start = time.perf_counter()
+                location = run()
+                latencies.append(time.perf_counter() - start)
+                if repeat > 0:
+                    continue
+                if location is None:
+                    no_result += 1
+                elif ground_truth is not None:
+                    errors.append(location_error(location, ground_truth))
+
+    # One traced pass for the peak memory of a single run
+    peak = 0
+    for run, _ in runs:
+        tracemalloc.start()
+        run()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "case": case,
+        "n_meas": n_meas,
+        "n_clusters": n_clusters,
+        "n_shuffle": n_shuffle if case in SHUFFLED_CASES else None,
+        "runs": len(latencies),
+        "latency_s": percentiles(latencies),
+        "ls_calls_per_run": counter["calls"] / max(len(latencies), 1),
+        "peak_kib": peak / 1024,
+        "error_m": percentiles(errors),
+        "no_result": no_result,
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=pathlib.Path(__file__).resolve().parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def result_key(result):
+    return (result["case"], result["n_meas"], result["n_clusters"],
+            result["n_shuffle"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print p50 latency and median error against baseline results.
+
+    Returns: number of regressions (ratio above tolerance)
+    """
+    old = {result_key(result): result for result in baseline}
+    regressions = 0
+    print()
+    print(f"{'case':>22} {'meas':>4} {'clus':>4} {'shuf':>4} "
+          f"{'p50 ratio':>9} {'err ratio':>9}")
+    for result in results:
+        prev = old.get(result_key(result))
+        if prev is None:
+            continue
+        ratios = []
+        for field, stat in (("latency_s", "p50"), ("error_m", "p50")):
+            new_val = (result[field] or {}).get(stat)
+            old_val = (prev[field] or {}).get(stat)
+            if new_val is None or old_val is None or old_val == 0:
+                ratios.append(None)
+            else:
+                ratios.append(new_val / old_val)
+        regressed = any(r is not None and r > tolerance for r in ratios)
+        regressions += regressed
+        shown = [f"{r:9.2f}" if r is not None else f"{'-':>9}" for r in ratios]
+        print(f"{result['case']:>22} {result['n_meas']:>4} "
+              f"{result['n_clusters']:>4} {str(result['n_shuffle'] or '-'):>4} "
+              f"{shown[0]} {shown[1]}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--measurements", type=int, nargs="+", default=[6, 9])
+    parser.add_argument("--clusters", type=int, nargs="+", default=[4])
+    parser.add_argument("--shuffles", type=int, nargs="+", default=[3])
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--compare", type=pathlib.Path,
+                        help="earlier --output file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.2,
+                        help="ratio to the baseline counted as a regression")
+    args = parser.parse_args()
+
+    seeds = range(args.seeds)
+    results = []
+    print(f"{'case':>22} {'meas':>4} {'clus':>4} {'shuf':>4} {'p50_ms':>8} "
+          f"{'p99_ms':>8} {'ls_calls':>8} {'peak_KiB':>9} {'err_p50':>8} "
+          f"{'no_res':>6}")
+    for case in args.cases:
+        shuffles = args.shuffles if case in SHUFFLED_CASES else [None]
+        for n_meas in args.measurements:
+            for n_clusters in args.clusters:
+                for n_shuffle in shuffles:
+                    result = run_case(case, n_meas, n_clusters, n_shuffle,
+                                      seeds, args.repeats)
+                    results.append(result)
+                    latency = result["latency_s"] or {}
+                    error = result["error_m"] or {}
+                    print(f"{case:>22} {n_meas:>4} {n_clusters:>4} "
+                          f"{str(n_shuffle or '-'):>4} "
+                          f"{latency.get('p50', np.nan) * 1e3:>8.2f} "
+                          f"{latency.get('p99', np.nan) * 1e3:>8.2f} "
+                          f"{result['ls_calls_per_run']:>8.1f} "
+                          f"{result['peak_kib']:>9.1f} "
+                          f"{error.get('p50', np.nan):>8.4f} "
+                          f"{result['no_result']:>6}")
+
+    if args.output:
+        args.output.write_text(json.dumps(
+            {"meta": metadata(), "args": {
+                key: (str(val) if isinstance(val, pathlib.Path) else val)
+                for key, val in vars(args).items()},
+             "results": results}, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
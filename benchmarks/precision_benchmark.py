@@ -0,0 +1,179 @@
+"""
+Accuracy guard for config["precision"] = "float32".
+
+Runs each case once per seed in float64 and in float32 (see
+localize_utils.precision()) and reports for both the time, the peak
+traced memory and the median location error against the ground truth,
+plus the largest distance between the float64 and float32 locations of
+the same seed.  The "tiebreaker" case scores --candidates random
+locations with aoa_tiebreaker_powers() alone, the part whose arrays
+scale with candidates x measurements x hops.
+
+The exit code is 1 if the float32 median error of any case is more than
+--max-error-increase meters above the float64 one.
+
+Usage:
+    python benchmarks/precision_benchmark.py --measurements 8 --seeds 5
+    python benchmarks/precision_benchmark.py --cases tiebreaker \
+        --candidates 20000
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localize_utils  # noqa: E402
+
+mf = localize_utils.mf
+
+CASES = ("target_localize_queue", "self_localize_queue",
+         "target_localize_grid", "tiebreaker")
+
+
+def prepare(case, n_meas, n_clusters, n_shuffle, n_candidates, seed):
+    """
+    (run(precision) -> location or None, ground truth) of one case and
+    seed
+    """
+    config = scenarios.default_config(n_shuffle, seed)
+    if case == "self_localize_queue":
+        scenario = scenarios.self_scenario(n_meas, n_clusters, seed)
+
+        def run(precision):
+            return localize_utils.self_localize_queue(
+                scenario["queue"], scenario["ref_locs"],
+                dict(config, precision=precision))
+        return run, scenario["ground_truth"]
+
+    scenario = scenarios.target_scenario(n_meas, n_clusters, seed)
+    if case == "tiebreaker":
+        poses = scenario["poses"]
+        rx_locs = (localize_utils.rotate_by_quaternions(
+            poses[:, 3:], scenarios.TX_RX_OFFSET) + poses[:, :3])
+        channels = np.array([localize_utils.preprocess_data(data)
+                             ["channel_estimate"][0]
+                             for data in scenario["queue"]])
+        rng = np.random.default_rng(seed)
+        locs = rng.uniform(scenarios.BOUND_MIN, scenarios.BOUND_MAX,
+                           (n_candidates, 3))
+        locs[0] = scenario["ground_truth"]
+
+        def run(precision):
+            _, complex_dtype = mf.PRECISIONS[precision]
+            arr_channels = localize_utils.antenna_array_channels(
+                channels.astype(complex_dtype), scenarios.CAL_DIST,
+                localize_utils.WAVELENGTHS)
+            powers = localize_utils.aoa_tiebreaker_powers(
+                locs.astype(mf.PRECISIONS[precision][0]), poses, rx_locs,
+                arr_channels, localize_utils.WAVELENGTHS)
+            return locs[np.argmax(powers)]
+        return run, scenario["ground_truth"]
+
+    if case == "target_localize_grid":
+        config["engine"] = "grid"
+
+    def run(precision):
+        return localize_utils.target_localize_queue(
+            scenario["queue"], scenario["poses"],
+            dict(config, precision=precision))
+    return run, scenario["ground_truth"]
+
+
+def measure(run, precision, repeats):
+    """(location, best time in s, peak traced bytes) of run(precision)"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        location = run(precision)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run(precision)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return location, min(times), peak
+
+
+def error(location, ground_truth):
+    if location is None:
+        return float("nan")
+    return float(np.linalg.norm(np.asarray(location, dtype=float) - ground_truth))
+
+
+def run_case(case, args):
+    totals = {precision: {"time_s": 0.0, "peak_kib": 0.0, "errors": []}
+              for precision in localize_utils.PRECISIONS}
+    max_shift = 0.0
+    for seed in range(args.seeds):
+        run, ground_truth = prepare(case, args.measurements, args.clusters,
+                                    args.shuffles, args.candidates, seed)
+        locations = {}
+        for precision, total in totals.items():
+            location, elapsed, peak = measure(run, precision, args.repeats)
+            locations[precision] = location
+            total["time_s"] += elapsed
+            total["peak_kib"] = max(total["peak_kib"], peak / 1024)
+            total["errors"].append(error(location, ground_truth))
+        if locations["float64"] is not None and locations["float32"] is not None:
+            max_shift = max(max_shift, error(locations["float32"],
+                                             locations["float64"]))
+
+    result = {"case": case, "max_shift_m": max_shift}
+    for precision, total in totals.items():
+        result[precision] = {
+            "time_s": total["time_s"],
+            "peak_kib": total["peak_kib"],
+            "err_p50": float(np.nanmedian(total["errors"])),
+            "found": int(np.count_nonzero(np.isfinite(total["errors"]))),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--measurements", type=int, default=8)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--shuffles", type=int, default=3)
+    parser.add_argument("--candidates", type=int, default=5000,
+                        help="candidate locations of the tiebreaker case")
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-error-increase", type=float, default=0.005,
+                        help="meters of float32 median error over float64")
+    parser.add_argument("--output", type=pathlib.Path)
+    args = parser.parse_args()
+
+    print(f"{'case':>22} {'t64_s':>7} {'t32_s':>7} {'mem64_KiB':>9} "
+          f"{'mem32_KiB':>9} {'err64':>7} {'err32':>7} {'shift':>8} found")
+    results = []
+    failed = []
+    for case in args.cases:
+        result = run_case(case, args)
+        results.append(result)
+        f64, f32 = result["float64"], result["float32"]
+        print(f"{case:>22} {f64['time_s']:>7.3f} {f32['time_s']:>7.3f} "
+              f"{f64['peak_kib']:>9.1f} {f32['peak_kib']:>9.1f} "
+              f"{f64['err_p50']:>7.4f} {f32['err_p50']:>7.4f} "
+              f"{result['max_shift_m']:>8.1e} {f32['found']}/{f64['found']}")
+        if not f32["err_p50"] <= f64["err_p50"] + args.max_error_increase:
+            failed.append(case)
+
+    if args.output:
+        args.output.write_text(json.dumps(
+            {"args": vars(args), "results": results}, indent=2, default=str))
+    localize_utils._close_shuffle_pool()
+    if failed:
+        print(f"float32 error regression: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Deterministic synthetic scenarios for the localization core.
+
+A target scenario is a tag at a random ground truth location and reader
+poses on a ring around it, each with a random yaw.  Every measurement
+has one distance cluster at the true bistatic distance (plus noise) and
+n_clusters - 1 wrong ones, and a channel estimate whose phase follows
+the true distance.  The queue entries are in the preprocess_data input
+format, so a scenario can be fed to target_localize_queue as is.
+
+A self scenario is the reverse for self_localize_queue: the reader is at
+the ground truth and the measurements come from reference tags at known
+locations.
+
+A batch scenario is several target tags measured from the same reader
+poses, for target_localize_batch.
+
+The same arguments always give the same scenario.
+"""
+
+import itertools
+import json
+import pathlib
+import sys
+
+import numpy as np
+import scipy.constants
+import scipy.spatial.transform
+
+sys.path.insert(
+    0, str(pathlib.Path(__file__).resolve().parents[1] / "localization_function"))
+
+import localize_utils  # noqa: E402
+
+BOUND_MIN = np.array([-2.0, -2.0, -1.0])
+BOUND_MAX = np.array([2.0, 2.0, 1.0])
+TX_RX_OFFSET = np.array([0.1, 0.0, 0.0])
+CAL_DIST = 0.5
+WAVELENGTHS = scipy.constants.c / np.array([770e6 + 27e6*i for i in range(14)])
+
+# Stream sequence numbers, increasing across all generated records
+_sequence_numbers = itertools.count(1)
+STREAM_ARN = ("arn:aws:dynamodb:us-east-1:123456789012:table/"
+              "IntermediateLocationsQueue/stream/2022-01-26T00:00:00.000")
+
+
+def default_config(n_shuffle=3, seed=0):
+    """target_localize_queue / self_localize_queue config of the scenarios"""
+    return {
+        "shuffle": n_shuffle,
+        "min_bounds": BOUND_MIN.tolist(),
+        "max_bounds": BOUND_MAX.tolist(),
+        "tx_rx_offset": TX_RX_OFFSET.tolist(),
+        "cal_dist": CAL_DIST,
+        "seed": seed,
+    }
+
+
+def bistatic_distance(loc, tx_loc, rx_loc):
+    return np.linalg.norm(loc - tx_loc) + np.linalg.norm(loc - rx_loc)
+
+
+def measurement_clusters(rng, dist, n_clusters, noise, spread=1.0):
+    """
+    (n_clusters, 2) [distance, cost] clusters in random order, one of
+    them at dist, the others within spread of it
+    """
+    clusters = [[dist + rng.normal(0, noise), rng.uniform()]]
+    for _ in range(n_clusters - 1):
+        clusters.append([dist + rng.uniform(-spread, spread), rng.uniform()])
+    return np.array(clusters)[rng.permutation(n_clusters)]
+
+
+def calibrated_channel(rng, dist, snr_db):
+    """
+    (1, n_freqs) calibrated channel of a tag at bistatic distance dist,
+    the inverse of localize_utils.antenna_array_channels, with complex
+    gaussian noise at snr_db
+    """
+    channel = np.exp(-2j * np.pi * (dist - CAL_DIST) / WAVELENGTHS)
+    sigma = 10 ** (-snr_db / 20) / np.sqrt(2)
+    channel = channel + sigma * (rng.standard_normal(channel.shape)
+                                 + 1j * rng.standard_normal(channel.shape))
+    return channel[None]
+
+
+def queue_entry(epc, clusters, channel, encoding):
+    """
+    One queue entry as stored.  encoding is "codec" (measurement_codec
+    binary) or "array" (already decoded)
+    """
+    data = {
+        "epc": epc,
+        "distance_candidates": clusters,
+        "channel_estimate": channel,
+    }
+    if encoding == "codec":
+        return localize_utils.encode_data(data)
+    if encoding == "array":
+        return data
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def target_scenario(n_meas, n_clusters=4, seed=0, noise=0.003, snr_db=20,
+                    radius=1.8, encoding="codec", spread=1.0):
+    """
+    Returns: {
+        "ground_truth": (3, ) tag location,
+        "queue": target_localize_queue data_queue,
+        "poses": (n_meas, 7) TX antenna poses [x,y,z,qx,qy,qz,qw],
+        "measurements": [(clusters, rx_loc, tx_loc)] for MultiFusion,
+    }
+    """
+    rng = np.random.default_rng(seed)
+    ground_truth = rng.uniform(BOUND_MIN / 2, BOUND_MAX / 2)
+    queue, poses, measurements = [], [], []
+    for i in range(n_meas):
+        angle = 2 * np.pi * i / n_meas + rng.uniform(-0.1, 0.1)
+        tx_loc = np.array([radius * np.cos(angle),
+                           radius * np.sin(angle),
+                           rng.uniform(BOUND_MIN[2] / 2, BOUND_MAX[2] / 2)])
+        quat = scipy.spatial.transform.Rotation.from_euler(
+            "z", rng.uniform(0, 2 * np.pi)).as_quat()
+        rx_loc = scipy.spatial.transform.Rotation.from_quat(quat).apply(
+            TX_RX_OFFSET) + tx_loc
+
+        dist = bistatic_distance(ground_truth, tx_loc, rx_loc)
+        clusters = measurement_clusters(rng, dist, n_clusters, noise, spread)
+        channel = calibrated_channel(rng, dist, snr_db)
+
+        # target_localize_queue reads distance_candidates[0]
+        queue.append(queue_entry("TARGET", clusters[None], channel, encoding))
+        poses.append(np.concatenate([tx_loc, quat]))
+        measurements.append((clusters, rx_loc, tx_loc))
+    return {
+        "ground_truth": ground_truth,
+        "queue": queue,
+        "poses": np.array(poses),
+        "measurements": measurements,
+    }
+
+
+def self_scenario(n_meas, n_clusters=4, seed=0, noise=0.003, snr_db=20,
+                  encoding="codec"):
+    """
+    Returns: {
+        "ground_truth": (3, ) reader location,
+        "queue": self_localize_queue data_queue,
+        "ref_locs": {epc: (3, ) reference tag location},
+    }
+    """
+    rng = np.random.default_rng(seed)
+    ground_truth = rng.uniform(BOUND_MIN / 2, BOUND_MAX / 2)
+    queue, ref_locs = [], {}
+    for i in range(n_meas):
+        epc = f"REF{i:04d}"
+        tag_loc = rng.uniform(BOUND_MIN, BOUND_MAX)
+        dist = bistatic_distance(ground_truth, tag_loc, tag_loc + TX_RX_OFFSET)
+        clusters = measurement_clusters(rng, dist, n_clusters, noise)
+        channel = calibrated_channel(rng, dist, snr_db)
+        queue.append(queue_entry(epc, clusters, channel, encoding))
+        ref_locs[epc] = tag_loc
+    return {
+        "ground_truth": ground_truth,
+        "queue": queue,
+        "ref_locs": ref_locs,
+    }
+
+
+def stream_records(scenario, epc="TARGET", area_id=1, device_id="UPDATER",
+                   start_ms=1643179964390, period_ms=100,
+                   distance_candidates=True):
+    """
+    IntermediateLocationsQueue stream INSERT records (DynamoDB JSON, as
+    Lambda receives them) for the measurements of a target scenario.
+    Distance_candidates is JSON text, Channel_estimates the [[re, im]]
+    list written by IntermediateLocationsFunction.  Without
+    distance_candidates the records are exactly what
+    IntermediateLocationsFunction writes, with no Distance_candidates.
+    """
+    records = []
+    for i, (data, pose) in enumerate(zip(scenario["queue"], scenario["poses"])):
+        data = localize_utils.preprocess_data(data)
+        channel = np.asarray(data["channel_estimate"])[0]
+        image = {
+            "Device_id": {"S": device_id},
+            "Epc": {"S": epc},
+            "Area_id": {"S": str(area_id)},
+            "Timestamp": {"N": str(start_ms + i * period_ms)},
+            "Updater_pose": {"M": {
+                key: {"N": repr(float(val))}
+                for key, val in zip(("x", "y", "z", "qx", "qy", "qz", "qw"), pose)}},
+            "Channel_estimates": {"L": [
+                {"L": [{"N": repr(float(c.real))}, {"N": repr(float(c.imag))}]}
+                for c in channel]},
+        }
+        if distance_candidates:
+            image["Distance_candidates"] = {"S": json.dumps(
+                np.asarray(data["distance_candidates"])[0].tolist())}
+        records.append({
+            "eventID": f"{epc}-{i}",
+            "eventName": "INSERT",
+            "eventVersion": "1.1",
+            "eventSource": "aws:dynamodb",
+            "awsRegion": "us-east-1",
+            "dynamodb": {
+                "ApproximateCreationDateTime": (start_ms + i * period_ms) // 1000,
+                "Keys": {"Device_id": image["Device_id"], "Epc": image["Epc"]},
+                "NewImage": image,
+                "SequenceNumber": f"{next(_sequence_numbers):030d}",
+                "SizeBytes": len(json.dumps(image)),
+                "StreamViewType": "NEW_IMAGE",
+            },
+            "eventSourceARN": STREAM_ARN,
+        })
+    return records
+
+
+def batch_scenario(n_tags, n_meas, n_clusters=4, seed=0, noise=0.003,
+                   snr_db=20, radius=1.8, encoding="codec"):
+    """
+    Several tags seen from the same reader poses, every tag measured at
+    every pose, for target_localize_batch.
+
+    Returns: {
+        "ground_truth": {epc: (3, ) tag location},
+        "queue": data_queue, measurements of all tags pose by pose,
+        "pose_indices": (n_tags * n_meas, ) pose of each queue entry,
+        "poses": (n_meas, 7) TX antenna poses,
+    }
+    """
+    rng = np.random.default_rng(seed)
+    epcs = [f"TAG{tag:04d}" for tag in range(n_tags)]
+    ground_truth = {epc: rng.uniform(BOUND_MIN / 2, BOUND_MAX / 2) for epc in epcs}
+    queue, pose_indices, poses = [], [], []
+    for i in range(n_meas):
+        angle = 2 * np.pi * i / n_meas + rng.uniform(-0.1, 0.1)
+        tx_loc = np.array([radius * np.cos(angle),
+                           radius * np.sin(angle),
+                           rng.uniform(BOUND_MIN[2] / 2, BOUND_MAX[2] / 2)])
+        quat = scipy.spatial.transform.Rotation.from_euler(
+            "z", rng.uniform(0, 2 * np.pi)).as_quat()
+        rx_loc = scipy.spatial.transform.Rotation.from_quat(quat).apply(
+            TX_RX_OFFSET) + tx_loc
+        poses.append(np.concatenate([tx_loc, quat]))
+        for epc in epcs:
+            dist = bistatic_distance(ground_truth[epc], tx_loc, rx_loc)
+            clusters = measurement_clusters(rng, dist, n_clusters, noise)
+            channel = calibrated_channel(rng, dist, snr_db)
+            queue.append(queue_entry(epc, clusters[None], channel, encoding))
+            pose_indices.append(i)
+    return {
+        "ground_truth": ground_truth,
+        "queue": queue,
+        "pose_indices": np.array(pose_indices),
+        "poses": np.array(poses),
+    }
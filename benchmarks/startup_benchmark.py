@@ -0,0 +1,141 @@
+"""
+Cold start budget of the LocalizationFunction.
+
+Each run starts a fresh interpreter (like a new Lambda execution
+environment), imports localization_handler and times the import, the
+first handle_request on a synthetic stream batch and a second, warm one.
+The DynamoDB client is the in-memory LocalDynamoClient, so boto3 is not
+needed.  Reports the median of the runs, which heavy modules the import
+loaded, and exits 1 if the median import time is over --import-budget-ms.
+
+Usage:
+    python benchmarks/startup_benchmark.py --runs 5
+    python benchmarks/startup_benchmark.py --importtime
+"""
+
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+
+FUNCTION_DIR = pathlib.Path(__file__).resolve().parents[1] / "localization_function"
+
+# Median import time of localization_handler allowed, about numpy's own
+# import time plus the pipeline modules
+IMPORT_BUDGET_MS = 300
+
+# Modules that should not be loaded by the import alone
+HEAVY_MODULES = ("scipy", "scipy.optimize", "scipy.spatial", "boto3")
+
+CHILD = """
+import contextlib, io, json, sys, time
+sys.path.insert(0, {function_dir!r})
+start = time.perf_counter()
+import localization_handler
+import_s = time.perf_counter() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+
+with open({event_path!r}) as f:
+    event, config = json.load(f)
+timings = []
+with contextlib.redirect_stdout(io.StringIO()):
+    for _ in range(2):
+        start = time.perf_counter()
+        response = localization_handler.handle_request(
+            event, None,
+            ddb_client=localization_handler.LocalDynamoClient(),
+            config=config,
+            results=localization_handler.result_cache.ResultCache(),
+            tracks=localization_handler.tracking.Tracker())
+        timings.append(time.perf_counter() - start)
+print(json.dumps({{
+    "import_ms": import_s * 1e3,
+    "first_call_ms": timings[0] * 1e3,
+    "warm_call_ms": timings[1] * 1e3,
+    "loaded_by_import": loaded,
+    "failures": len(response["batchItemFailures"]),
+}}))
+"""
+
+
+def make_event(n_meas, n_clusters, n_shuffle, n_tags):
+    records = []
+    for tag in range(n_tags):
+        scenario = scenarios.target_scenario(n_meas, n_clusters, seed=tag)
+        records += scenarios.stream_records(scenario, epc=f"TAG{tag:04d}")
+    return {"Records": records}, scenarios.default_config(n_shuffle)
+
+
+def run_once(event_path):
+    code = CHILD.format(function_dir=str(FUNCTION_DIR), heavy=HEAVY_MODULES,
+                        event_path=str(event_path))
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(top):
+    """Slowest modules (cumulative) of the import, from -X importtime"""
+    code = f"import sys; sys.path.insert(0, {str(FUNCTION_DIR)!r}); import localization_handler"
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--measurements", type=int, default=6)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--shuffles", type=int, default=3)
+    parser.add_argument("--tags", type=int, default=2)
+    parser.add_argument("--import-budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--importtime", action="store_true",
+                        help="also show the slowest modules of the import")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        event_path = pathlib.Path(tmp) / "event.json"
+        event_path.write_text(json.dumps(make_event(
+            args.measurements, args.clusters, args.shuffles, args.tags)))
+        runs = [run_once(event_path) for _ in range(args.runs)]
+
+    print(f"{'run':>3} {'import_ms':>9} {'first_ms':>9} {'warm_ms':>9} failures")
+    for i, run in enumerate(runs):
+        print(f"{i:>3} {run['import_ms']:>9.1f} {run['first_call_ms']:>9.1f} "
+              f"{run['warm_call_ms']:>9.1f} {run['failures']:>8}")
+    median = {key: float(np.median([run[key] for run in runs]))
+              for key in ("import_ms", "first_call_ms", "warm_call_ms")}
+    print(f"median import {median['import_ms']:.1f} ms, first invocation "
+          f"{median['first_call_ms']:.1f} ms, warm invocation "
+          f"{median['warm_call_ms']:.1f} ms")
+    loaded = sorted({m for run in runs for m in run["loaded_by_import"]})
+    print(f"heavy modules loaded by the import: {', '.join(loaded) or 'none'}")
+
+    if args.importtime:
+        print()
+        print(f"{'cumulative_ms':>13} module")
+        for cumulative, name in import_profile(15):
+            print(f"{cumulative / 1e3:>13.1f} {name}")
+
+    if median["import_ms"] > args.import_budget_ms:
+        print(f"import over budget ({args.import_budget_ms:.0f} ms)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
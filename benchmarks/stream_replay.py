@@ -0,0 +1,294 @@
+"""
+Replay DynamoDB stream traffic through the LocalizationFunction handler.
+
+Builds IntermediateLocationsQueue stream records (synthetic ones from
+scenarios.py, or the Records of recorded event files shaped like
+events/event.json) and feeds them to localization_handler.handle_request
+the way one Lambda worker polling one shard would: records arrive at
+--rate per second and each invocation takes the records that have
+arrived, up to the batch size.  Arrival times are simulated, handler
+time is real (the measured duration of each call against the in-memory
+LocalDynamoClient), so a record's latency includes waiting for a busy
+worker.
+
+For every batch size and rate the throughput, record latency p50 / p99,
+invocation duration, worker utilization and localized tags are
+reported, plus the peak traced memory of one full batch invocation.
+Every batch size is also run with all records available at once, which
+gives the capacity of one worker (records / s with full batches).  A
+batch holds more records per tag the larger it is, so the work per record
+grows with the batch size; for every rate the batch size that saturates
+one worker is the smallest one whose capacity is below the rate.  The
+handler localizes a tag from its tag_history.TagHistory, the records of
+earlier batches included, so small batches localize a tag more often
+(the written column), each time from up to config["history_size"]
+records.
+
+Usage:
+    python benchmarks/stream_replay.py --tags 8 --measurements 6 \
+        --batch-sizes 1 5 10 25 --rates 5 20
+    python benchmarks/stream_replay.py --events recorded.json --batch-sizes 10
+    python benchmarks/stream_replay.py --join-poses --batch-sizes 10
+    python benchmarks/stream_replay.py --write-event event.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localization_handler  # noqa: E402
+import pose_index  # noqa: E402
+import fusion_state  # noqa: E402
+import result_cache  # noqa: E402
+import tag_history  # noqa: E402
+import tracking  # noqa: E402
+
+# Pose samples written around each measurement with --join-poses, ms
+POSE_SAMPLE_OFFSETS_MS = (-5, 5)
+
+
+# ------------------------------- Records -------------------------------- #
+
+def synthetic_records(n_tags, n_meas, n_clusters, period_ms, seed,
+                      device_id="UPDATER"):
+    """
+    Stream records of n_tags target scenarios, measured in turns by one
+    updater: tag t's i-th measurement is at i * period_ms + t * period_ms
+    / n_tags.  Sorted by timestamp.
+    """
+    records = []
+    start_ms = 1643179964390
+    for tag in range(n_tags):
+        scenario = scenarios.target_scenario(n_meas, n_clusters, seed + tag)
+        records += scenarios.stream_records(
+            scenario, epc=f"TAG{tag:04d}", device_id=device_id,
+            start_ms=start_ms + tag * period_ms // n_tags, period_ms=period_ms)
+    return sorted(records, key=record_timestamp)
+
+
+def recorded_records(paths):
+    """Records of recorded stream event files, in file order"""
+    records = []
+    for path in paths:
+        records += json.loads(pathlib.Path(path).read_text())["Records"]
+    return records
+
+
+def record_timestamp(record):
+    image = record["dynamodb"].get("NewImage", {})
+    return int(image.get("Timestamp", {}).get("N", 0))
+
+
+def without_poses(records):
+    """
+    Records without Updater_pose and the UpdaterHistoricalTable items
+    the handler joins them with (a sample before and after each one)
+    """
+    stripped = []
+    pose_items = []
+    for record in records:
+        record = json.loads(json.dumps(record))
+        image = record["dynamodb"]["NewImage"]
+        pose = image.pop("Updater_pose")["M"]
+        timestamp = int(image["Timestamp"]["N"])
+        for offset in POSE_SAMPLE_OFFSETS_MS:
+            pose_items.append({
+                "Device_id": image["Device_id"],
+                "Timestamp": {"S": str(timestamp + offset)},
+                **{"pose_" + key: pose[key] for key in pose_index.POSE_KEYS},
+            })
+        stripped.append(record)
+    return stripped, pose_items
+
+
+# -------------------------------- Replay -------------------------------- #
+
+def new_history():
+    return tag_history.TagHistory(fusion_state.MemoryStateStore())
+
+
+def invoke(records, client, config, results, tracks, histories):
+    """
+    One handle_request call.
+
+    Returns: (duration_s, failed records, handler stats)
+    """
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        response = localization_handler.handle_request(
+            {"Records": records}, None, ddb_client=client, config=config,
+            results=results, tracks=tracks, histories=histories)
+    duration = time.perf_counter() - start
+    stats = {}
+    for line in output.getvalue().splitlines():
+        if line.startswith('{"records"'):
+            stats = json.loads(line)
+    return duration, len(response["batchItemFailures"]), stats
+
+
+def make_client(pose_items):
+    client = localization_handler.LocalDynamoClient()
+    for item in pose_items:
+        client.put_item(localization_handler.UPDATER_TABLE, item)
+    return client
+
+
+def replay(records, batch_size, rate, config, pose_items=()):
+    """
+    Run the records through one simulated worker.  rate is records per
+    second, None for all records available at the start.  The worker
+    starts with an empty result cache, tag histories and no tag tracks.
+    """
+    n = len(records)
+    if rate is None:
+        arrivals = np.zeros(n)
+    else:
+        arrivals = np.arange(n) / rate
+    client = make_client(pose_items)
+    results = result_cache.ResultCache()
+    tracks = tracking.Tracker()
+    histories = new_history()
+
+    now = 0.0
+    i = 0
+    latencies, durations, sizes = [], [], []
+    failures = written = no_location = 0
+    while i < n:
+        now = max(now, arrivals[i])
+        j = i + 1
+        while j < n and j - i < batch_size and arrivals[j] <= now:
+            j += 1
+        duration, failed, stats = invoke(records[i:j], client, config, results,
+                                         tracks, histories)
+        now += duration
+        durations.append(duration)
+        sizes.append(j - i)
+        latencies += (now - arrivals[i:j]).tolist()
+        failures += failed
+        written += stats.get("written", 0)
+        no_location += stats.get("no_location", 0)
+        i = j
+
+    return {
+        "batch_size": batch_size,
+        "rate": rate,
+        "records": n,
+        "invocations": len(durations),
+        "mean_batch": float(np.mean(sizes)),
+        "throughput_rps": n / now if now > 0 else 0.0,
+        "capacity_rps": n / sum(durations),
+        "utilization": sum(durations) / now if now > 0 else 0.0,
+        "latency_s": {"p50": float(np.percentile(latencies, 50)),
+                      "p99": float(np.percentile(latencies, 99))},
+        "duration_s": {"p50": float(np.percentile(durations, 50)),
+                       "p99": float(np.percentile(durations, 99))},
+        "written": written,
+        "no_location": no_location,
+        "failed_records": failures,
+    }
+
+
+def peak_memory(records, batch_size, config, pose_items=()):
+    """Peak traced memory (bytes) of one invocation with a full batch"""
+    client = make_client(pose_items)
+    tracemalloc.start()
+    invoke(records[:batch_size], client, config, result_cache.ResultCache(),
+           tracking.Tracker(), new_history())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def saturating_batch_size(results, rate):
+    """
+    Smallest batch size whose full batch capacity is below rate, None if
+    one worker keeps up with all of them
+    """
+    return min((result["batch_size"] for result in results
+                if result["rate"] is None and result["capacity_rps"] < rate),
+               default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", nargs="+", type=pathlib.Path,
+                        help="recorded stream event files instead of synthetic")
+    parser.add_argument("--tags", type=int, default=8)
+    parser.add_argument("--measurements", type=int, default=6)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--period-ms", type=int, default=100,
+                        help="time between measurements of one tag")
+    parser.add_argument("--shuffles", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--join-poses", action="store_true",
+                        help="strip Updater_pose, the handler reads the poses")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--rates", type=float, nargs="*", default=[10.0],
+                        help="arrival rates, records / s")
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--write-event", type=pathlib.Path,
+                        help="write the first --batch-sizes records as an "
+                             "event file and exit")
+    args = parser.parse_args()
+
+    if args.events:
+        records = recorded_records(args.events)
+    else:
+        records = synthetic_records(args.tags, args.measurements, args.clusters,
+                                    args.period_ms, args.seed)
+    if args.write_event:
+        args.write_event.write_text(json.dumps(
+            {"Records": records[:max(args.batch_sizes)]}, indent=2))
+        return
+    pose_items = []
+    if args.join_poses:
+        records, pose_items = without_poses(records)
+    config = scenarios.default_config(args.shuffles, args.seed)
+
+    results = []
+    print(f"{'batch':>5} {'rate':>6} {'tput_rps':>8} {'cap_rps':>8} "
+          f"{'util':>5} {'lat_p50':>8} {'lat_p99':>8} {'dur_p99':>8} "
+          f"{'peak_MiB':>8} {'written':>7} {'failed':>6}")
+    for batch_size in args.batch_sizes:
+        peak = peak_memory(records, batch_size, config, pose_items)
+        for rate in [None] + list(args.rates):
+            result = replay(records, batch_size, rate, config, pose_items)
+            result["peak_mib"] = peak / 2**20
+            results.append(result)
+            print(f"{batch_size:>5} {'max' if rate is None else f'{rate:g}':>6} "
+                  f"{result['throughput_rps']:>8.2f} "
+                  f"{result['capacity_rps']:>8.2f} "
+                  f"{result['utilization']:>5.2f} "
+                  f"{result['latency_s']['p50']:>8.3f} "
+                  f"{result['latency_s']['p99']:>8.3f} "
+                  f"{result['duration_s']['p99']:>8.3f} "
+                  f"{result['peak_mib']:>8.1f} "
+                  f"{result['written']:>7} {result['failed_records']:>6}")
+
+    saturating = {}
+    for rate in args.rates:
+        saturating[rate] = saturating_batch_size(results, rate)
+        print(f"{rate:g} records/s: one worker saturates at batch size "
+              f"{saturating[rate] or 'none of ' + str(args.batch_sizes)}")
+
+    if args.output:
+        args.output.write_text(json.dumps(
+            {"args": vars(args),
+             "saturating_batch_size": {str(rate): size
+                                       for rate, size in saturating.items()},
+             "results": results}, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
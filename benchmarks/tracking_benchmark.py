@@ -0,0 +1,91 @@
+"""
+Effect of the tracking mode of target_localize_queue (a prior location,
+see localize_utils.track_localize()).
+
+Localizes target scenarios without a prior (the full area search), with
+a prior near the ground truth (a stationary tag) and with a prior
+--moved meters away from it (a tag that moved, which must fall back to
+the full search), and reports per case the time, the median location
+error, the locations found and the tracking metrics (hits, fallbacks).
+
+Usage:
+    python benchmarks/tracking_benchmark.py --measurements 10 \
+        --clusters 6 --spread 3 --seeds 3
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+import scenarios  # noqa: E402
+import localize_utils  # noqa: E402
+import metrics  # noqa: E402
+
+CASES = ("full", "stationary", "moved")
+
+
+def prior(case, ground_truth, rng, args):
+    if case == "full":
+        return None
+    direction = rng.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    offset = args.moved if case == "moved" else args.uncertainty
+    return {"location": (ground_truth + offset * direction).tolist(),
+            "uncertainty": args.uncertainty}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--measurements", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=6)
+    parser.add_argument("--spread", type=float, default=3.0)
+    parser.add_argument("--shuffles", type=int, default=3)
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--uncertainty", type=float, default=0.02,
+                        help="prior standard deviation, meters")
+    parser.add_argument("--moved", type=float, default=1.0,
+                        help="distance of the moved prior, meters")
+    args = parser.parse_args()
+
+    metrics.enable()
+    totals = {case: {"time_s": 0.0, "errors": []} for case in CASES}
+    counters = {case: {} for case in CASES}
+    for seed in range(args.seeds):
+        scenario = scenarios.target_scenario(
+            args.measurements, args.clusters, seed, spread=args.spread)
+        config = scenarios.default_config(args.shuffles, seed)
+        ground_truth = scenario["ground_truth"]
+        rng = np.random.default_rng(seed)
+        for case in CASES:
+            metrics.reset()
+            start = time.perf_counter()
+            location = localize_utils.target_localize_queue(
+                scenario["queue"], scenario["poses"], config,
+                prior(case, ground_truth, rng, args))
+            totals[case]["time_s"] += time.perf_counter() - start
+            totals[case]["errors"].append(
+                float("nan") if location is None
+                else float(np.linalg.norm(location - ground_truth)))
+            for name, value in metrics.snapshot()["counters"].items():
+                if name.startswith("tracking."):
+                    counters[case][name] = counters[case].get(name, 0) + value
+
+    print(f"{'case':>10} {'time_s':>7} {'err_p50':>8} {'found':>5} "
+          f"{'hits':>4} {'fallbacks':>9}")
+    for case, total in totals.items():
+        errors = np.array(total["errors"])
+        print(f"{case:>10} {total['time_s']:>7.3f} "
+              f"{np.nanmedian(errors):>8.4f} "
+              f"{np.count_nonzero(np.isfinite(errors)):>5} "
+              f"{counters[case].get('tracking.hits', 0):>4} "
+              f"{counters[case].get('tracking.fallbacks', 0):>9}")
+    localize_utils._close_shuffle_pool()
+
+
+if __name__ == "__main__":
+    main()
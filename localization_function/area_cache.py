@@ -0,0 +1,174 @@
+"""
+Per-area localization context, cached across warm Lambda invocations.
+
+Every area has its own config (bounds, tx_rx_offset, cal_dist, ...) and
+set of reference tag locations.  An AreaContext holds them ready to use:
+the config arrays already converted to numpy and the reference
+locations as one contiguous (n, 3) array with an EPC -> row index.
+AreaCache keeps the contexts of recently seen areas for ttl_s seconds,
+at most max_areas of them (least recently used evicted first), and
+loads missing or expired ones with a loader:
+    static_loader(config, ref_locs): the same context for every area
+    DynamoAreaLoader: one item per area in a DynamoDB table, on top of a
+        default config
+"""
+
+import collections
+import json
+import time
+
+import numpy as np
+
+import metrics
+
+# Contexts older than this are reloaded
+AREA_CACHE_TTL_S = 300.0
+# Most areas kept
+AREA_CACHE_SIZE = 64
+
+# Config values converted to float arrays once per area
+ARRAY_KEYS = ("min_bounds", "max_bounds", "tx_rx_offset")
+
+
+class ReferenceLocations:
+    """
+    Reference tag locations, an EPC -> row index into a contiguous
+    (n, 3) coordinate array
+    """
+
+    def __init__(self, ref_locs=None):
+        ref_locs = ref_locs or {}
+        self.index = {epc: row for row, epc in enumerate(ref_locs)}
+        self.coords = np.array([ref_locs[epc] for epc in ref_locs],
+                               dtype=float).reshape(-1, 3)
+        self.coords.flags.writeable = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, epc):
+        return epc in self.index
+
+    def __getitem__(self, epc):
+        return self.coords[self.index[epc]]
+
+    def lookup(self, epcs):
+        """(len(epcs), 3) locations, KeyError for an unknown EPC"""
+        return self.coords[[self.index[epc] for epc in epcs]]
+
+
+class AreaContext:
+    """
+    Config and reference locations of one area.  config is a copy of the
+    area's config with the ARRAY_KEYS values as read-only float arrays,
+    which the localize_utils queue functions use without copying.
+    """
+
+    def __init__(self, area_id, config, ref_locs=None, loaded_at=0.0):
+        self.area_id = area_id
+        self.config = dict(config)
+        for key in ARRAY_KEYS:
+            if key in self.config:
+                arr = np.array(self.config[key], dtype=float)
+                arr.flags.writeable = False
+                self.config[key] = arr
+        self.ref_locs = ReferenceLocations(ref_locs)
+        self.loaded_at = loaded_at
+
+
+def static_loader(config, ref_locs=None):
+    """Loader giving every area the same config and reference locations"""
+    def load(area_id):
+        return config, ref_locs
+    return load
+
+
+class DynamoAreaLoader:
+    """
+    Loader reading one item per area from a DynamoDB table keyed by
+    Area_id (N).  The item's Config attribute (JSON string) overrides
+    the default config, Reference_tags (map of EPC to [x, y, z]) gives
+    the reference locations.  An area without an item gets the default
+    config and no reference locations.
+    """
+
+    def __init__(self, ddb_client, table_name, default_config=None):
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+        self.default_config = default_config or {}
+
+    def __call__(self, area_id):
+        response = self.ddb_client.get_item(
+            TableName=self.table_name,
+            Key={"Area_id": {"N": str(area_id)}})
+        item = response.get("Item") or {}
+        config = dict(self.default_config)
+        if "Config" in item:
+            config.update(json.loads(item["Config"]["S"]))
+        ref_locs = {
+            epc: [float(coord["N"]) for coord in loc["L"]]
+            for epc, loc in item.get("Reference_tags", {}).get("M", {}).items()}
+        return config, ref_locs
+
+
+class AreaCache:
+    """
+    AreaContexts by Area_id, loaded with loader(area_id) -> (config,
+    ref_locs) when missing or older than ttl_s.  Hits, misses,
+    expirations and evictions are counted in stats and as
+    area_cache.* metrics.
+    """
+
+    def __init__(self, loader, ttl_s=AREA_CACHE_TTL_S,
+                 max_areas=AREA_CACHE_SIZE, clock=time.monotonic):
+        self.loader = loader
+        self.ttl_s = ttl_s
+        self.max_areas = max_areas
+        self.clock = clock
+        self._contexts = collections.OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+        }
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.count(f"area_cache.{name}")
+
+    def get(self, area_id):
+        """AreaContext of area_id, loaded if needed"""
+        key = str(area_id)
+        now = self.clock()
+        context = self._contexts.get(key)
+        if context is not None:
+            if now - context.loaded_at <= self.ttl_s:
+                self._contexts.move_to_end(key)
+                self._count('hits')
+                return context
+            self._count('expired')
+            del self._contexts[key]
+
+        self._count('misses')
+        config, ref_locs = self.loader(area_id)
+        context = AreaContext(key, config, ref_locs, loaded_at=now)
+        self._contexts[key] = context
+        while len(self._contexts) > self.max_areas:
+            self._contexts.popitem(last=False)
+            self._count('evictions')
+        return context
+
+    def invalidate(self, area_id=None):
+        """Drop one area, or all of them"""
+        if area_id is None:
+            self._contexts.clear()
+        else:
+            self._contexts.pop(str(area_id), None)
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
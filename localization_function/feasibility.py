@@ -0,0 +1,116 @@
+"""
+Cheap geometric tests of measurement clusters before any least squares.
+
+A cluster distance d of a measurement is the bistatic distance
+|p - tx| + |p - rx| of the tag, so the tag lies on the ellipsoid with
+foci tx, rx and semi-major axis d / 2.  A cluster can only give a valid
+intersection if that ellipsoid passes through the area box, and can only
+extend a previous intersection if it passes near its location.  Both are
+checked here with axis aligned bounding boxes, for all clusters of a
+measurement at once.  The tests are conservative: a cluster they reject
+cannot give a location inside the box (or within tolerance of the
+candidates), a cluster they keep may still fail later.
+"""
+
+import numpy as np
+
+
+def ellipsoid_boxes(tx_loc, rx_loc, dists):
+    """
+    Axis aligned bounding boxes of the ellipsoids |p - tx| + |p - rx| =
+    d, one per entry of dists.  A distance below |tx - rx| has no
+    points, its box is empty (lo > hi).
+
+    Returns: (lo, hi), both (n, 3)
+    """
+    tx_loc = np.asarray(tx_loc, dtype=float)
+    rx_loc = np.asarray(rx_loc, dtype=float)
+    dists = np.asarray(dists, dtype=float)
+    center = (tx_loc + rx_loc) / 2
+    axis = rx_loc - tx_loc
+    focal = np.linalg.norm(axis) / 2
+    unit = axis / (2 * focal) if focal > 0 else np.zeros(3)
+
+    a = dists / 2
+    b_sq = np.fmax(a**2 - focal**2, 0.0)
+    # Half extent along each axis of a spheroid with semi-axes a (along
+    # unit) and b: sqrt(a^2 u_i^2 + b^2 (1 - u_i^2))
+    half = np.sqrt(a[:, None]**2 * unit**2 + b_sq[:, None] * (1 - unit**2))
+    empty = (a < focal)[:, None]
+    return (np.where(empty, np.inf, center - half),
+            np.where(empty, -np.inf, center + half))
+
+
+def _box_distance(point, bound_min, bound_max):
+    """Distance from point to the box, 0 inside"""
+    return np.linalg.norm(np.fmax(bound_min - point, 0.0)
+                          + np.fmax(point - bound_max, 0.0))
+
+
+def bistatic_range(tx_loc, rx_loc, bound_min, bound_max):
+    """
+    (smallest, largest) bistatic distance |p - tx| + |p - rx| of a point
+    p in the box.  smallest is dist(tx, box) + dist(rx, box), a lower
+    bound, largest is exact (at a corner).
+    """
+    tx_loc = np.asarray(tx_loc, dtype=float)
+    rx_loc = np.asarray(rx_loc, dtype=float)
+    bound_min = np.asarray(bound_min, dtype=float)
+    bound_max = np.asarray(bound_max, dtype=float)
+    corners = np.stack(np.meshgrid(*zip(bound_min, bound_max), indexing="ij"),
+                       axis=-1).reshape(-1, 3)
+    largest = np.max(np.linalg.norm(corners - tx_loc, axis=1)
+                     + np.linalg.norm(corners - rx_loc, axis=1))
+    smallest = (_box_distance(tx_loc, bound_min, bound_max)
+                + _box_distance(rx_loc, bound_min, bound_max))
+    return smallest, largest
+
+
+def box_feasible(tx_loc, rx_loc, dists, bound_min, bound_max, margin=0.0,
+                 tolerance=0.0):
+    """
+    Clusters whose ellipsoid can pass through the box grown by margin,
+    for some distance within tolerance (in bistatic distance) of d.
+    A cluster is rejected if
+        the bounding box of the ellipsoid of d + tolerance misses the box,
+        d - tolerance is above the largest bistatic distance of a box
+            corner (the ellipsoid encloses the box), or
+        d + tolerance is below dist(tx, box) + dist(rx, box), the
+            smallest bistatic distance of a point in the box can be no
+            less.
+    Non-finite distances are not feasible.
+
+    Returns: (n, ) bool
+    """
+    tx_loc = np.asarray(tx_loc, dtype=float)
+    rx_loc = np.asarray(rx_loc, dtype=float)
+    dists = np.asarray(dists, dtype=float)
+    bound_min = np.asarray(bound_min, dtype=float) - margin
+    bound_max = np.asarray(bound_max, dtype=float) + margin
+
+    lo, hi = ellipsoid_boxes(tx_loc, rx_loc, dists + tolerance)
+    overlaps = np.all((lo <= bound_max) & (hi >= bound_min), axis=1)
+
+    smallest, largest = bistatic_range(tx_loc, rx_loc, bound_min, bound_max)
+    with np.errstate(invalid="ignore"):
+        return (overlaps & (dists - tolerance <= largest)
+                & (dists + tolerance >= smallest))
+
+
+def near_locations(tx_loc, rx_loc, dists, locations, tolerance):
+    """
+    Clusters whose ellipsoid can pass within tolerance (in bistatic
+    distance) of one of the (m, 3) locations: the bounding box of the
+    ellipsoid of d + tolerance overlaps the bounding box of the
+    locations.  A location outside that box has a bistatic distance
+    above d + tolerance.
+
+    Returns: (n, ) bool, all False without locations
+    """
+    dists = np.asarray(dists, dtype=float)
+    locations = np.asarray(locations, dtype=float).reshape(-1, 3)
+    if locations.shape[0] == 0:
+        return np.zeros(dists.shape[0], dtype=bool)
+    lo, hi = ellipsoid_boxes(tx_loc, rx_loc, dists + tolerance)
+    return np.all((lo <= locations.max(axis=0))
+                  & (hi >= locations.min(axis=0)), axis=1)
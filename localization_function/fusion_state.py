@@ -0,0 +1,315 @@
+"""
+Checkpoint / restore of per-tag MultiFusion state between Lambda
+invocations.
+
+MultiFusion.process_new_measurement is incremental, so instead of
+re-running the whole IntermediateLocationsQueue of a tag for every new
+record, the fusion state of each (Area_id, Epc) is saved after a step and
+restored for the next one.  The state (candidate sets, compacted
+intersection history, measurement count, bounds, thresholds and solver
+options) is written as a compressed .npz blob with a JSON header, loaded
+with allow_pickle=False.
+
+Storage is pluggable, anything with get(key) / put(key, blob) /
+delete(key) works:
+    MemoryStateStore: dict in the process, survives warm invocations
+    FileStateStore: one file per key in a directory
+    DynamoStateStore: binary attribute of a DynamoDB table, either a
+        boto3 Table resource or the LocalDynamoTable stand-in
+"""
+
+import io
+import json
+import os
+import pathlib
+import urllib.parse
+import zipfile
+
+import numpy as np
+
+import multi_fusion as mf
+
+STATE_VERSION = 2
+
+# DynamoDB items are limited to 400 KB, leave room for the other attributes
+MAX_STATE_BYTES = 350 * 1024
+
+# MultiFusion attributes saved with the state
+THRESHOLDS = (
+    'RESIDUAL_COST_THR',
+    'REALLY_GOOD_RESIDUAL_PERCENTAGE',
+    'ABSOLUTE_RESIDUAL_THRESHOLD',
+    'DISTANCE_THRESHOLD',
+    'PRUNE_CLOSE_DISTANCE_THRESHOLD',
+    'FEASIBILITY_TOLERANCE',
+)
+OPTIONS = ('run_early_return', 'warm_start', 'analytic_jac', 'solver',
+           'beam_width', 'dedup', 'max_candidates', 'time_budget',
+           'precision', 'precheck')
+
+_CANDIDATE_FIELDS = (
+    'location',
+    'residual_cost',
+    'combined_cluster_cost',
+    'cand_counts',
+    'node',
+)
+
+
+def state_key(area_id, epc):
+    return f"{area_id}#{epc}"
+
+
+def dump_fusion(fusion, meta=None, extra=None):
+    """
+    Serialize a MultiFusion (compacting its history first).  meta is any
+    JSON-able dict stored alongside, e.g. the last applied record, and
+    extra any named numpy arrays (no object arrays), e.g. the state of
+    a localize_utils.TiebreakerAccumulator.
+
+    Returns: bytes
+    """
+    fusion.compactHistory()
+    history = fusion.history
+    header = {
+        'version': STATE_VERSION,
+        'num_of_rx': fusion.num_of_rx,
+        'prev_keys': [int(k) for k in fusion.prev.keys()],
+        'thresholds': {name: getattr(fusion, name) for name in THRESHOLDS},
+        'options': {name: getattr(fusion, name) for name in OPTIONS},
+        'meta': meta or {},
+    }
+    arrays = {
+        'header': np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+        'bound_min': np.asarray(fusion.bound_min, dtype=float),
+        'bound_max': np.asarray(fusion.bound_max, dtype=float),
+        'hist_parent': history.parent[:history.num_nodes],
+        'hist_meas_index': history.meas_index[:history.num_nodes],
+        'hist_cluster_index': history.cluster_index[:history.num_nodes],
+        'hist_cluster': history.cluster[:history.num_nodes],
+        'meas_rx_locs': history.rx_locs[:history.num_meas],
+        'meas_tx_locs': history.tx_locs[:history.num_meas],
+        'meas_ids': history.meas_ids[:history.num_meas],
+    }
+    for k, solutions in fusion.prev.items():
+        for field in _CANDIDATE_FIELDS:
+            arrays[f'prev{k}_{field}'] = getattr(solutions, field)[:len(solutions)]
+    for name, val in (extra or {}).items():
+        arrays[f'extra_{name}'] = np.asarray(val)
+
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def load_fusion(blob):
+    """
+    Inverse of dump_fusion.
+
+    Returns: (MultiFusion, meta), the extra arrays are in
+    meta['arrays'] if any were saved
+    """
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        header = json.loads(data['header'].tobytes().decode())
+        if header.get('version') != STATE_VERSION:
+            raise ValueError(
+                f"Fusion state version {header.get('version')}, "
+                f"expected {STATE_VERSION}")
+        options = header['options']
+        beam_width = options['beam_width']
+        if isinstance(beam_width, dict):
+            # JSON object keys are strings
+            beam_width = {int(k): width for k, width in beam_width.items()}
+        fusion = mf.MultiFusion(
+            bound_min=data['bound_min'],
+            bound_max=data['bound_max'],
+            early_return=options['run_early_return'],
+            warm_start=options['warm_start'],
+            analytic_jac=options['analytic_jac'],
+            solver=options['solver'],
+            beam_width=beam_width,
+            dedup=options['dedup'],
+            max_candidates=options['max_candidates'],
+            time_budget=options['time_budget'],
+            precision=options.get('precision', 'float64'),
+            precheck=options['precheck'],
+        )
+        for name, val in header['thresholds'].items():
+            setattr(fusion, name, val)
+        fusion.num_of_rx = header['num_of_rx']
+
+        history = fusion.history
+        history.parent = data['hist_parent']
+        history.meas_index = data['hist_meas_index']
+        history.cluster_index = data['hist_cluster_index']
+        history.cluster = data['hist_cluster']
+        history.num_nodes = history.parent.shape[0]
+        history.rx_locs = data['meas_rx_locs']
+        history.tx_locs = data['meas_tx_locs']
+        history.meas_ids = data['meas_ids']
+        history.num_meas = history.rx_locs.shape[0]
+
+        fusion.prev = {}
+        for k in header['prev_keys']:
+            fusion.prev[k] = mf.CandidateSet.from_arrays(
+                *(data[f'prev{k}_{field}'] for field in _CANDIDATE_FIELDS))
+        meta = header['meta']
+        extra = {name[len('extra_'):]: data[name]
+                 for name in data.files if name.startswith('extra_')}
+        if extra:
+            meta['arrays'] = extra
+    return fusion, meta
+
+
+# ------------------------------ Stores ------------------------------ #
+
+class MemoryStateStore:
+    """Blobs in a dict, kept as long as the process is warm"""
+
+    def __init__(self):
+        self._items = {}
+
+    def get(self, key):
+        return self._items.get(key)
+
+    def put(self, key, blob):
+        self._items[key] = bytes(blob)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+
+class FileStateStore:
+    """One file per key in directory (e.g. /tmp on Lambda)"""
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / (urllib.parse.quote(key, safe='') + '.state')
+
+    def get(self, key):
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, blob):
+        # Write then rename so a reader never sees a partial file
+        path = self._path(key)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(blob)
+        os.replace(tmp, path)
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class DynamoStateStore:
+    """
+    Blobs as a binary attribute of a DynamoDB table.  table is a boto3
+    Table resource or anything with the same get_item / put_item /
+    delete_item methods, such as LocalDynamoTable.
+    """
+
+    def __init__(self, table, key_name='State_key', attribute='State'):
+        self.table = table
+        self.key_name = key_name
+        self.attribute = attribute
+
+    def get(self, key):
+        item = self.table.get_item(Key={self.key_name: key}).get('Item')
+        if item is None or self.attribute not in item:
+            return None
+        blob = item[self.attribute]
+        # boto3 wraps binary attributes in boto3.dynamodb.types.Binary
+        return bytes(getattr(blob, 'value', blob))
+
+    def put(self, key, blob):
+        self.table.put_item(Item={
+            self.key_name: key,
+            self.attribute: bytes(blob),
+            'State_version': STATE_VERSION,
+        })
+
+    def delete(self, key):
+        self.table.delete_item(Key={self.key_name: key})
+
+
+class LocalDynamoTable:
+    """In-memory stand-in for the boto3 Table methods DynamoStateStore uses"""
+
+    def __init__(self, key_name='State_key'):
+        self.key_name = key_name
+        self.items = {}
+
+    def get_item(self, Key):
+        item = self.items.get(Key[self.key_name])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item):
+        self.items[Item[self.key_name]] = dict(Item)
+        return {}
+
+    def delete_item(self, Key):
+        self.items.pop(Key[self.key_name], None)
+        return {}
+
+
+# --------------------------- Checkpointer --------------------------- #
+
+class FusionCheckpointer:
+    """
+    Load / save the MultiFusion of each (Area_id, Epc) in a store.
+
+    A state that fails to load (unknown version, corrupt blob) counts as
+    missing.  A state larger than max_bytes is not saved and the old one
+    is deleted, so the next load misses and the caller recomputes from
+    the full queue.
+    """
+
+    def __init__(self, store, max_bytes=MAX_STATE_BYTES):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.stats = {
+            'loads': 0,
+            'misses': 0,
+            'invalid': 0,
+            'saves': 0,
+            'too_large': 0,
+            'bytes_saved': 0,
+        }
+
+    def load(self, area_id, epc):
+        """Returns: (MultiFusion, meta), or (None, None) if there is no state"""
+        blob = self.store.get(state_key(area_id, epc))
+        if blob is None:
+            self.stats['misses'] += 1
+            return None, None
+        try:
+            fusion, meta = load_fusion(blob)
+        except (ValueError, KeyError, OSError, EOFError, zipfile.BadZipFile):
+            self.stats['invalid'] += 1
+            return None, None
+        self.stats['loads'] += 1
+        return fusion, meta
+
+    def save(self, area_id, epc, fusion, meta=None, extra=None):
+        """Returns: True if the state was stored"""
+        key = state_key(area_id, epc)
+        blob = dump_fusion(fusion, meta, extra)
+        if len(blob) > self.max_bytes:
+            self.stats['too_large'] += 1
+            self.store.delete(key)
+            return False
+        self.store.put(key, blob)
+        self.stats['saves'] += 1
+        self.stats['bytes_saved'] += len(blob)
+        return True
+
+    def delete(self, area_id, epc):
+        self.store.delete(state_key(area_id, epc))
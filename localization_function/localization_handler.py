@@ -1,13 +1,682 @@
-from __future__ import print_function
-import boto3
-import localize_utils
-
-client = boto3.client('dynamodb')
-
-
-def handle_request(event, context):
-    for record in event["Records"]:
-        print(record)
-        
-        
-    return "localization_handler finished running" + "\n"
\ No newline at end of file
+from __future__ import print_function
+import base64
+import json
+import os
+import time
+
+import numpy as np
+
+import area_cache
+import fusion_state
+import localize_utils
+import measurement_codec
+import metrics
+import pose_index
+import result_cache
+import tag_history
+import tracking
+
+# DynamoDB client, created on first use by get_client().  Importing boto3
+# and creating a client take a large part of a cold start, and are not
+# needed when a client is passed in.
+client = None
+
+LOCALIZED_TAGS_TABLE = os.environ.get("LOCALIZED_TAGS_TABLE", "LocalizedTags")
+
+# Pose stream of the updaters, read for records without Updater_pose
+UPDATER_TABLE = os.environ.get("UPDATER_HISTORICAL_TABLE", "UpdaterHistoricalTable")
+# Staleness limits of the pose join, see pose_index.PoseIndex.lookup()
+POSE_MAX_GAP_MS = float(os.environ.get("POSE_MAX_GAP_MS", pose_index.POSE_MAX_GAP_MS))
+POSE_MAX_HOLD_MS = float(os.environ.get("POSE_MAX_HOLD_MS", pose_index.POSE_MAX_HOLD_MS))
+
+# Optional table of per-area config and reference tags, see
+# area_cache.DynamoAreaLoader.  Without it every area uses load_config().
+AREA_CONFIG_TABLE = os.environ.get("AREA_CONFIG_TABLE")
+
+# area_cache.AreaCache of the areas seen, created by get_area_cache() and
+# kept across warm invocations
+areas = None
+
+# Optional table shared by all workers for the cached localization
+# results (key Result_key), see get_result_cache().  Without it results
+# are only cached in the process.
+RESULT_CACHE_TABLE = os.environ.get("RESULT_CACHE_TABLE")
+RESULT_CACHE_TTL_S = float(os.environ.get("RESULT_CACHE_TTL_S",
+                                          result_cache.RESULT_CACHE_TTL_S))
+
+# result_cache.ResultCache, created by get_result_cache() and kept across
+# warm invocations
+results = None
+
+# Optional table (key State_key) of the per-tag state kept between
+# invocations: the measurement history (see tag_history) and, in areas
+# with config["incremental"], the fusion_state checkpoint.  Without it the
+# state is kept in the process, which sees all records of a shard while
+# it is warm.
+LOCALIZATION_STATE_TABLE = os.environ.get("LOCALIZATION_STATE_TABLE")
+
+# tag_history.TagHistory and fusion_state.FusionCheckpointer, created by
+# get_tag_history() / get_checkpointer() and kept across warm invocations
+histories = None
+checkpointer = None
+
+# tracking.Tracker of the tags localized by this process, the priors of
+# areas with config["tracking"]
+tracker = tracking.Tracker()
+
+# BatchWriteItem accepts at most 25 put requests
+BATCH_WRITE_SIZE = 25
+# Retries of UnprocessedItems, with exponential backoff from
+# WRITE_BACKOFF_S seconds
+WRITE_RETRIES = 5
+WRITE_BACKOFF_S = 0.05
+
+# Keys of the Updater_pose map, in [x,y,z,qx,qy,qz,qw] order
+POSE_KEYS = ("x", "y", "z", "qx", "qy", "qz", "qw")
+
+
+def get_client():
+    global client
+    if client is None:
+        import boto3
+        client = boto3.client('dynamodb')
+    return client
+
+
+# ----------------------- DynamoDB attribute values ----------------------- #
+
+def _number(text):
+    val = float(text)
+    return int(val) if val.is_integer() and "." not in text else val
+
+def deserialize(attr):
+    """
+    Convert a DynamoDB typed attribute value ({"N": "1.5"}, {"L": [...]},
+    ...) to Python.  B is base64 text in stream events and bytes from
+    boto3, both come back as bytes.
+    """
+    (kind, val), = attr.items()
+    if kind == "S":
+        return val
+    if kind == "N":
+        return _number(val)
+    if kind == "B":
+        return base64.b64decode(val) if isinstance(val, str) else bytes(val)
+    if kind == "L":
+        return [deserialize(item) for item in val]
+    if kind == "M":
+        return {key: deserialize(item) for key, item in val.items()}
+    if kind == "BOOL":
+        return val
+    if kind == "NULL":
+        return None
+    if kind == "SS":
+        return set(val)
+    if kind == "NS":
+        return {_number(item) for item in val}
+    raise ValueError(f"Unsupported attribute type {kind}")
+
+def serialize(val):
+    """
+    Inverse of deserialize for the types written to LocalizedTags
+    """
+    if isinstance(val, (bool, np.bool_)):
+        return {"BOOL": bool(val)}
+    if isinstance(val, str):
+        return {"S": val}
+    if isinstance(val, (int, float, np.integer, np.floating)):
+        return {"N": repr(val.item() if isinstance(val, np.generic) else val)}
+    if isinstance(val, (bytes, bytearray)):
+        return {"B": bytes(val)}
+    if isinstance(val, dict):
+        return {"M": {key: serialize(item) for key, item in val.items()}}
+    if isinstance(val, (list, tuple)):
+        return {"L": [serialize(item) for item in val]}
+    if val is None:
+        return {"NULL": True}
+    raise ValueError(f"Cannot serialize {type(val)}")
+
+
+# ------------------------------ Stream records ---------------------------- #
+
+def _measurement_array(val, dtype):
+    """Binary measurement_codec, JSON text or a (nested) list"""
+    if measurement_codec.is_encoded(val):
+        return measurement_codec.decode_array(val)
+    if isinstance(val, str):
+        val = json.loads(val)
+    return np.asarray(val, dtype=dtype)
+
+def parse_record(record):
+    """
+    Convert an IntermediateLocationsQueue stream record to
+    {area_id, epc, device_id, timestamp, pose, data}, where data is a
+    queue entry for localize_utils.target_localize_queue and pose is the
+    TX antenna pose [x,y,z,qx,qy,qz,qw].  pose is None if the record has
+    no Updater_pose, join_poses() then looks it up.
+
+    Distance_candidates ([[distance, cost], ...] of the tag, binary or
+    JSON) is required, Channel_estimates is the [[re, im], ...] list
+    written by IntermediateLocationsFunction or a binary complex array.
+    Area_id is a number or its text, area_id an int.
+
+    Returns None for REMOVE records, raises KeyError / ValueError if the
+    record is malformed.
+    """
+    if record["eventName"] == "REMOVE":
+        return None
+    item = {key: deserialize(val)
+            for key, val in record["dynamodb"]["NewImage"].items()}
+
+    pose = item.get("Updater_pose")
+    if pose is not None:
+        pose = np.array([pose[key] if key in pose else pose["pose_" + key]
+                         for key in POSE_KEYS], dtype=float)
+    elif "Device_id" not in item:
+        raise ValueError("Record has no Updater_pose and no Device_id")
+
+    area_id = item["Area_id"]
+    if isinstance(area_id, str):
+        area_id = int(area_id)
+    elif isinstance(area_id, float) and area_id.is_integer():
+        area_id = int(area_id)
+    if not isinstance(area_id, int):
+        raise ValueError(f"Area_id {area_id!r} is not an integer")
+
+    if "Distance_candidates" not in item:
+        raise ValueError("Record has no Distance_candidates")
+    clusters = _measurement_array(item["Distance_candidates"], float)
+    if clusters.ndim == 2:
+        clusters = clusters[None]
+    if clusters.ndim != 3 or clusters.shape[-1] != 2:
+        raise ValueError(f"Distance_candidates has shape {clusters.shape}")
+
+    channels = item["Channel_estimates"]
+    if isinstance(channels, list):
+        channels = np.asarray(channels, dtype=float)
+        if channels.shape[-1] != 2:
+            raise ValueError(f"Channel_estimates has shape {channels.shape}")
+        channels = channels[..., 0] + 1j * channels[..., 1]
+    else:
+        channels = _measurement_array(channels, complex)
+    if channels.ndim == 1:
+        channels = channels[None]
+    if channels.shape[-1] != len(localize_utils.WAVELENGTHS):
+        raise ValueError(f"Channel_estimates has shape {channels.shape}")
+
+    return {
+        "area_id": area_id,
+        "epc": item["Epc"],
+        "device_id": item.get("Device_id"),
+        "timestamp": item["Timestamp"],
+        "pose": pose,
+        "data": {
+            "epc": item["Epc"],
+            "distance_candidates": clusters,
+            "channel_estimate": channels,
+        },
+    }
+
+def group_records(records):
+    """
+    Parse stream records and group them by tag.
+
+    A record that fails to parse would fail again on every retry, and
+    would hold back the records behind it on its shard.  It is logged and
+    skipped instead of failing.
+
+    Returns: (groups, malformed)
+        groups: {(area_id, epc): [(sequence_number, parsed record)]},
+            each group in timestamp order
+        malformed: sequence numbers of the records that failed to parse
+    """
+    groups = {}
+    malformed = []
+    for record in records:
+        sequence_number = record["dynamodb"]["SequenceNumber"]
+        try:
+            parsed = parse_record(record)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Skipping malformed record {sequence_number}: {e!r}")
+            malformed.append(sequence_number)
+            continue
+        if parsed is None:
+            continue
+        key = (parsed["area_id"], parsed["epc"])
+        groups.setdefault(key, []).append((sequence_number, parsed))
+    for group in groups.values():
+        group.sort(key=lambda entry: entry[1]["timestamp"])
+    metrics.count("records.malformed", len(malformed))
+    return groups, malformed
+
+def join_poses(groups, ddb_client, table_name=UPDATER_TABLE,
+               max_gap_ms=POSE_MAX_GAP_MS, max_hold_ms=POSE_MAX_HOLD_MS):
+    """
+    Look up the pose of the grouped records that have none, with one
+    UpdaterHistoricalTable range Query per device for the whole batch
+    and a pose_index.PoseIndex lookup of all of its timestamps.
+
+    Records whose pose is stale are dropped from their group (and empty
+    groups removed), retrying them would not make the poses appear.
+    The records of a device whose poses could not be read fail.
+
+    Returns: (sequence numbers of failed records, number of stale records)
+    """
+    missing = {}
+    for group in groups.values():
+        for _, parsed in group:
+            if parsed["pose"] is None:
+                missing.setdefault(parsed["device_id"], []).append(parsed)
+    if not missing:
+        return [], 0
+
+    dropped = set()
+    failed = set()
+    margin = max(max_gap_ms, max_hold_ms)
+    for device_id, parsed_records in missing.items():
+        timestamps = np.array([parsed["timestamp"] for parsed in parsed_records],
+                              dtype=float)
+        try:
+            with metrics.span("pose_query"):
+                index = pose_index.query_pose_index(
+                    ddb_client, table_name, device_id,
+                    timestamps.min() - margin, timestamps.max() + margin)
+        except Exception as e:
+            print(f"Reading the poses of {device_id} failed: {e!r}")
+            failed.update(id(parsed) for parsed in parsed_records)
+            continue
+        poses, valid = index.lookup(timestamps, max_gap_ms, max_hold_ms)
+        for parsed, pose, is_valid in zip(parsed_records, poses, valid):
+            if is_valid:
+                parsed["pose"] = pose
+            else:
+                dropped.add(id(parsed))
+
+    failures = []
+    for key in list(groups):
+        kept = []
+        for sequence_number, parsed in groups[key]:
+            if id(parsed) in failed:
+                failures.append(sequence_number)
+            elif id(parsed) not in dropped:
+                kept.append((sequence_number, parsed))
+        if kept:
+            groups[key] = kept
+        else:
+            del groups[key]
+    metrics.count("poses.joined", sum(map(len, missing.values())))
+    metrics.count("poses.stale", len(dropped))
+    return failures, len(dropped)
+
+
+# -------------------------------- Localize -------------------------------- #
+
+def localize_group(records, config, results=None, prior=None):
+    """
+    Localize one tag from its parsed records (all measurements in a
+    single target_localize_queue call, searching around prior first if
+    given).  With a result_cache.ResultCache, records localized before
+    give the cached location.
+
+    Returns: [x,y,z] or None if no location was found
+    """
+    data_queue = [record["data"] for record in records]
+    poses = [record["pose"] for record in records]
+    if results is not None:
+        return result_cache.target_localize_queue(results, data_queue,
+                                                  poses, config, prior)
+    return localize_utils.target_localize_queue(data_queue, poses, config,
+                                                prior)
+
+def localize_incremental(area_id, epc, records, config, checkpoints):
+    """
+    Localize one tag by applying its parsed records one at a time to its
+    checkpointed fusion state (localize_utils.target_localize_incremental,
+    records already applied are skipped), for areas with
+    config["incremental"].
+
+    Returns: [x,y,z] or None if no location was found
+    """
+    location = None
+    for record in records:
+        location, _ = localize_utils.target_localize_incremental(
+            checkpoints, area_id, epc, record["data"], record["pose"], config,
+            timestamp=record["timestamp"])
+    return location
+
+def localized_tag_item(area_id, epc, location, records, config):
+    """LocalizedTags item (low level format) for a localized tag"""
+    return {key: serialize(val) for key, val in {
+        "Area_id": int(area_id),
+        "Epc": epc,
+        "Timestamp": str(records[-1]["timestamp"]),
+        "status": 1,
+        "location_x": float(location[0]),
+        "location_y": float(location[1]),
+        "location_z": float(location[2]),
+        "precision_radius": float(config.get("precision_radius", 0.0)),
+    }.items()}
+
+
+# --------------------------------- Writes --------------------------------- #
+
+def _item_key(item):
+    return item["Area_id"]["N"], item["Epc"]["S"]
+
+def batch_write(ddb_client, table_name, items, retries=WRITE_RETRIES,
+                backoff_s=WRITE_BACKOFF_S, sleep=time.sleep):
+    """
+    Put items with BatchWriteItem, BATCH_WRITE_SIZE at a time.
+    UnprocessedItems are retried with exponential backoff.
+
+    Returns: (indices of items that were not written, write stats)
+    """
+    stats = {"requests": 0, "retries": 0, "failed_requests": 0}
+    failed = []
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        # Unprocessed requests are matched back to items by their key
+        pending = {_item_key(items[i]): i
+                   for i in range(start, min(start + BATCH_WRITE_SIZE, len(items)))}
+        for attempt in range(retries + 1):
+            if attempt:
+                sleep(backoff_s * 2**(attempt - 1))
+                stats["retries"] += 1
+            stats["requests"] += 1
+            try:
+                response = ddb_client.batch_write_item(RequestItems={
+                    table_name: [{"PutRequest": {"Item": items[i]}}
+                                 for i in pending.values()]})
+            except Exception as e:
+                # Throttling that outlasted the client's own retries, or
+                # a rejected request.  Give up on this chunk.
+                print(f"batch_write_item failed: {e!r}")
+                stats["failed_requests"] += 1
+                break
+            unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+            pending = {key: pending[key] for key in
+                       (_item_key(request["PutRequest"]["Item"])
+                        for request in unprocessed)}
+            if not pending:
+                break
+        failed += pending.values()
+    return sorted(failed), stats
+
+
+
+class LocalDynamoClient:
+    """
+    In-memory stand-in for the boto3 client methods the handler uses.
+    Each batch_write_item call writes at most max_writes items per table
+    and returns the rest as UnprocessedItems, like a throttled table.
+    put_item / query hold the pose stream (query_key_names) for the
+    pose_index.query_pose_index Query, page_size items per page.
+    """
+
+    def __init__(self, key_names=("Area_id", "Epc"), max_writes=None,
+                 query_key_names=("Device_id", "Timestamp"), page_size=None):
+        self.key_names = key_names
+        self.max_writes = max_writes
+        self.query_key_names = query_key_names
+        self.page_size = page_size
+        self.tables = {}
+        self.calls = 0
+
+    def put_item(self, TableName, Item):
+        key = tuple(json.dumps(Item[name], sort_keys=True)
+                    for name in self.query_key_names)
+        self.tables.setdefault(TableName, {})[key] = Item
+        return {}
+
+    def query(self, TableName, ExpressionAttributeValues, ExclusiveStartKey=None,
+              **kwargs):
+        self.calls += 1
+        hash_name, range_name = self.query_key_names
+        values = ExpressionAttributeValues
+        (_, start), = values[":start"].items()
+        (_, end), = values[":end"].items()
+        items = sorted(
+            (item for item in self.tables.get(TableName, {}).values()
+             if item[hash_name] == values[":device_id"]
+             and float(start) <= float(deserialize(item[range_name])) <= float(end)),
+            key=lambda item: float(deserialize(item[range_name])))
+        if ExclusiveStartKey is not None:
+            last = float(deserialize(ExclusiveStartKey[range_name]))
+            items = [item for item in items
+                     if float(deserialize(item[range_name])) > last]
+        if self.page_size is None or len(items) <= self.page_size:
+            return {"Items": items}
+        page = items[:self.page_size]
+        return {"Items": page,
+                "LastEvaluatedKey": {name: page[-1][name]
+                                     for name in self.query_key_names}}
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            if len(requests) > BATCH_WRITE_SIZE:
+                raise ValueError("Too many items in BatchWriteItem")
+            n_writes = len(requests) if self.max_writes is None else self.max_writes
+            table = self.tables.setdefault(table_name, {})
+            for request in requests[:n_writes]:
+                item = request["PutRequest"]["Item"]
+                key = tuple(json.dumps(item[name], sort_keys=True)
+                            for name in self.key_names)
+                table[key] = item
+            if requests[n_writes:]:
+                unprocessed[table_name] = requests[n_writes:]
+        return {"UnprocessedItems": unprocessed}
+
+
+# --------------------------------- Handler -------------------------------- #
+
+def load_config():
+    """
+    Localization config (see localize_utils.target_localize_queue) from
+    the LOCALIZATION_CONFIG environment variable, a JSON object
+    """
+    return json.loads(os.environ["LOCALIZATION_CONFIG"])
+
+def get_area_cache():
+    """
+    The module level AreaCache, loading areas from AREA_CONFIG_TABLE if
+    set, otherwise giving every area load_config()
+    """
+    global areas
+    if areas is None:
+        if AREA_CONFIG_TABLE:
+            loader = area_cache.DynamoAreaLoader(get_client(), AREA_CONFIG_TABLE,
+                                                 load_config())
+        else:
+            loader = area_cache.static_loader(load_config())
+        areas = area_cache.AreaCache(loader)
+    return areas
+
+def get_result_cache():
+    """
+    The module level ResultCache, shared through RESULT_CACHE_TABLE if
+    set
+    """
+    global results
+    if results is None:
+        backend = None
+        if RESULT_CACHE_TABLE:
+            import boto3
+            backend = fusion_state.DynamoStateStore(
+                boto3.resource('dynamodb').Table(RESULT_CACHE_TABLE),
+                key_name="Result_key", attribute="Result")
+        results = result_cache.ResultCache(backend, ttl_s=RESULT_CACHE_TTL_S)
+    return results
+
+def get_state_store():
+    """Store of the per-tag state, LOCALIZATION_STATE_TABLE if set"""
+    if LOCALIZATION_STATE_TABLE:
+        import boto3
+        return fusion_state.DynamoStateStore(
+            boto3.resource('dynamodb').Table(LOCALIZATION_STATE_TABLE))
+    return fusion_state.MemoryStateStore()
+
+def get_tag_history():
+    """The module level TagHistory"""
+    global histories
+    if histories is None:
+        histories = tag_history.TagHistory(get_state_store())
+    return histories
+
+def get_checkpointer():
+    """The module level FusionCheckpointer"""
+    global checkpointer
+    if checkpointer is None:
+        checkpointer = fusion_state.FusionCheckpointer(get_state_store())
+    return checkpointer
+
+def process_records(records, ddb_client, config, table_name=LOCALIZED_TAGS_TABLE,
+                    results=None, tracks=None, histories=None, checkpoints=None):
+    """
+    Localize each tag in a batch of IntermediateLocationsQueue stream
+    records once and write the results to LocalizedTags.
+
+    config is one config for all areas, or an area_cache.AreaCache giving
+    the config of each area.  histories is a tag_history.TagHistory: the
+    records of a tag are added to its history and the tag is localized
+    from the whole history (config["history_size"] records, default
+    tag_history.MAX_HISTORY_RECORDS), so tags with few records per batch
+    are still localized.  Without it a tag is localized from the records
+    of this batch only.  In areas with config["incremental"] the records
+    are instead applied to the tag's fusion state in checkpoints, a
+    fusion_state.FusionCheckpointer (see localize_incremental()).
+
+    results is an optional result_cache.ResultCache, so that retried
+    records are not localized again.  tracks is an optional
+    tracking.Tracker updated with every location, in areas with
+    config["tracking"] its track is the prior of the tag's next
+    localization.
+
+    A record fails if its pose could not be read, if localizing its tag
+    raised, or if the tag's item could not be written.  A tag without a
+    location is not written and not a failure, nor is a record without a
+    pose (see join_poses()) or a malformed record (see group_records()).
+
+    Returns: (sequence numbers of failed records, stats)
+    """
+    start = time.perf_counter()
+    groups, malformed = group_records(records)
+    failures = []
+    pose_failures, stale_poses = join_poses(groups, ddb_client)
+    failures += pose_failures
+
+    items = []
+    item_groups = []
+    group_latency_s = []
+    no_location = 0
+    for (area_id, epc), group in groups.items():
+        group_start = time.perf_counter()
+        parsed = [entry[1] for entry in group]
+        try:
+            if isinstance(config, area_cache.AreaCache):
+                area_config = config.get(area_id).config
+            else:
+                area_config = config
+            if area_config.get("incremental"):
+                if checkpoints is None:
+                    raise ValueError('config["incremental"] needs checkpoints')
+                with metrics.span("localize_group"):
+                    location = localize_incremental(area_id, epc, parsed,
+                                                    area_config, checkpoints)
+            else:
+                if histories is not None:
+                    parsed = histories.extend(
+                        area_id, epc, parsed, area_config.get(
+                            "history_size", tag_history.MAX_HISTORY_RECORDS))
+                prior = None
+                if tracks is not None and area_config.get("tracking"):
+                    prior = tracks.prior((area_id, epc), parsed[-1]["timestamp"])
+                with metrics.span("localize_group"):
+                    location = localize_group(parsed, area_config, results,
+                                              prior)
+            if location is None:
+                no_location += 1
+            else:
+                if tracks is not None:
+                    tracks.update((area_id, epc), location,
+                                  parsed[-1]["timestamp"])
+                items.append(localized_tag_item(area_id, epc, location,
+                                                parsed, area_config))
+                item_groups.append(group)
+        except Exception as e:
+            print(f"Localizing {area_id} {epc} failed: {e!r}")
+            failures += [entry[0] for entry in group]
+        group_latency_s.append(time.perf_counter() - group_start)
+
+    with metrics.span("batch_write"):
+        failed_items, write_stats = batch_write(ddb_client, table_name, items)
+    for i in failed_items:
+        failures += [entry[0] for entry in item_groups[i]]
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "records": len(records),
+        "groups": len(groups),
+        "written": len(items) - len(failed_items),
+        "no_location": no_location,
+        "stale_poses": stale_poses,
+        "malformed": len(malformed),
+        "failed_records": len(failures),
+        "elapsed_s": elapsed,
+        "records_per_s": len(records) / elapsed if elapsed > 0 else 0.0,
+        "group_latency_s": {
+            "mean": float(np.mean(group_latency_s)) if group_latency_s else 0.0,
+            "max": max(group_latency_s, default=0.0),
+        },
+        "writes": write_stats,
+    }
+    if isinstance(config, area_cache.AreaCache):
+        stats["area_cache"] = dict(config.stats, areas=len(config))
+    if results is not None:
+        stats["result_cache"] = dict(results.stats, entries=len(results),
+                                     hit_rate=results.hit_rate())
+    if tracks is not None:
+        stats["tracking"] = dict(tracks.stats, tags=len(tracks))
+    if histories is not None:
+        stats["history"] = dict(histories.stats)
+    if checkpoints is not None:
+        stats["checkpoints"] = dict(checkpoints.stats)
+    return failures, stats
+
+def handle_request(event, context, ddb_client=None, config=None, results=None,
+                   tracks=None, histories=None, checkpoints=None):
+    """
+    Lambda entry point for the IntermediateLocationsQueue stream.
+
+    Failed records are reported as batchItemFailures (the function uses
+    ReportBatchItemFailures), so Lambda retries from the first failed
+    record instead of the whole batch.  ddb_client defaults to
+    get_client(), config to the per-area configs of get_area_cache(),
+    results to get_result_cache(), tracks to the module's tracker,
+    histories to get_tag_history() and checkpoints to get_checkpointer().
+    """
+    if ddb_client is None:
+        ddb_client = get_client()
+    if config is None:
+        config = get_area_cache()
+    if results is None:
+        results = get_result_cache()
+    if tracks is None:
+        tracks = tracker
+    if histories is None:
+        histories = get_tag_history()
+    if checkpoints is None:
+        checkpoints = get_checkpointer()
+
+    failures, stats = process_records(event["Records"], ddb_client, config,
+                                      results=results, tracks=tracks,
+                                      histories=histories,
+                                      checkpoints=checkpoints)
+    print(json.dumps(stats))
+    metrics.count("handler.records", stats["records"])
+    metrics.count("handler.failed_records", stats["failed_records"])
+    # Metrics of this invocation as CloudWatch EMF log lines, if enabled
+    metrics.flush()
+
+    return {"batchItemFailures": [{"itemIdentifier": sequence_number}
+                                  for sequence_number in failures]}
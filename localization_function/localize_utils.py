@@ -11,54 +11,684 @@
 ########################################################################
 
 import sys
+import os
+import atexit
 import pathlib
 import pickle
 import json
+import itertools
+import multiprocessing
+import multiprocessing.connection
 
 import numpy as np
-import scipy.constants
-import scipy.spatial.transform
 
-from backtrack.localization import multi_fusion as mf
+import multi_fusion as mf
+import measurement_codec
+import fusion_state
+import metrics
 
+# Speed of light (scipy.constants.c), written out so that importing this
+# module does not load scipy
+SPEED_OF_LIGHT = 299792458.0
+# The 14 frequency hops of the measurements and their wavelengths
+FREQUENCIES = 770e6 + 27e6 * np.arange(14)
+WAVELENGTHS = SPEED_OF_LIGHT / FREQUENCIES
+
+# Number of candidate locations scored at once by the AoA tiebreaker.
+# Bounds the (chunk, n_tags, n_freqs) complex array held in memory.
+TIEBREAKER_CHUNK_SIZE = 256
+
+# Worker pool for parallel shuffles, kept warm across invocations.  See
+# get_shuffle_pool()
+_shuffle_pool = None
+
+# Default size of the intersection cache shared by the shuffles of one
+# queue, config["intersection_cache_size"] = 0 disables it
+INTERSECTION_CACHE_SIZE = 4096
+
+# Adaptive shuffles (config["adaptive_shuffle"]) stop once the best
+# location moved less than this many meters in a round, but not before
+# SHUFFLE_MIN shuffles.  config["shuffle"] stays the hard cap.
+SHUFFLE_TOLERANCE = 0.05
+SHUFFLE_MIN = 2
+
+# Localization engines, see engine()
+ENGINES = ("multi_fusion", "grid", "auto")
+
+# grid_localize() defaults: coarse voxel size in meters, peaks refined,
+# refinement levels and step reduction per level
+GRID_RESOLUTION = 0.1
+GRID_PEAKS = 3
+GRID_LEVELS = 3
+GRID_REFINE = 4
+
+# Array precisions, see precision()
+PRECISIONS = tuple(mf.PRECISIONS)
+
+# Tracking mode (target_localize_queue with a prior) defaults: the search
+# box reaches TRACKING_SIGMAS prior uncertainties, and at least
+# TRACKING_MIN_RADIUS meters, around the prior location.  A result whose
+# median bistatic residual is above TRACKING_RESIDUAL meters means the
+# tag moved.
+TRACKING_SIGMAS = 3.0
+TRACKING_MIN_RADIUS = 0.1
+TRACKING_RESIDUAL = 0.05
+
+# target_localize_queue config that target_localize_batch does not
+# implement, rejected instead of ignored
+BATCH_UNSUPPORTED_KEYS = ("adaptive_shuffle", "tracking", "tracking_sigmas",
+                          "tracking_min_radius", "tracking_residual")
+
+# (call id, IntersectionCache) of this process, see _run_shuffle_task()
+_task_cache = (None, None)
+_call_ids = itertools.count()
+
+def rotate_by_quaternions(quats, vector):
+    """
+    Rotate vector by each quaternion, the same as
+    scipy.spatial.transform.Rotation.from_quat(quats).apply(vector)
+    without importing scipy.
+
+    quats: (4, ) or (n, 4) [qx,qy,qz,qw], normalized here
+    vector: (3, ) or (n, 3)
+
+    Returns: (n, 3)
+    """
+    quats = np.asarray(quats, dtype=float).reshape(-1, 4)
+    quats = quats / np.linalg.norm(quats, axis=1, keepdims=True)
+    xyz, w = quats[:, :3], quats[:, 3:]
+    vector = np.broadcast_to(np.asarray(vector, dtype=float), xyz.shape)
+    # v + 2w (q x v) + 2 q x (q x v)
+    uv = np.cross(xyz, vector)
+    return vector + 2 * (w * uv + np.cross(xyz, uv))
+
+# Measurement arrays of a queue decoded together, see preprocess_queue()
+BATCH_DECODED_KEYS = ("distance_candidates", "channel_estimate")
+
+@metrics.timed("preprocess")
 def preprocess_queue(data_queue):
     """
     Process each measurement in the queue
+
+    When every measurement has a BATCH_DECODED_KEYS array in the binary
+    measurement_codec format, all of them are decoded with one
+    measurement_codec.decode_batch() into a contiguous array, and each
+    measurement gets its row.  Arrays of different shapes or formats are
+    decoded one at a time by preprocess_data().
     """
-    return [preprocess_data(data) for data in data_queue]
+    batches = {}
+    for key in BATCH_DECODED_KEYS:
+        bufs = [data.get(key) for data in data_queue]
+        if not bufs or not all(measurement_codec.is_encoded(buf) for buf in bufs):
+            continue
+        try:
+            batches[key] = measurement_codec.decode_batch(bufs)
+        except ValueError:
+            # Mixed shapes, or a corrupt buffer that preprocess_data()
+            # reports on its own
+            continue
+    return [preprocess_data(dict(data, **{key: batch[i]
+                                          for key, batch in batches.items()}))
+            for i, data in enumerate(data_queue)]
 
 def preprocess_data(data):
     """
     Convert stored SQL data into arrays
+
+    distance_candidates and channel_estimate may be in the binary
+    measurement_codec format (decoded without a copy) or in the legacy
+    JSON / pickle format.  Arrays that are already decoded (e.g. parsed
+    from a stream record) are kept as they are.
     """
     out_data = {}
     for key, val in data.items():
-        if key == "distance_candidates":
+        if isinstance(val, np.ndarray):
+            fmt_val = val
+        elif key in ("distance_candidates", "channel_estimate") \
+                and measurement_codec.is_encoded(val):
+            fmt_val = measurement_codec.decode_array(val)
+        elif key == "distance_candidates":
             fmt_val= np.array(json.loads(val))
         elif key == "channel_estimate":
+            # Legacy path, only for trusted data written before the
+            # binary format
             fmt_val = pickle.loads(val)
         else:
             fmt_val = val
         out_data[key] = fmt_val
     return out_data
 
-def localize(clusters, tx_poses, rx_poses, bound_min, bound_max):
+def encode_data(data):
+    """
+    Inverse of preprocess_data for the binary format: encode
+    distance_candidates as float32 and channel_estimate as complex64.
+    """
+    out_data = dict(data)
+    if "distance_candidates" in data:
+        out_data["distance_candidates"] = measurement_codec.encode_array(
+            data["distance_candidates"], np.float32)
+    if "channel_estimate" in data:
+        out_data["channel_estimate"] = measurement_codec.encode_array(
+            data["channel_estimate"], np.complex64)
+    return out_data
+
+def prune_options_from_config(config):
+    """
+    MultiFusion pruning options from config["beam_width"],
+    config["dedup"], config["max_candidates"] and config["time_budget_s"],
+    all off by default (see MultiFusion.prune), the precision of its
+    candidates (see precision()), config["solver"], "scipy" (default) or
+    "batch" for batch_least_squares() (see MultiFusion.solveIntersections),
+    config["warm_start"], least squares seeded from the previous
+    intersection, off by default (the intersection cache is then not
+    used), and config["precheck"], the bounding box prechecks of the clusters,
+    off by default (see MultiFusion.earlyRejection)
+    """
+    beam_width = config.get("beam_width")
+    if isinstance(beam_width, dict):
+        # Per-k widths, keys are strings in JSON
+        beam_width = {int(k): width for k, width in beam_width.items()}
+    return {
+        "beam_width": beam_width,
+        "dedup": config.get("dedup", False),
+        "max_candidates": config.get("max_candidates"),
+        "time_budget": config.get("time_budget_s"),
+        "precision": precision(config),
+        "solver": config.get("solver", "scipy"),
+        "warm_start": config.get("warm_start", False),
+        "precheck": config.get("precheck", False),
+    }
+
+@metrics.timed("localize")
+def localize(clusters, tx_poses, rx_poses, bound_min, bound_max,
+             meas_ids=None, prune_options=None, cache=None):
     """
     Localize a set of clusters and poses.  The poses are the TX antenna
     location, and tx_rx_offset should represent the offset from TX ant
     to the RX ant in the TX ant frame.
 
     TX ant frame is x right, z back, y up, the same as the T265 camera
+
+    meas_ids are the original queue indices of the (shuffled)
+    measurements, used to key the optional mf.IntersectionCache.
+    prune_options are passed on to mf.MultiFusion, see
+    prune_options_from_config()
     """
 
-    multi_fusion = mf.MultiFusion(bound_min=bound_min, bound_max=bound_max)
-    for (cluster, tx_pose, rx_pose) in zip(clusters, tx_poses, rx_poses):
-        multi_fusion.process_new_measurement(cluster, rx_pose[:3], tx_pose[:3])
+    # The closed-form jacobian gives the same accept / reject outcome as
+    # finite differences with far fewer residual evaluations, see
+    # benchmarks/least_squares_benchmark.py
+    multi_fusion = mf.MultiFusion(bound_min=bound_min, bound_max=bound_max,
+                                  analytic_jac=True, cache=cache,
+                                  **(prune_options or {}))
+    if meas_ids is None:
+        meas_ids = range(len(clusters))
+    for (cluster, tx_pose, rx_pose, meas_id) in zip(
+            clusters, tx_poses, rx_poses, meas_ids):
+        multi_fusion.process_new_measurement(
+            cluster, rx_pose[:3], tx_pose[:3], meas_id)
     locations = multi_fusion.get_all_locations()
     # print(f"Returning all locations: {len(locations)}")
 
     return locations
 
+def _restore_fusion(checkpointer, area_id, epc, min_bounds, max_bounds):
+    """
+    Saved MultiFusion and meta of (area_id, epc), (None, {}) if there is
+    none or it was made for other bounds
+    """
+    fusion, meta = checkpointer.load(area_id, epc)
+    if fusion is not None and not (np.allclose(fusion.bound_min, min_bounds)
+                                   and np.allclose(fusion.bound_max, max_bounds)):
+        # Area bounds changed, the saved candidates are no longer valid
+        fusion = None
+    if fusion is None:
+        return None, {}
+    return fusion, meta
+
+def _applied(meta, timestamp):
+    """
+    True if the saved state with meta already holds the record at
+    timestamp, i.e. the record was redelivered
+    """
+    return (timestamp is not None and meta.get("timestamp") is not None
+            and float(timestamp) <= meta["timestamp"])
+
+def _incremental_meta(fusion, timestamp):
+    return {"records": fusion.num_of_rx,
+            "timestamp": None if timestamp is None else float(timestamp)}
+
+@metrics.timed("localize_incremental")
+def localize_incremental(checkpointer, area_id, epc, data, tx_pose, config,
+                         timestamp=None):
+    """
+    Apply one new IntermediateLocationsQueue record to the saved
+    MultiFusion state of (area_id, epc) instead of re-running the whole
+    queue, then save the state back.
+
+    The state is a single MultiFusion run over the records in arrival
+    order, the same as localize() on them.  target_localize_queue runs
+    config["shuffle"] permutations of the queue and tiebreaks over the
+    candidates of all of them, so its location can differ.
+
+    checkpointer: fusion_state.FusionCheckpointer
+    data: one queue record, same format as in target_localize_queue
+    tx_pose: [x,y,z,qx,qy,qz,qw] TX antenna pose of the record
+    timestamp: (optional) timestamp of the record, saved with the state.
+        A record at or before the last applied timestamp is a redelivery
+        (stream retries) and is not applied again.
+
+    Returns: (MultiFusion.get_all_locations(), saved), saved is False if
+    the state was too large to store, then the next record starts over
+    and the caller should localize from the full queue.
+    """
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    fusion, meta = _restore_fusion(checkpointer, area_id, epc, min_bounds, max_bounds)
+    if fusion is not None and _applied(meta, timestamp):
+        metrics.count("incremental.duplicates")
+        return fusion.get_all_locations(), True
+    if fusion is None:
+        fusion = mf.MultiFusion(bound_min=min_bounds, bound_max=max_bounds,
+                                analytic_jac=True,
+                                **prune_options_from_config(config))
+
+    processed = preprocess_data(data)
+    tx_pose = np.asarray(tx_pose, dtype=float)
+    rx_loc = rotate_by_quaternions(
+        tx_pose[3:], np.asarray(config["tx_rx_offset"], dtype=float))[0] + tx_pose[:3]
+    fusion.process_new_measurement(processed["distance_candidates"][0],
+                                   rx_loc,
+                                   tx_pose[:3],
+                                   fusion.num_of_rx)
+    saved = checkpointer.save(area_id, epc, fusion,
+                              meta=_incremental_meta(fusion, timestamp))
+    return fusion.get_all_locations(), saved
+
+@metrics.timed("target_localize_incremental")
+def target_localize_incremental(checkpointer, area_id, epc, data, tx_pose,
+                                config, accumulators=None, timestamp=None):
+    """
+    localize_incremental() followed by the AoA tiebreaker: the location
+    of the tag after one new record, the aoa_tiebreaker() of the
+    localize() candidates of the records so far in arrival order (see
+    localize_incremental() for how that differs from
+    target_localize_queue).  A redelivered record (timestamp at or before
+    the last applied one) is not applied again.
+
+    The tiebreaker is a TiebreakerAccumulator saved with the fusion state,
+    so only the new measurement and the candidates new to MultiFusion are
+    scored.  accumulators is an optional dict the caller keeps across
+    warm invocations, {(area_id, epc): TiebreakerAccumulator}, which saves
+    restoring the accumulator from the checkpoint.  A saved fusion state
+    without an accumulator (from localize_incremental) is started over.
+
+    Returns: (best_loc or None, saved), see localize_incremental
+    """
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    key = (area_id, epc)
+    fusion, meta = _restore_fusion(checkpointer, area_id, epc, min_bounds, max_bounds)
+    accumulator = None
+    if fusion is not None:
+        accumulator = (accumulators or {}).get(key)
+        if accumulator is None or accumulator.num_measurements != fusion.num_of_rx:
+            accumulator = TiebreakerAccumulator.from_arrays(meta.get("arrays", {}))
+        if accumulator is None or accumulator.num_measurements != fusion.num_of_rx:
+            fusion = None
+    if fusion is not None and _applied(meta, timestamp):
+        metrics.count("incremental.duplicates")
+        best_loc, _ = accumulator.best()
+        return best_loc, True
+
+    processed = preprocess_data(data)
+    tx_pose = np.asarray(tx_pose, dtype=float)
+    rx_loc = rotate_by_quaternions(
+        tx_pose[3:], np.asarray(config["tx_rx_offset"], dtype=float))[0] + tx_pose[:3]
+    _, complex_dtype = mf.PRECISIONS[precision(config)]
+    arr_channel = antenna_array_channels(
+        np.asarray(processed["channel_estimate"], dtype=complex_dtype)[0],
+        config["cal_dist"], WAVELENGTHS)
+    if fusion is None:
+        fusion = mf.MultiFusion(bound_min=min_bounds, bound_max=max_bounds,
+                                analytic_jac=True,
+                                **prune_options_from_config(config))
+        accumulator = TiebreakerAccumulator(precision=precision(config))
+
+    fusion.process_new_measurement(processed["distance_candidates"][0],
+                                   rx_loc,
+                                   tx_pose[:3],
+                                   fusion.num_of_rx)
+    accumulator.add_measurements(tx_pose[:3], rx_loc, arr_channel)
+    accumulator.set_candidates(
+        [loc["location"] for loc in fusion.get_all_locations()])
+    best_loc, _ = accumulator.best()
+
+    saved = checkpointer.save(area_id, epc, fusion,
+                              meta=_incremental_meta(fusion, timestamp),
+                              extra=accumulator.to_arrays())
+    if accumulators is not None:
+        if saved:
+            accumulators[key] = accumulator
+        else:
+            accumulators.pop(key, None)
+    return best_loc, saved
+
+def _run_shuffle_task(args, cache_spec):
+    """
+    localize(*args) with this process's intersection cache.
+
+    cache_spec is None (no cache) or (call id, cache size).  Every task
+    of one localize_shuffles() call carries the same call id, so the
+    shuffles that run in the same process share a cache and a new call
+    starts a fresh one.
+
+    Returns: (localize output, cache stats accumulated by this task)
+    """
+    global _task_cache
+    if cache_spec is None:
+        return localize(*args), {}
+    call_id, cache_size = cache_spec
+    if _task_cache[0] != call_id:
+        _task_cache = (call_id, mf.IntersectionCache(cache_size))
+    cache = _task_cache[1]
+    before = dict(cache.stats)
+    result = localize(*args, cache=cache)
+    return result, {key: val - before[key] for key, val in cache.stats.items()}
+
+def _shuffle_worker(conn):
+    """
+    Worker process loop: receive (map id, index, ((args, cache_spec),
+    collect_metrics)), send back (map id, index, ok, (result, metrics
+    snapshot or None)).  None stops the worker.
+    """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        map_id, index, ((args, cache_spec), collect_metrics) = task
+        try:
+            if collect_metrics:
+                metrics.enable()
+                metrics.reset()
+            else:
+                metrics.disable()
+            result = _run_shuffle_task(args, cache_spec)
+            conn.send((map_id, index, True, (
+                result, metrics.snapshot() if collect_metrics else None)))
+        except Exception as e:
+            conn.send((map_id, index, False, repr(e)))
+    conn.close()
+
+class ShufflePool:
+    """
+    Persistent worker processes that run localize() on shuffles.
+
+    Lambda has no /dev/shm, so multiprocessing.Pool and
+    concurrent.futures (which need semaphores) fail there.  Workers are
+    plain Processes, each fed one task at a time over its own Pipe.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._conns = []
+        self._procs = []
+        self._map_ids = itertools.count()
+        for _ in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_shuffle_worker, args=(child_conn,), daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+    def is_alive(self):
+        return bool(self._procs) and all(proc.is_alive() for proc in self._procs)
+
+    def map(self, tasks):
+        """
+        Run _run_shuffle_task(args, cache_spec) for every
+        ((args, cache_spec), collect_metrics) task, results in task order
+        regardless of which worker ran them.  With collect_metrics the
+        worker also returns its metrics.snapshot() for the task.
+
+        Tasks and replies carry the id of their map() call, a reply of
+        another call is never taken as a result.  After a task fails no
+        new task is sent, and the replies of the running ones are
+        received before raising RuntimeError, so no reply is left in a
+        pipe for the next call.  If the workers cannot be reached (or
+        map() is interrupted) the pool is terminated, get_shuffle_pool()
+        then starts a new one.
+        """
+        map_id = next(self._map_ids)
+        results = [None] * len(tasks)
+        pending = iter(enumerate(tasks))
+        busy = {}
+        error = None
+        try:
+            for conn in self._conns:
+                task = next(pending, None)
+                if task is None:
+                    break
+                conn.send((map_id,) + task)
+                busy[conn] = task[0]
+
+            while busy:
+                for conn in multiprocessing.connection.wait(list(busy)):
+                    reply_id, index, ok, result = conn.recv()
+                    if reply_id != map_id:
+                        continue
+                    del busy[conn]
+                    if not ok:
+                        if error is None:
+                            error = f"localize failed on shuffle {index}: {result}"
+                        continue
+                    results[index] = result
+                    task = next(pending, None) if error is None else None
+                    if task is not None:
+                        conn.send((map_id,) + task)
+                        busy[conn] = task[0]
+        except BaseException:
+            self.terminate()
+            raise
+        if error is not None:
+            raise RuntimeError(error)
+        return results
+
+    def terminate(self):
+        """Stop the workers without waiting for their tasks"""
+        for proc in self._procs:
+            proc.terminate()
+        for conn in self._conns:
+            conn.close()
+        for proc in self._procs:
+            proc.join(timeout=1)
+        self._conns = []
+        self._procs = []
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, BrokenPipeError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        self._conns = []
+        self._procs = []
+
+def get_shuffle_pool(workers):
+    """
+    Return the module level ShufflePool, (re)starting it if the worker
+    count changed or a worker died.  It survives warm Lambda invocations.
+    """
+    global _shuffle_pool
+    if (_shuffle_pool is None or _shuffle_pool.workers != workers
+            or not _shuffle_pool.is_alive()):
+        if _shuffle_pool is not None:
+            _shuffle_pool.close()
+        _shuffle_pool = ShufflePool(workers)
+    return _shuffle_pool
+
+@atexit.register
+def _close_shuffle_pool():
+    global _shuffle_pool
+    if _shuffle_pool is not None:
+        _shuffle_pool.close()
+        _shuffle_pool = None
+
+def shuffle_permutations(n_tags, config):
+    """
+    Measurement orders for each shuffle.  With config["seed"] set the
+    permutations come from their own generator so the output is
+    reproducible, otherwise the global numpy random state is used.
+    """
+    n_shuffle = config["shuffle"]
+    seed = config.get("seed")
+    if seed is None:
+        return [np.random.permutation(n_tags) for _ in range(n_shuffle)]
+    rng = np.random.default_rng(seed)
+    return [rng.permutation(n_tags) for _ in range(n_shuffle)]
+
+def shuffle_workers(config, n_shuffle):
+    """
+    Number of processes to run shuffles on.  config["shuffle_workers"]
+    defaults to 1 (serial), None means one per available core.
+    """
+    workers = config.get("shuffle_workers", 1)
+    n_cores = os.cpu_count() or 1
+    if workers is None:
+        workers = n_cores
+    return max(1, min(workers, n_cores, n_shuffle))
+
+@metrics.timed("shuffles")
+def localize_shuffles(clusters, tx_poses, rx_poses, bound_min, bound_max,
+                      permutations, workers=1,
+                      cache_size=INTERSECTION_CACHE_SIZE, cache_stats=None,
+                      prune_options=None):
+    """
+    Run localize() once per permutation of the measurements, serially
+    or on the warm ShufflePool, with the given MultiFusion prune_options.
+    Shuffles running in the same process share an mf.IntersectionCache
+    of cache_size entries (0 disables it), whose hit / miss / eviction
+    counts are added to cache_stats if given.
+
+    Returns: list of localize() outputs, in permutation order
+    """
+    tasks = shuffle_tasks(clusters, tx_poses, rx_poses, bound_min, bound_max,
+                          permutations, cache_size, prune_options)
+    return run_shuffle_tasks(tasks, workers, cache_stats)
+
+def shuffle_tasks(clusters, tx_poses, rx_poses, bound_min, bound_max,
+                  permutations, cache_size=INTERSECTION_CACHE_SIZE,
+                  prune_options=None):
+    """
+    (args, cache_spec) tasks of localize_shuffles(), one per permutation.
+    The tasks of one call share an intersection cache.
+    """
+    cache_spec = (next(_call_ids), cache_size) if cache_size else None
+    return [((clusters[shuffler],
+              tx_poses[shuffler],
+              rx_poses[shuffler],
+              bound_min,
+              bound_max,
+              shuffler,
+              prune_options), cache_spec) for shuffler in permutations]
+
+def run_shuffle_tasks(tasks, workers=1, cache_stats=None):
+    """
+    Run shuffle_tasks() output serially or on the warm ShufflePool, tasks
+    of several calls may be mixed.
+
+    Returns: list of localize() outputs, in task order
+    """
+    if workers <= 1:
+        outputs = [_run_shuffle_task(*task) for task in tasks]
+    else:
+        outputs = []
+        for output, worker_metrics in get_shuffle_pool(workers).map(
+                [(task, metrics.enabled) for task in tasks]):
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            outputs.append(output)
+
+    if cache_stats is not None:
+        for _, task_stats in outputs:
+            for key, val in task_stats.items():
+                cache_stats[key] = cache_stats.get(key, 0) + val
+    return [result for result, _ in outputs]
+
+def cost_ordered_permutation(clusters):
+    """
+    Measurement order by best (lowest) cluster cost, so the measurements
+    whose distance is most certain seed the intersections
+    """
+    best_costs = np.array([np.min(np.asarray(cluster)[:, 1])
+                           for cluster in clusters])
+    return np.argsort(best_costs, kind="stable")
+
+@metrics.timed("shuffles")
+def adaptive_localize_shuffles(clusters, tx_poses, rx_poses, bound_min,
+                               bound_max, arr_channels, config,
+                               prune_options=None):
+    """
+    Shuffles until the tiebreaker winner stops moving.
+
+    The first shuffle processes the measurements in cost_ordered_permutation()
+    order, the others in shuffle_permutations() order.  Shuffles run in
+    rounds of shuffle_workers() at a time.  After each round the AoA
+    tiebreaker scores the new candidates, and once the best location so far
+    moved less than config["shuffle_tolerance"] (SHUFFLE_TOLERANCE) in a
+    round, after at least config["shuffle_min"] (SHUFFLE_MIN) shuffles, the
+    rest are skipped.  config["shuffle"] is the most shuffles run.
+
+    The powers of a candidate do not depend on the other candidates, so the
+    result is the aoa_tiebreaker() of all candidates of the shuffles run.
+
+    Returns: (best_loc or None, number of shuffles run)
+    """
+    n_shuffle = config["shuffle"]
+    tolerance = config.get("shuffle_tolerance", SHUFFLE_TOLERANCE)
+    min_shuffles = config.get("shuffle_min", SHUFFLE_MIN)
+    workers = shuffle_workers(config, n_shuffle)
+    if n_shuffle < 1:
+        return None, 0
+
+    permutations = ([cost_ordered_permutation(clusters)]
+                    + shuffle_permutations(len(clusters), config)[:n_shuffle - 1])
+    tasks = shuffle_tasks(clusters, tx_poses, rx_poses, bound_min, bound_max,
+                          permutations,
+                          config.get("intersection_cache_size",
+                                     INTERSECTION_CACHE_SIZE),
+                          prune_options)
+
+    best_loc, best_power = None, -np.inf
+    n_run = 0
+    for start in range(0, len(tasks), workers):
+        prev_loc = best_loc
+        for loc_guesses in run_shuffle_tasks(tasks[start:start + workers],
+                                             workers):
+            if not loc_guesses:
+                continue
+            locs = np.array([guess["location"] for guess in loc_guesses])
+            loc, powers = aoa_tiebreaker(locs, tx_poses, rx_poses,
+                                         arr_channels, WAVELENGTHS)
+            if powers.max() > best_power:
+                best_loc, best_power = loc, powers.max()
+        n_run = min(start + workers, len(tasks))
+        if (n_run >= min_shuffles and prev_loc is not None
+                and np.linalg.norm(best_loc - prev_loc) <= tolerance):
+            break
+
+    metrics.gauge("shuffle.count", n_run)
+    if n_run < len(tasks):
+        metrics.count("shuffle.early_stops")
+    return best_loc, n_run
+
 def antenna_array_channels(calibrated_channels, cal_dist, wavelengths):
     """
     Convert calibrated channel estimates to antenna array channels
@@ -70,47 +700,390 @@ def antenna_array_channels(calibrated_channels, cal_dist, wavelengths):
     cal_phases = cal_dist * 2 * np.pi / wavelengths
     # Note that cal_phases is (n_hops, ) and
     # calibrated_channels = (n_tags, 1, n_hops).  Multiplying this way
-    # properly applies the phase across the hops on the channels
-    return calibrated_channels * np.exp(-1j*cal_phases)
+    # properly applies the phase across the hops on the channels.  The
+    # result keeps the complex precision of the channels.
+    calibrated_channels = np.asarray(calibrated_channels)
+    dtype = np.result_type(calibrated_channels.dtype, np.complex64)
+    return calibrated_channels * np.exp(-1j*cal_phases).astype(dtype)
+
+def _phasor_chunks(locs, tx_locs, rx_locs, wavelengths, chunk_size,
+                   dtype=np.float64):
+    """
+    Yields (rows, phasors) for chunk_size candidates at a time, phasors
+    is the (chunk, n_tags, n_freqs) array of exp(1j * k * d) for the
+    bistatic distance d of every candidate and (tx, rx) pair.  Distances
+    are computed in the float dtype, phasors are the matching complex.
+    """
+    locs = np.asarray(locs, dtype=dtype).reshape(-1, 3)
+    tx_locs = np.asarray(tx_locs, dtype=dtype)[:, :3]
+    rx_locs = np.asarray(rx_locs, dtype=dtype)[:, :3]
+    wavenumbers = (2 * np.pi / np.asarray(wavelengths)).astype(dtype)
+
+    chunk_size = max(int(chunk_size), 1)
+    for start in range(0, locs.shape[0], chunk_size):
+        chunk = locs[start:start + chunk_size]
+        # (chunk, n_tags) bistatic distances
+        dists = (np.linalg.norm(chunk[:, None, :] - tx_locs[None], axis=-1)
+                 + np.linalg.norm(chunk[:, None, :] - rx_locs[None], axis=-1))
+        phases = dists[:, :, None] * wavenumbers
+        # exp(1j * phases) as cos + 1j * sin, the same values, but numpy
+        # vectorizes the real float32 functions and not the complex exp
+        phasors = np.empty(phases.shape, dtype=np.result_type(dtype, np.complex64))
+        np.cos(phases, out=phasors.real)
+        np.sin(phases, out=phasors.imag)
+        yield slice(start, start + chunk_size), phasors
+
+def aoa_phasor_sums(locs, tx_locs, rx_locs, arr_channels, wavelengths,
+                    chunk_size=TIEBREAKER_CHUNK_SIZE):
+    """
+    Complex sum over tags and frequencies of the phase-rotated channels
+    for every candidate location, the coherent AoA power is its
+    magnitude.  The sum over tags is additive, see TiebreakerAccumulator.
+    Computed in the precision of arr_channels (complex64 or complex128).
+
+    Returns: (n_locs, ) complex array
+    """
+    arr_channels = np.asarray(arr_channels)
+    sums = np.zeros(np.asarray(locs).reshape(-1, 3).shape[0],
+                    dtype=arr_channels.dtype)
+    for rows, phasors in _phasor_chunks(locs, tx_locs, rx_locs, wavelengths,
+                                        chunk_size, arr_channels.real.dtype):
+        sums[rows] = np.einsum("ctf,tf->c", phasors, arr_channels)
+    return sums
+
+def aoa_tiebreaker_powers(locs, tx_locs, rx_locs, arr_channels, wavelengths,
+                          chunk_size=TIEBREAKER_CHUNK_SIZE, coherent=True):
+    """
+    Coherent AoA power for every candidate location.
+
+    For each candidate the bistatic distance to every (tx, rx) pair is
+    computed as a (candidates x tags) matrix, then the channels are
+    phase-rotated by that distance and summed over tags and frequencies.
+    Candidates are processed chunk_size at a time so the intermediate
+    (chunk, n_tags, n_freqs) phasor array stays bounded.
+
+    With coherent=False the magnitudes of the per tag sums are added
+    instead.  That power varies with the distance on the scale of the
+    bandwidth rather than the wavelength, so it can be sampled coarsely.
+
+    The powers are computed in the precision of arr_channels.
+
+    locs: (n_locs, 3) candidate locations
+    tx_locs, rx_locs: (n_tags, 3) antenna locations per measurement
+    arr_channels: (n_tags, n_freqs) antenna array channels
+    wavelengths: (n_freqs, ) wavelengths of each hop
+
+    Returns: (n_locs, ) array of |sum of phasors| per candidate
+    """
+    if coherent:
+        return np.abs(aoa_phasor_sums(locs, tx_locs, rx_locs, arr_channels,
+                                      wavelengths, chunk_size))
+    arr_channels = np.asarray(arr_channels)
+    powers = np.zeros(np.asarray(locs).reshape(-1, 3).shape[0],
+                      dtype=arr_channels.real.dtype)
+    for rows, phasors in _phasor_chunks(locs, tx_locs, rx_locs, wavelengths,
+                                        chunk_size, arr_channels.real.dtype):
+        powers[rows] = np.abs(
+            np.einsum("ctf,tf->ct", phasors, arr_channels)).sum(axis=1)
+    return powers
+
+@metrics.timed("tiebreaker")
+def aoa_tiebreaker(locs, tx_locs, rx_locs, arr_channels, wavelengths,
+                   chunk_size=TIEBREAKER_CHUNK_SIZE):
+    """
+    Pick the candidate location with the highest coherent AoA power.
+
+    Returns: (best_loc, powers), best_loc is None if there are no
+    candidates
+    """
+    powers = aoa_tiebreaker_powers(locs, tx_locs, rx_locs, arr_channels,
+                                   wavelengths, chunk_size=chunk_size)
+    metrics.gauge("tiebreaker.candidates", powers.shape[0])
+    if powers.shape[0] == 0:
+        return None, powers
+    return np.asarray(locs)[np.argmax(powers)], powers
+
+class TiebreakerAccumulator:
+    """
+    Running aoa_phasor_sums() of a changing candidate set.
+
+    The phasor sum of a candidate is a sum over measurements, so a new
+    measurement only adds its own term to each kept candidate, and only
+    candidates that are new to the set are summed over the measurement
+    history.  Candidates are matched by their exact location, which
+    MultiFusion keeps for a candidate it carries over.  The cost of an
+    update is O(candidates) for a measurement plus O(history) per new
+    candidate, instead of O(candidates x history).
+
+    Keeps the measurement history (tx / rx locations, antenna array
+    channels) to score new candidates, see to_arrays() to store it.
+    Everything is stored in the dtypes of precision (see precision()).
+    """
+
+    def __init__(self, wavelengths=WAVELENGTHS,
+                 chunk_size=TIEBREAKER_CHUNK_SIZE, precision="float64"):
+        self.wavelengths = np.asarray(wavelengths)
+        self.chunk_size = chunk_size
+        self.dtype, self.complex_dtype = mf.PRECISIONS[precision]
+        self.tx_locs = np.empty((0, 3), dtype=self.dtype)
+        self.rx_locs = np.empty((0, 3), dtype=self.dtype)
+        self.arr_channels = np.empty((0, self.wavelengths.shape[0]),
+                                     dtype=self.complex_dtype)
+        self.locations = np.empty((0, 3), dtype=self.dtype)
+        self.sums = np.empty(0, dtype=self.complex_dtype)
+        self.stats = {'measurements': 0, 'reused': 0, 'backfilled': 0}
+
+    @property
+    def num_measurements(self):
+        return self.tx_locs.shape[0]
+
+    def add_measurements(self, tx_locs, rx_locs, arr_channels):
+        """Add (n, 3) tx / rx locations and (n, n_freqs) channels"""
+        tx_locs = np.asarray(tx_locs, dtype=self.dtype).reshape(-1, 3)
+        rx_locs = np.asarray(rx_locs, dtype=self.dtype).reshape(-1, 3)
+        arr_channels = np.asarray(arr_channels, dtype=self.complex_dtype).reshape(
+            -1, self.wavelengths.shape[0])
+        self.sums = self.sums + aoa_phasor_sums(
+            self.locations, tx_locs, rx_locs, arr_channels, self.wavelengths,
+            self.chunk_size)
+        self.tx_locs = np.concatenate([self.tx_locs, tx_locs])
+        self.rx_locs = np.concatenate([self.rx_locs, rx_locs])
+        self.arr_channels = np.concatenate([self.arr_channels, arr_channels])
+        self.stats['measurements'] += tx_locs.shape[0]
+
+    def set_candidates(self, locs):
+        """
+        Replace the candidate set with (n, 3) locs, keeping the sums of
+        the candidates already in it and summing the new ones over all
+        measurements
+        """
+        locs = np.asarray(locs, dtype=self.dtype).reshape(-1, 3)
+        rows = {loc.tobytes(): row for row, loc in enumerate(self.locations)}
+        old = np.array([rows.get(loc.tobytes(), -1) for loc in locs],
+                       dtype=np.int64)
+        new = old < 0
+        sums = np.empty(locs.shape[0], dtype=self.complex_dtype)
+        sums[~new] = self.sums[old[~new]]
+        sums[new] = aoa_phasor_sums(locs[new], self.tx_locs, self.rx_locs,
+                                    self.arr_channels, self.wavelengths,
+                                    self.chunk_size)
+        self.locations = locs
+        self.sums = sums
+        self.stats['reused'] += int(np.count_nonzero(~new))
+        self.stats['backfilled'] += int(np.count_nonzero(new))
+        metrics.count("tiebreaker.reused", int(np.count_nonzero(~new)))
+        metrics.count("tiebreaker.backfilled", int(np.count_nonzero(new)))
+
+    def best(self):
+        """
+        Same as aoa_tiebreaker() on the candidates and measurements.
+
+        Returns: (best_loc, powers), best_loc is None if there are no
+        candidates
+        """
+        powers = np.abs(self.sums)
+        if powers.shape[0] == 0:
+            return None, powers
+        return self.locations[np.argmax(powers)], powers
+
+    def to_arrays(self):
+        """Named arrays of the state, for fusion_state.dump_fusion()"""
+        return {
+            'tiebreaker_tx_locs': self.tx_locs,
+            'tiebreaker_rx_locs': self.rx_locs,
+            'tiebreaker_channels': self.arr_channels,
+            'tiebreaker_locations': self.locations,
+            'tiebreaker_sums': self.sums,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, wavelengths=WAVELENGTHS):
+        """Inverse of to_arrays(), None if arrays has no accumulator"""
+        if 'tiebreaker_sums' not in arrays:
+            return None
+        precision = ("float32" if arrays['tiebreaker_sums'].dtype == np.complex64
+                     else "float64")
+        out = cls(wavelengths, precision=precision)
+        out.tx_locs = arrays['tiebreaker_tx_locs']
+        out.rx_locs = arrays['tiebreaker_rx_locs']
+        out.arr_channels = arrays['tiebreaker_channels']
+        out.locations = arrays['tiebreaker_locations']
+        out.sums = arrays['tiebreaker_sums']
+        return out
+
+def grid_points(bound_min, bound_max, resolution):
+    """
+    (n, 3) voxel centers of a resolution grid over the box, the center of
+    an axis shorter than resolution / 2 if none, (0, 3) if the box is empty
+    """
+    axes = []
+    for low, high in zip(bound_min, bound_max):
+        axis = np.arange(low + resolution / 2, high, resolution)
+        if axis.size == 0 and high >= low:
+            axis = np.array([(low + high) / 2])
+        axes.append(axis)
+    return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+def grid_peaks(locs, powers, n_peaks, separation):
+    """
+    Up to n_peaks highest power locations at least separation apart,
+    highest first
+    """
+    peaks = []
+    for i in np.argsort(powers, kind="stable")[::-1]:
+        if all(np.linalg.norm(locs[i] - locs[j]) >= separation for j in peaks):
+            peaks.append(i)
+            if len(peaks) == n_peaks:
+                break
+    return locs[peaks], powers[peaks]
+
+@metrics.timed("grid_localize")
+def grid_localize(tx_locs, rx_locs, arr_channels, bound_min, bound_max,
+                  config):
+    """
+    Coarse to fine search of the AoA power over the bounds, the
+    localization engine for config["engine"] = "grid" (see engine()).
+
+    The non-coherent power is evaluated on a grid of
+    config["grid_resolution"] (GRID_RESOLUTION) meters, then the
+    config["grid_peaks"] (GRID_PEAKS) best separated voxels are refined
+    config["grid_levels"] (GRID_LEVELS) times with the coherent power:
+    each level samples +-2 steps of the previous level around every peak
+    at GRID_REFINE times finer steps.  The number of points evaluated
+    only depends on the bounds and these settings.
+
+    Returns: (best_loc, coherent power at best_loc), (None, None) if the
+        bounds are empty
+    """
+    bound_min = np.asarray(bound_min, dtype=float)
+    bound_max = np.asarray(bound_max, dtype=float)
+    step = config.get("grid_resolution", GRID_RESOLUTION)
+    n_peaks = config.get("grid_peaks", GRID_PEAKS)
+    n_levels = config.get("grid_levels", GRID_LEVELS)
+
+    locs = grid_points(bound_min, bound_max, step)
+    if locs.shape[0] == 0:
+        metrics.count("grid.empty")
+        return None, None
+    powers = aoa_tiebreaker_powers(locs, tx_locs, rx_locs, arr_channels,
+                                   WAVELENGTHS, coherent=False)
+    n_points = locs.shape[0]
+    peaks, _ = grid_peaks(locs, powers, n_peaks, 2 * step)
+
+    offsets = np.arange(-2 * GRID_REFINE, 2 * GRID_REFINE + 1)
+    offsets = np.stack(np.meshgrid(offsets, offsets, offsets, indexing="ij"),
+                       axis=-1).reshape(-1, 3)
+    for _ in range(max(n_levels, 1)):
+        step /= GRID_REFINE
+        locs = np.clip((peaks[:, None, :] + offsets * step).reshape(-1, 3),
+                       bound_min, bound_max)
+        powers = aoa_tiebreaker_powers(locs, tx_locs, rx_locs, arr_channels,
+                                       WAVELENGTHS)
+        n_points += locs.shape[0]
+        peaks, peak_powers = grid_peaks(locs, powers, n_peaks, 2 * step)
+
+    metrics.gauge("grid.points", n_points)
+    return peaks[0], peak_powers[0]
 
+def engine(config):
+    """
+    Localization engine of config["engine"]:
+        "multi_fusion" (default): MultiFusion shuffles and AoA tiebreaker
+        "grid": grid_localize() only
+        "auto": MultiFusion, grid_localize() if it found no candidates
+    """
+    name = config.get("engine", "multi_fusion")
+    if name not in ENGINES:
+        raise ValueError(f"Unknown localization engine {name}")
+    return name
+
+def precision(config):
+    """
+    Array precision of config["precision"]:
+        "float64" (default): float64 / complex128 everywhere
+        "float32": clusters, channels, MultiFusion candidates and the AoA
+            tiebreaker in float32 / complex64, least squares in float64
+    """
+    name = config.get("precision", "float64")
+    if name not in PRECISIONS:
+        raise ValueError(f"Unknown precision {name}")
+    return name
+
+def grid_fallback(best_loc, tx_locs, rx_locs, arr_channels, bound_min,
+                  bound_max, config):
+    """best_loc, or the grid_localize() result for engine "auto" if None"""
+    if best_loc is not None or engine(config) != "auto":
+        return best_loc
+    metrics.count("grid.fallbacks")
+    best_loc, _ = grid_localize(tx_locs, rx_locs, arr_channels, bound_min,
+                                bound_max, config)
+    return best_loc
+
+@metrics.timed("self_localize_queue")
 def self_localize_queue(data_queue, ref_locs, config):
+    """
+    Computes the reader location from measurements of reference tags.
+
+    ref_locs: {epc: [x,y,z]} or area_cache.ReferenceLocations
+    config: same as target_localize_queue
+    """
     processed_data = preprocess_queue(data_queue)
 
     n_shuffle = config["shuffle"]
-    min_bounds = np.array(config["min_bounds"])
-    max_bounds = np.array(config["max_bounds"])
-    tx_rx_offset = np.array(config["tx_rx_offset"])
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    tx_rx_offset = np.asarray(config["tx_rx_offset"], dtype=float)
 
-    freqs = np.array([770e6 + 27e6*i for i in range(14)])
-    wavelengths = scipy.constants.c/freqs
+    wavelengths = WAVELENGTHS
     n_tags = len(data_queue)
 
     clusters = []
-    tag_locs = []
     channels = []
     for i in range(len(processed_data)):
         clusters.append(processed_data[i]["distance_candidates"])
-        tag_locs.append(ref_locs[processed_data[i]["epc"]])
         channels.append(processed_data[i]["channel_estimate"][0])
-    clusters = np.array(clusters)
-    tag_locs = np.array(tag_locs)
-    channels = np.array(channels)
+    float_dtype, complex_dtype = mf.PRECISIONS[precision(config)]
+    clusters = np.array(clusters, dtype=float_dtype)
+    channels = np.array(channels, dtype=complex_dtype)
+    epcs = [data["epc"] for data in processed_data]
+    if isinstance(ref_locs, dict):
+        tag_locs = np.array([ref_locs[epc] for epc in epcs])
+    else:
+        # area_cache.ReferenceLocations, one gather from its coordinates
+        tag_locs = ref_locs.lookup(epcs)
     arr_channels = antenna_array_channels(
         channels, config["cal_dist"], wavelengths)
 
 
+    if engine(config) == "grid":
+        best_loc, _ = grid_localize(tag_locs, tag_locs + tx_rx_offset,
+                                    arr_channels, min_bounds, max_bounds,
+                                    config)
+        return best_loc
+
+    if config.get("adaptive_shuffle"):
+        best_loc, _ = adaptive_localize_shuffles(
+            clusters, tag_locs, tag_locs + tx_rx_offset, min_bounds,
+            max_bounds, arr_channels, config,
+            prune_options_from_config(config))
+        return grid_fallback(best_loc, tag_locs, tag_locs + tx_rx_offset,
+                             arr_channels, min_bounds, max_bounds, config)
+
     # --------------- Multi fusion possible locations ---------------- #
+    # The RX antenna is offset from each reference tag location, same as
+    # in the tiebreaker below.
+    shuffle_results = localize_shuffles(clusters,
+                                        tag_locs,
+                                        tag_locs + tx_rx_offset,
+                                        min_bounds,
+                                        max_bounds,
+                                        shuffle_permutations(n_tags, config),
+                                        shuffle_workers(config, n_shuffle),
+                                        config.get("intersection_cache_size",
+                                                   INTERSECTION_CACHE_SIZE),
+                                        prune_options=prune_options_from_config(config))
     possible_locs = []
-    for i in range(n_shuffle):
-        shuffler = np.random.permutation(n_tags)
-        shuffled_locs = tag_locs[shuffler]
-        shuffled_clusters = clusters[shuffler]
-        # BUG fix tx_rx_offset order with new localize function
-        loc_guesses = localize(shuffled_clusters,
-                               shuffled_locs,
-                               tx_rx_offset,
-                               min_bounds,
-                               max_bounds)
+    for loc_guesses in shuffle_results:
         if loc_guesses:
             possible_locs += [guess["location"] for guess in loc_guesses]
     # TODO (Isaac) investigate no results from multifusion
@@ -120,29 +1093,98 @@ def self_localize_queue(data_queue, ref_locs, config):
     # print(np.mean(np.array(possible_locs),axis=0))
     # print(len(possible_locs))
     
-    # TODO (Isaac) put into function
     # print("Starting Tiebreaker")
-    best_power = None
-    best_loc = None
-    n_freqs = len(wavelengths)
-    for loc in possible_locs:
-        power = 0
-        for i in range(n_tags):
-            dist = (np.linalg.norm(loc - tag_locs[i])
-                    + np.linalg.norm(loc - tag_locs[i] - tx_rx_offset))
-            for j in range(n_freqs):
-                power += (arr_channels[i, j]
-                            * np.exp(1j * 2 * np.pi * dist / wavelengths[j]))
-        power = np.abs(power)
-        if best_power is None or power > best_power:
-            best_power = power
-            best_loc = loc
+    best_loc, _ = aoa_tiebreaker(possible_locs,
+                                 tag_locs,
+                                 tag_locs + tx_rx_offset,
+                                 arr_channels,
+                                 wavelengths)
     # print("Ended tiebreaker")
     # print(best_loc)
     # print()
+    return grid_fallback(best_loc, tag_locs, tag_locs + tx_rx_offset,
+                         arr_channels, min_bounds, max_bounds, config)
+
+def prior_bounds(prior, min_bounds, max_bounds, config):
+    """
+    Search box of the tracking mode, the bounds cut down to the prior
+    location +- max(config["tracking_sigmas"] (TRACKING_SIGMAS) x its
+    uncertainty, config["tracking_min_radius"] (TRACKING_MIN_RADIUS)).
+
+    prior: {location: [x,y,z], uncertainty: standard deviation in
+        meters, a number or one per axis}
+
+    Returns: (min_bounds, max_bounds), or None if the prior box is
+    outside the bounds
+    """
+    location = np.asarray(prior["location"], dtype=float)
+    radius = np.fmax(
+        config.get("tracking_sigmas", TRACKING_SIGMAS)
+        * np.asarray(prior["uncertainty"], dtype=float),
+        config.get("tracking_min_radius", TRACKING_MIN_RADIUS))
+    low = np.fmax(location - radius, min_bounds)
+    high = np.fmin(location + radius, max_bounds)
+    if np.any(low >= high):
+        return None
+    return low, high
+
+def bistatic_residual(location, clusters, tx_locs, rx_locs):
+    """
+    Median over the measurements of the distance between the bistatic
+    distance of location and the closest cluster distance, in meters
+    """
+    dists = (np.linalg.norm(tx_locs[:, :3] - location, axis=1)
+             + np.linalg.norm(rx_locs[:, :3] - location, axis=1))
+    errors = np.nanmin(np.abs(clusters[:, :, 0] - dists[:, None]), axis=1)
+    return float(np.median(errors))
+
+@metrics.timed("tracking")
+def track_localize(processed_data, self_loc_poses, config, prior):
+    """
+    Fast path of target_localize_queue for a tag that probably did not
+    move: the same search in the prior_bounds() box instead of the area.
+    processed_data is the preprocess_queue() of the data_queue, which the
+    caller reuses for the whole area search if the tag moved.
+    MultiFusion starts its least squares in the middle of that box and
+    its prechecks, on unless config["precheck"] is False, drop the
+    clusters that miss it, so far fewer intersections are tried.
+
+    Returns: [x,y,z], or None if the prior box is outside the area, no
+    location was found in it, or the bistatic_residual() of the location
+    is above config["tracking_residual"] (TRACKING_RESIDUAL), i.e. the
+    tag moved and the caller should search the whole area
+    """
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    bounds = prior_bounds(prior, min_bounds, max_bounds, config)
+    if bounds is None:
+        metrics.count("tracking.outside")
+        return None
+
+    best_loc = _target_localize_queue(
+        processed_data, self_loc_poses,
+        dict(config, min_bounds=bounds[0], max_bounds=bounds[1],
+             precheck=config.get("precheck", True)))
+    if best_loc is not None:
+        clusters = np.array([data["distance_candidates"][0]
+                             for data in processed_data],
+                            dtype=float)
+        tx_poses = np.asarray(self_loc_poses, dtype=float).reshape(-1, 7)
+        rx_locs = (rotate_by_quaternions(
+            tx_poses[:, 3:], np.asarray(config["tx_rx_offset"], dtype=float))
+            + tx_poses[:, :3])
+        residual = bistatic_residual(best_loc, clusters, tx_poses, rx_locs)
+        metrics.gauge("tracking.residual", residual)
+        if residual > config.get("tracking_residual", TRACKING_RESIDUAL):
+            best_loc = None
+    if best_loc is None:
+        metrics.count("tracking.fallbacks")
+    else:
+        metrics.count("tracking.hits")
     return best_loc
 
-def target_localize_queue(data_queue, self_loc_poses, config):
+@metrics.timed("target_localize_queue")
+def target_localize_queue(data_queue, self_loc_poses, config, prior=None):
     """
     Computes target tag locations based on measurement data and self-
     localization positions.
@@ -162,65 +1204,103 @@ def target_localize_queue(data_queue, self_loc_poses, config):
         tx_rx_offset: [x,y,z] shift from TX antenna to RX antenna in TX
             frame
         cal_dist: calibration_distance
+        seed: (optional) seed for the shuffle permutations
+        shuffle_workers: (optional) processes to run shuffles on,
+            default 1, None for one per core
+        intersection_cache_size: (optional) intersections cached across
+            shuffles, 0 disables the cache
+        beam_width, dedup, max_candidates, time_budget_s: (optional)
+            MultiFusion pruning, see prune_options_from_config()
+        adaptive_shuffle: (optional) stop shuffling once the result
+            converged, shuffle is then the most shuffles run.  Tuned by
+            shuffle_tolerance and shuffle_min, see
+            adaptive_localize_shuffles()
+        engine: (optional) "multi_fusion", "grid" or "auto", see
+            engine().  grid_resolution, grid_peaks and grid_levels tune
+            grid_localize()
+        precision: (optional) "float64" or "float32", see precision()
+        solver, warm_start: (optional) least squares of the
+            intersections, see prune_options_from_config()
+        precheck: (optional) True turns on the bounding box prechecks
+            of the clusters, see prune_options_from_config()
+        tracking_sigmas, tracking_min_radius, tracking_residual:
+            (optional) tune the tracking mode, see track_localize()
     }
+    prior: (optional) {location: [x,y,z], uncertainty: meters} where the
+        tag was last seen, e.g. from tracking.Tracker.  The tag is then
+        first searched for around the prior (track_localize()), and in
+        the whole area if it moved.
     """
-
     # Load data from queue into proper format.  This can be removed if
     # the data is already in the right format
     processed_data = preprocess_queue(data_queue)
 
+    if prior is not None:
+        best_loc = track_localize(processed_data, self_loc_poses, config, prior)
+        if best_loc is not None:
+            return best_loc
+    return _target_localize_queue(processed_data, self_loc_poses, config)
+
+def _target_localize_queue(processed_data, self_loc_poses, config):
+    """target_localize_queue of preprocess_queue() data without a prior"""
+
     n_shuffle = config["shuffle"]
-    min_bounds = np.array(config["min_bounds"])
-    max_bounds = np.array(config["max_bounds"])
-    tx_rx_offset = np.array(config["tx_rx_offset"])
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    tx_rx_offset = np.asarray(config["tx_rx_offset"], dtype=float)
 
-    freqs = np.array([770e6 + 27e6*i for i in range(14)])
-    wavelengths = scipy.constants.c/freqs
-    n_tags = len(data_queue)
+    wavelengths = WAVELENGTHS
+    n_tags = len(processed_data)
 
     clusters = []
     channels = []
     for data in processed_data:
         clusters.append(data["distance_candidates"][0])
         channels.append(data["channel_estimate"][0])
-    clusters = np.array(clusters)
-    channels = np.array(channels)
+    float_dtype, complex_dtype = mf.PRECISIONS[precision(config)]
+    clusters = np.array(clusters, dtype=float_dtype)
+    channels = np.array(channels, dtype=complex_dtype)
     tx_self_loc_poses = np.array(self_loc_poses)
 
     # Calculate the RX antenna poses based on the TX antenna poses
     # and the TX RX offset
-    rx_self_loc_poses = []
-    for tx_pose in tx_self_loc_poses:
-        tx_loc = tx_pose[:3]
-        # This is just a cleaner way of doing pose math. This can be 
-        # written with standard vector / matrix math
-        rot = scipy.spatial.transform.Rotation.from_quat(tx_pose[3:])
-        rx_self_loc_poses.append(rot.apply(tx_rx_offset) + tx_loc)
-    rx_self_loc_poses = np.array(rx_self_loc_poses)
+    rx_self_loc_poses = (rotate_by_quaternions(tx_self_loc_poses[:, 3:],
+                                               tx_rx_offset)
+                         + tx_self_loc_poses[:, :3])
 
     arr_channels = antenna_array_channels(
         channels, config["cal_dist"], wavelengths)
 
     # --------------- Multi fusion possible locations ---------------- #
+    # Run the algorithm in different orders because currently the
+    # order is an issue (BUG)
+    if engine(config) == "grid":
+        best_loc, _ = grid_localize(tx_self_loc_poses, rx_self_loc_poses,
+                                    arr_channels, min_bounds, max_bounds,
+                                    config)
+        return best_loc
+
+    if config.get("adaptive_shuffle"):
+        best_loc, _ = adaptive_localize_shuffles(
+            clusters, tx_self_loc_poses, rx_self_loc_poses, min_bounds,
+            max_bounds, arr_channels, config,
+            prune_options_from_config(config))
+        return grid_fallback(best_loc, tx_self_loc_poses, rx_self_loc_poses,
+                             arr_channels, min_bounds, max_bounds, config)
+
+    shuffle_results = localize_shuffles(clusters,
+                                        tx_self_loc_poses,
+                                        rx_self_loc_poses,
+                                        min_bounds,
+                                        max_bounds,
+                                        shuffle_permutations(n_tags, config),
+                                        shuffle_workers(config, n_shuffle),
+                                        config.get("intersection_cache_size",
+                                                   INTERSECTION_CACHE_SIZE),
+                                        prune_options=prune_options_from_config(config))
     possible_locs = []
     residuals = []
-    for i in range(n_shuffle):
-        # Run the algorithm in different orders because currently the
-        # order is an issue (BUG)
-        shuffler = np.random.permutation(n_tags)
-        tx_shuffled_poses = tx_self_loc_poses[shuffler]
-        rx_shuffled_poses = rx_self_loc_poses[shuffler]
-        shuffled_clusters = clusters[shuffler]
-
-        # To reuse the localize function, since offset get's added 
-        # to the tx locs. # TODO (Isaac) fix this, since confusing
-        # shuffled_locs = shuffled_locs - tx_rx_offset
-
-        loc_guesses = localize(shuffled_clusters,
-                               tx_shuffled_poses,
-                               rx_shuffled_poses,
-                               min_bounds,
-                               max_bounds)
+    for loc_guesses in shuffle_results:
         if loc_guesses:
             # print(len(loc_guesses))
             # print([guess["location"] for guess in loc_guesses])
@@ -244,34 +1324,123 @@ def target_localize_queue(data_queue, self_loc_poses, config):
     # print(np.mean(np.array(possible_locs),axis=0))
     # print(len(possible_locs))
     
-    # TODO (Isaac) put into function
     # print("Starting Tiebreaker")
-    best_power = None
-    best_loc = None
-    n_freqs = len(wavelengths)
-    for t, loc in enumerate(possible_locs):
-        power = 0
-        for i in range(n_tags):
-            dist = (np.linalg.norm(loc - tx_self_loc_poses[i][:3])
-                    + np.linalg.norm(loc - rx_self_loc_poses[i][:3]))
-            # TODO (Isaac) tx_rx_offset should apply to which? Same as self loc
-            # in this case, which is opposite of in the localize() call
-            # FIXED: changed from - to + (since - is sort of in parentheses)
-            # and this fixed issue.  However, should still fix naming 
-            # convention and clean up the code.
-            for j in range(n_freqs):
-                power += (arr_channels[i, j]
-                            * np.exp(1j * 2 * np.pi * dist / wavelengths[j]))
-        power = np.abs(power)
-        # if t == min_err_idx:
-        #     print(f"Min Power: {power}")
-        # if best_power is not None and power < best_power and np.abs(best_power - power) < 0.01*np.abs(best_power):
-        #     print(f"Close: {power} {best_power} {loc}")
-        if best_power is None or power > best_power:
-            best_power = power
-            best_loc = loc
-    # print("Best Power: ", best_power)
+    # TODO (Isaac) tx_rx_offset should apply to which? Same as self loc
+    # in this case, which is opposite of in the localize() call
+    # FIXED: changed from - to + (since - is sort of in parentheses)
+    # and this fixed issue.  However, should still fix naming
+    # convention and clean up the code.
+    best_loc, powers = aoa_tiebreaker(possible_locs,
+                                      tx_self_loc_poses,
+                                      rx_self_loc_poses,
+                                      arr_channels,
+                                      wavelengths)
+    # print("Best Power: ", np.max(powers) if len(powers) else None)
     # print("Ended tiebreaker")
     # print(best_loc)
     # print()
-    return best_loc
\ No newline at end of file
+    return grid_fallback(best_loc, tx_self_loc_poses, rx_self_loc_poses,
+                         arr_channels, min_bounds, max_bounds, config)
+
+@metrics.timed("target_localize_batch")
+def target_localize_batch(data_queue, pose_indices, self_loc_poses, config):
+    """
+    target_localize_queue for many tags at once.  One reader pass sees
+    many EPCs from the same poses, so the poses are given once and each
+    measurement points to its pose.  The RX poses and the antenna array
+    channels are computed once for the whole batch, and the shuffles of
+    all tags run in a single pass over the worker pool.  The location of
+    each tag is the same as target_localize_queue on its measurements
+    (in queue order) with the same config.
+
+    The least squares of each tag's MultiFusion are most of the time and
+    are not shared between tags, so this is not faster than a
+    target_localize_queue loop on one worker (see
+    benchmarks/batch_benchmark.py).  There are no adaptive shuffles and
+    no tracking priors, config with BATCH_UNSUPPORTED_KEYS raises
+    ValueError.
+
+    data_queue: [{epc, distance_candidates, channel_estimate}], any mix
+        of tags
+    pose_indices: (n_measurements, ) index in self_loc_poses of the pose
+        of each measurement
+    self_loc_poses: (n_poses, 7) [x,y,z,qx,qy,qz,qw] TX antenna poses
+    config: same as target_localize_queue
+
+    Returns: {epc: [x,y,z] or None}
+    """
+    unsupported = [key for key in BATCH_UNSUPPORTED_KEYS if config.get(key)]
+    if unsupported:
+        raise ValueError(f"target_localize_batch does not support {unsupported}")
+    processed_data = preprocess_queue(data_queue)
+
+    min_bounds = np.asarray(config["min_bounds"], dtype=float)
+    max_bounds = np.asarray(config["max_bounds"], dtype=float)
+    tx_rx_offset = np.asarray(config["tx_rx_offset"], dtype=float)
+    cache_size = config.get("intersection_cache_size", INTERSECTION_CACHE_SIZE)
+    prune_options = prune_options_from_config(config)
+
+    # ------------------- Shared per batch ---------------------------- #
+    tx_poses = np.asarray(self_loc_poses, dtype=float).reshape(-1, 7)
+    rx_locs = (rotate_by_quaternions(tx_poses[:, 3:], tx_rx_offset)
+               + tx_poses[:, :3])
+    pose_indices = np.asarray(pose_indices, dtype=np.int64)
+    tx_poses = tx_poses[pose_indices]
+    rx_locs = rx_locs[pose_indices]
+
+    float_dtype, complex_dtype = mf.PRECISIONS[precision(config)]
+    channels = np.array([data["channel_estimate"][0] for data in processed_data],
+                        dtype=complex_dtype)
+    arr_channels = antenna_array_channels(
+        channels, config["cal_dist"], WAVELENGTHS)
+
+    # Measurement indices of each tag, in queue order
+    tag_measurements = {}
+    for i, data in enumerate(processed_data):
+        tag_measurements.setdefault(data["epc"], []).append(i)
+
+    # --------------- Multi fusion possible locations ---------------- #
+    tasks = []
+    task_tags = []
+    use_grid = engine(config) == "grid"
+    for epc, indices in ([] if use_grid else tag_measurements.items()):
+        clusters = np.array(
+            [processed_data[i]["distance_candidates"][0] for i in indices],
+            dtype=float_dtype)
+        tag_tasks = shuffle_tasks(clusters,
+                                  tx_poses[indices],
+                                  rx_locs[indices],
+                                  min_bounds,
+                                  max_bounds,
+                                  shuffle_permutations(len(indices), config),
+                                  cache_size,
+                                  prune_options)
+        tasks += tag_tasks
+        task_tags += [epc] * len(tag_tasks)
+    with metrics.span("shuffles"):
+        shuffle_results = run_shuffle_tasks(
+            tasks, shuffle_workers(config, len(tasks)))
+
+    possible_locs = {epc: [] for epc in tag_measurements}
+    for epc, loc_guesses in zip(task_tags, shuffle_results):
+        if loc_guesses:
+            possible_locs[epc] += [guess["location"] for guess in loc_guesses]
+
+    # ----------------------- AoA Tiebreaker ------------------------- #
+    locations = {}
+    for epc, indices in tag_measurements.items():
+        if use_grid:
+            locations[epc], _ = grid_localize(
+                tx_poses[indices], rx_locs[indices], arr_channels[indices],
+                min_bounds, max_bounds, config)
+            continue
+        best_loc, _ = aoa_tiebreaker(np.array(possible_locs[epc]),
+                                     tx_poses[indices],
+                                     rx_locs[indices],
+                                     arr_channels[indices],
+                                     WAVELENGTHS)
+        locations[epc] = grid_fallback(
+            best_loc, tx_poses[indices], rx_locs[indices],
+            arr_channels[indices], min_bounds, max_bounds, config)
+    metrics.count("batch.tags", len(tag_measurements))
+    return locations
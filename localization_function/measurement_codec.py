@@ -0,0 +1,132 @@
+"""
+Compact binary encoding for measurement arrays (channel_estimate,
+distance_candidates) stored in DynamoDB and read from its streams.
+
+Layout, all little-endian:
+
+    offset  size  field
+    0       2     magic b"IQ"
+    2       1     format version (1)
+    3       1     dtype code, see DTYPES
+    4       1     ndim
+    5       3     reserved, zero
+    8       4*n   shape, uint32 per dimension
+    ...           zero padding up to a multiple of 8 bytes
+    ...           array data, C order
+
+The header is padded so the data is 8-byte aligned and decodes without a
+copy through np.frombuffer.  Unlike pickle, decoding never executes
+anything from the payload, so it is safe on untrusted stream data.
+"""
+
+import struct
+
+import numpy as np
+
+MAGIC = b"IQ"
+VERSION = 1
+
+# dtype code -> little-endian numpy dtype
+DTYPES = {
+    1: np.dtype("<c8"),  # complex64, channel estimates
+    2: np.dtype("<f4"),  # float32, distance candidates
+    3: np.dtype("<c16"),
+    4: np.dtype("<f8"),
+}
+_DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+_HEADER = struct.Struct("<2sBBB3x")
+_ALIGN = 8
+# Shape struct per ndim, decoding runs once per stream record
+_SHAPES = {}
+
+
+def _data_offset(ndim):
+    end = _HEADER.size + 4 * ndim
+    return -(-end // _ALIGN) * _ALIGN
+
+
+def _shape_struct(ndim):
+    shape_struct = _SHAPES.get(ndim)
+    if shape_struct is None:
+        shape_struct = _SHAPES[ndim] = struct.Struct(f"<{ndim}I")
+    return shape_struct
+
+
+def is_encoded(buf):
+    """True if buf starts with the header of this format"""
+    return (isinstance(buf, (bytes, bytearray, memoryview))
+            and buf[:len(MAGIC)] == MAGIC)
+
+
+def encode_array(arr, dtype=None):
+    """
+    Encode arr as bytes.  dtype (e.g. np.complex64) converts the array
+    first, otherwise its own dtype must be one of DTYPES.
+    """
+    arr = np.asarray(arr, dtype=dtype)
+    le_dtype = arr.dtype.newbyteorder("<")
+    if le_dtype not in _DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype {arr.dtype}")
+    # Not ascontiguousarray, which turns a 0-d array into a 1-d one
+    arr = np.asarray(arr, dtype=le_dtype, order="C")
+
+    offset = _data_offset(arr.ndim)
+    header = bytearray(offset)
+    _HEADER.pack_into(header, 0, MAGIC, VERSION, _DTYPE_CODES[le_dtype], arr.ndim)
+    _shape_struct(arr.ndim).pack_into(header, _HEADER.size, *arr.shape)
+    return bytes(header) + arr.tobytes()
+
+
+def decode_header(buf):
+    """
+    Returns: (dtype, shape, data offset) of an encoded buffer
+    """
+    if len(buf) < _HEADER.size:
+        raise ValueError("Buffer too short for header")
+    magic, version, code, ndim = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded measurement array")
+    if version != VERSION:
+        raise ValueError(f"Unsupported format version {version}")
+    if code not in DTYPES:
+        raise ValueError(f"Unknown dtype code {code}")
+    offset = _data_offset(ndim)
+    if len(buf) < offset:
+        raise ValueError("Buffer too short for shape")
+    shape = _shape_struct(ndim).unpack_from(buf, _HEADER.size)
+    dtype = DTYPES[code]
+    expected = dtype.itemsize
+    for dim in shape:
+        expected *= dim
+    expected += offset
+    if len(buf) != expected:
+        raise ValueError(f"Expected {expected} bytes, got {len(buf)}")
+    return dtype, shape, offset
+
+
+def decode_array(buf):
+    """
+    Decode one encoded array.  The result is a read-only view on buf,
+    no data is copied.
+    """
+    dtype, shape, offset = decode_header(buf)
+    return np.frombuffer(buf, dtype=dtype, offset=offset).reshape(shape)
+
+
+def decode_batch(bufs):
+    """
+    Decode encoded arrays of the same dtype and shape into one
+    contiguous (len(bufs), *shape) array.
+    """
+    if not bufs:
+        raise ValueError("Empty batch")
+    dtype, shape, _ = decode_header(bufs[0])
+    out = np.empty((len(bufs),) + tuple(shape), dtype=dtype)
+    for i, buf in enumerate(bufs):
+        buf_dtype, buf_shape, offset = decode_header(buf)
+        if buf_dtype != dtype or buf_shape != shape:
+            raise ValueError(
+                f"Record {i} is {buf_dtype}{buf_shape}, batch is {dtype}{shape}")
+        out[i] = np.frombuffer(buf, dtype=dtype, offset=offset).reshape(shape)
+    return out
@@ -0,0 +1,226 @@
+"""
+Lightweight instrumentation for the localization pipeline.
+
+Timing spans nest: a span opened inside another is recorded under the
+path "outer/inner".  Counters add up, gauges keep count / sum / min / max
+of the observed values.  Everything goes to one in-process registry,
+read with snapshot() (e.g. in tests) or written with flush() as
+CloudWatch Embedded Metric Format log lines.
+
+Disabled by default.  Set LOCALIZATION_METRICS=1 or call enable().  When
+disabled, span() returns a shared no-op context manager and callers
+guard any other bookkeeping with `if metrics.enabled:`, so the cost is a
+function call and an attribute check.
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+
+NAMESPACE = os.environ.get("LOCALIZATION_METRICS_NAMESPACE", "IndoorIoT/Localization")
+
+enabled = os.environ.get("LOCALIZATION_METRICS", "") not in ("", "0")
+
+# name path -> [count, total_s, max_s]
+_timings = {}
+# name -> value
+_counters = {}
+# name -> [count, sum, min, max]
+_gauges = {}
+# Names of the open spans
+_stack = []
+
+# CloudWatch accepts at most 100 metrics per EMF record
+EMF_MAX_METRICS = 100
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    _timings.clear()
+    _counters.clear()
+    _gauges.clear()
+
+
+def current_path():
+    return "/".join(_stack)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        path = "/".join(_stack)
+        _stack.pop()
+        timing = _timings.get(path)
+        if timing is None:
+            _timings[path] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            if elapsed > timing[2]:
+                timing[2] = elapsed
+        return False
+
+
+def span(name):
+    """Context manager timing the enclosed block under name"""
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name):
+    """Decorator running the function inside span(name)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    if enabled:
+        stats = _gauges.get(name)
+        if stats is None:
+            _gauges[name] = [1, value, value, value]
+        else:
+            stats[0] += 1
+            stats[1] += value
+            if value < stats[2]:
+                stats[2] = value
+            if value > stats[3]:
+                stats[3] = value
+
+
+def snapshot():
+    """
+    Returns: {
+        "timings": {path: {"count", "total_s", "max_s"}},
+        "counters": {name: value},
+        "gauges": {name: {"count", "sum", "min", "max"}},
+    }
+    """
+    return {
+        "timings": {path: {"count": c, "total_s": total, "max_s": max_s}
+                    for path, (c, total, max_s) in _timings.items()},
+        "counters": dict(_counters),
+        "gauges": {name: {"count": c, "sum": total, "min": low, "max": high}
+                   for name, (c, total, low, high) in _gauges.items()},
+    }
+
+
+def merge(other, prefix=None):
+    """
+    Add a snapshot() taken elsewhere (e.g. in a worker process).  Its
+    spans are placed under prefix, by default the currently open span.
+    """
+    if prefix is None:
+        prefix = current_path()
+    for path, timing in other["timings"].items():
+        path = f"{prefix}/{path}" if prefix else path
+        mine = _timings.setdefault(path, [0, 0.0, 0.0])
+        mine[0] += timing["count"]
+        mine[1] += timing["total_s"]
+        mine[2] = max(mine[2], timing["max_s"])
+    for name, value in other["counters"].items():
+        _counters[name] = _counters.get(name, 0) + value
+    for name, stats in other["gauges"].items():
+        mine = _gauges.get(name)
+        if mine is None:
+            _gauges[name] = [stats["count"], stats["sum"], stats["min"], stats["max"]]
+        else:
+            mine[0] += stats["count"]
+            mine[1] += stats["sum"]
+            mine[2] = min(mine[2], stats["min"])
+            mine[3] = max(mine[3], stats["max"])
+
+
+def emf_records(dimensions=None):
+    """
+    The registry as CloudWatch Embedded Metric Format records, at most
+    EMF_MAX_METRICS metrics each.  Span totals are in milliseconds,
+    gauges report their maximum.
+    """
+    dimensions = dict(dimensions or {})
+    values = []
+    for path, (_, total, _) in _timings.items():
+        values.append((f"time.{path}", total * 1e3, "Milliseconds"))
+    for name, value in _counters.items():
+        values.append((name, value, "Count"))
+    for name, (_, _, _, high) in _gauges.items():
+        values.append((name, high, "None"))
+
+    timestamp = int(time.time() * 1000)
+    records = []
+    for start in range(0, len(values), EMF_MAX_METRICS):
+        record = dict(dimensions)
+        metric_defs = []
+        for name, value, unit in values[start:start + EMF_MAX_METRICS]:
+            record[name] = value
+            metric_defs.append({"Name": name, "Unit": unit})
+        record["_aws"] = {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": metric_defs,
+            }],
+        }
+        records.append(record)
+    return records
+
+
+def flush(dimensions=None, stream=None):
+    """
+    Write the registry as EMF log lines (JSON objects on stdout by
+    default, which Lambda sends to CloudWatch Logs) and reset it.
+
+    Returns: the records written, none when disabled
+    """
+    if not enabled:
+        return []
+    records = emf_records(dimensions)
+    for record in records:
+        print(json.dumps(record), file=stream or sys.stdout)
+    reset()
+    return records
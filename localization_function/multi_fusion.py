@@ -1,6 +1,10 @@
 import itertools
+import collections
+import time
 import numpy as np
-import scipy.optimize
+
+import feasibility
+import metrics
 # from . import localize # TODO fix chained imports for globals
 
 ##
@@ -19,12 +23,330 @@ import scipy.optimize
 #          with pretty small residual cost. See stopCondition()
 #       3. Don't need to book-keep all S(N,*) for all N. Only need the previous (aka N-1).
 #       4. Deduplicate intersections that are close to each other. See pruneDeduplicateCloseIntersections()
+#       5. Skip least squares for (previous solution, cluster) pairs whose
+#          cluster distance disagrees with the previous location. Done for all
+#          pairs of a measurement at once, see earlyRejection()
+#       6. Keep only the best beam_width intersections of each S(n, k). See pruneBeam()
+#       7. Cap the total number of intersections across all k, and the time
+#          spent on one measurement. See pruneBudget() and process_new_measurement()
+#       8. Skip clusters whose bistatic ellipsoid cannot pass through the
+#          bounds, and settle the early rejection of clusters whose ellipsoid
+#          passes nowhere near the previous intersections, with bounding box
+#          tests (see feasibility.py and earlyRejection())
+#
+#   Storage:
+#       Each S(n, k) is a CandidateSet, a struct-of-arrays with one row per
+#       intersection. Instead of copying the cartesian product and the
+#       rx/tx locations into every solution, each row points to a node in
+#       a shared IntersectionHistory, and the node points to the node it
+#       extended. The history of a candidate is recovered by walking the
+#       parent pointers back to the root.
+#
+#   Precision:
+#       Locations, costs and measurement geometry are stored in the float
+#       dtype of MultiFusion(precision=...), float64 by default.  Least
+#       squares always runs in float64, see solveIntersections().
 #
+# Float and complex dtype of each precision, see MultiFusion
+PRECISIONS = {
+    'float64': (np.float64, np.complex128),
+    'float32': (np.float32, np.complex64),
+}
+
+
+def _grow(arr, min_len):
+    """Return arr reallocated along axis 0 to hold at least min_len rows"""
+    if arr.shape[0] >= min_len:
+        return arr
+    new_len = max(2 * arr.shape[0], min_len)
+    grown = np.empty((new_len,) + arr.shape[1:], dtype=arr.dtype)
+    grown[:arr.shape[0]] = arr
+    return grown
+
+
+class IntersectionHistory:
+    """
+    Append-only back-pointer store shared by all CandidateSets of one
+    MultiFusion.
+
+    A node is one (measurement, cluster) choice and the index of the node
+    it extended (ROOT for the first measurement of a candidate).
+    Measurement rx/tx locations are stored once, indexed by arrival order.
+    """
+    ROOT = -1
+
+    def __init__(self, capacity=64, dtype=np.float64):
+        self.num_nodes = 0
+        self.parent = np.empty(capacity, dtype=np.int64)
+        self.meas_index = np.empty(capacity, dtype=np.int64)
+        self.cluster_index = np.empty(capacity, dtype=np.int64)
+        self.cluster = np.empty((capacity, 2), dtype=dtype) # (distance, cluster cost)
+
+        self.num_meas = 0
+        self.rx_locs = np.empty((16, 3), dtype=dtype)
+        self.tx_locs = np.empty((16, 3), dtype=dtype)
+        # Caller's id of each measurement, stable across shuffles
+        self.meas_ids = np.empty(16, dtype=np.int64)
+
+    def add_measurement(self, rx_loc, tx_loc, meas_id=None):
+        """Store the antenna locations of a new measurement, return its index"""
+        self.rx_locs = _grow(self.rx_locs, self.num_meas + 1)
+        self.tx_locs = _grow(self.tx_locs, self.num_meas + 1)
+        self.meas_ids = _grow(self.meas_ids, self.num_meas + 1)
+        self.rx_locs[self.num_meas] = rx_loc
+        self.tx_locs[self.num_meas] = tx_loc
+        self.meas_ids[self.num_meas] = self.num_meas if meas_id is None else meas_id
+        self.num_meas += 1
+        return self.num_meas - 1
+
+    def add_nodes(self, parents, meas_index, cluster_index, clusters):
+        """
+        Append one node per row of clusters, node i extending parents[i],
+        all for the measurement meas_index.  Returns the new node indices.
+        """
+        n = self.num_nodes
+        m = len(parents)
+        self.parent = _grow(self.parent, n + m)
+        self.meas_index = _grow(self.meas_index, n + m)
+        self.cluster_index = _grow(self.cluster_index, n + m)
+        self.cluster = _grow(self.cluster, n + m)
+        self.parent[n:n + m] = parents
+        self.meas_index[n:n + m] = meas_index
+        self.cluster_index[n:n + m] = cluster_index
+        self.cluster[n:n + m] = clusters[:, :2]
+        self.num_nodes = n + m
+        return np.arange(n, n + m)
+
+    def compact(self, live_nodes):
+        """
+        Drop every node not reachable from live_nodes, keeping their
+        order.
+
+        Returns: remap(nodes) function translating old node indices to
+        the new ones
+        """
+        reachable = np.zeros(self.num_nodes, dtype=bool)
+        frontier = np.unique(np.asarray(live_nodes, dtype=np.int64))
+        frontier = frontier[frontier != self.ROOT]
+        while frontier.size:
+            frontier = frontier[~reachable[frontier]]
+            reachable[frontier] = True
+            frontier = self.parent[frontier]
+            frontier = np.unique(frontier[frontier != self.ROOT])
+
+        keep = np.flatnonzero(reachable)
+        new_index = np.full(self.num_nodes, self.ROOT, dtype=np.int64)
+        new_index[keep] = np.arange(keep.size)
+
+        def remap(nodes):
+            nodes = np.asarray(nodes, dtype=np.int64)
+            return np.where(nodes == self.ROOT, self.ROOT,
+                            new_index[np.fmax(nodes, 0)])
+
+        self.parent = remap(self.parent[keep])
+        self.meas_index = self.meas_index[keep]
+        self.cluster_index = self.cluster_index[keep]
+        self.cluster = self.cluster[keep]
+        self.num_nodes = keep.size
+        return remap
+
+    def walk(self, nodes, depth):
+        """
+        Follow the parent pointers of every node in nodes for depth steps.
+
+        Returns: (len(nodes), depth) array of node indices, oldest
+        measurement first
+        """
+        path = np.empty((len(nodes), depth), dtype=np.int64)
+        cur = np.asarray(nodes, dtype=np.int64)
+        for d in range(depth - 1, -1, -1):
+            path[:, d] = cur
+            cur = self.parent[cur]
+        return path
+
+
+class CandidateSet:
+    """
+    Struct-of-arrays set of intersections S(n, k).
+
+    Rows are preallocated up to capacity and filled with append(); only
+    the first size rows are valid. Row i of every array describes the
+    same intersection, and node[i] is its entry in the IntersectionHistory.
+    Locations and costs are stored as dtype.
+    """
+
+    def __init__(self, capacity, dtype=np.float64):
+        self.size = 0
+        self.location = np.full((capacity, 3), np.nan, dtype=dtype)
+        self.residual_cost = np.full(capacity, np.nan, dtype=dtype)
+        self.combined_cluster_cost = np.full(capacity, np.nan, dtype=dtype)
+        # Number of times the zeroth, first and second cluster was chosen
+        self.cand_counts = np.zeros((capacity, 3), dtype=np.int64)
+        self.node = np.full(capacity, IntersectionHistory.ROOT, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, location, residual_cost, combined_cluster_cost,
+               cand_counts, node):
+        i = self.size
+        self.location[i] = location
+        self.residual_cost[i] = residual_cost
+        self.combined_cluster_cost[i] = combined_cluster_cost
+        self.cand_counts[i] = cand_counts
+        self.node[i] = node
+        self.size = i + 1
+
+    def extend(self, location, residual_cost, combined_cluster_cost,
+               cand_counts, node):
+        """Append a block of rows, one per entry of node"""
+        i, j = self.size, self.size + len(node)
+        self.location[i:j] = location
+        self.residual_cost[i:j] = residual_cost
+        self.combined_cluster_cost[i:j] = combined_cluster_cost
+        self.cand_counts[i:j] = cand_counts
+        self.node[i:j] = node
+        self.size = j
+
+    @classmethod
+    def from_arrays(cls, location, residual_cost, combined_cluster_cost,
+                    cand_counts, node):
+        """CandidateSet holding exactly the given rows, without copying"""
+        out = cls(0, location.dtype)
+        out.size = len(node)
+        out.location = location
+        out.residual_cost = residual_cost
+        out.combined_cluster_cost = combined_cluster_cost
+        out.cand_counts = cand_counts
+        out.node = node
+        return out
+
+    def take(self, indices):
+        """Return a new CandidateSet holding the rows at indices"""
+        indices = np.asarray(indices, dtype=np.int64)
+        return CandidateSet.from_arrays(
+            self.location[indices],
+            self.residual_cost[indices],
+            self.combined_cluster_cost[indices],
+            self.cand_counts[indices],
+            self.node[indices],
+        )
+
+    def sorted_by_residual(self):
+        """Stable sort by residual cost (nan last)"""
+        order = np.argsort(self.residual_cost[:self.size], kind="stable")
+        return self.take(order)
+
+    @classmethod
+    def concatenate(cls, sets):
+        sets = [c for c in sets if c is not None]
+        out = cls(0, sets[0].location.dtype if sets else np.float64)
+        out.size = sum(len(c) for c in sets)
+        out.location = np.concatenate(
+            [c.location[:c.size] for c in sets] + [out.location])
+        out.residual_cost = np.concatenate(
+            [c.residual_cost[:c.size] for c in sets] + [out.residual_cost])
+        out.combined_cluster_cost = np.concatenate(
+            [c.combined_cluster_cost[:c.size] for c in sets]
+            + [out.combined_cluster_cost])
+        out.cand_counts = np.concatenate(
+            [c.cand_counts[:c.size] for c in sets] + [out.cand_counts])
+        out.node = np.concatenate([c.node[:c.size] for c in sets] + [out.node])
+        return out
+
+    def nbytes(self):
+        return (self.location.nbytes + self.residual_cost.nbytes
+                + self.combined_cluster_cost.nbytes + self.cand_counts.nbytes
+                + self.node.nbytes)
+
+
+class IntersectionCache:
+    """
+    LRU cache of least squares intersections, shared by the MultiFusion
+    runs of every shuffle of one measurement queue.
+
+    The key is the order-independent set of (measurement id, cluster
+    index) pairs an intersection uses, so the same subset reached in a
+    different order is not solved again.  It also holds the solver inputs
+    of the MultiFusion (bounds, precision, solver options and threshold,
+    see MultiFusion.cacheContext()), so runs with other settings never
+    share an entry.  A MultiFusion with warm_start does not use the cache,
+    its solutions depend on the previous location they start from.
+    Measurement ids are only meaningful within one queue; use a new cache
+    for a new queue.
+    """
+    # Bits reserved for the cluster index in a key code
+    CLUSTER_BITS = 16
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_keys(self, meas_ids, cluster_indices, context=b""):
+        """
+        One key per row of the (n, k) measurement id and cluster index
+        arrays, independent of the column order, each prefixed with
+        context.
+        """
+        codes = (np.asarray(meas_ids, dtype=np.int64) << self.CLUSTER_BITS) \
+            | np.asarray(cluster_indices, dtype=np.int64)
+        codes = np.sort(codes, axis=1)
+        return [context + row.tobytes() for row in codes]
+
+    def lookup(self, keys):
+        """
+        Returns: (locations, residual_costs, valid, misses), misses are
+        the indices of keys that still need solving
+        """
+        locs = np.full((len(keys), 3), np.nan)
+        residual_costs = np.full(len(keys), np.nan)
+        valid = np.zeros(len(keys), dtype=bool)
+        misses = []
+        for i, key in enumerate(keys):
+            entry = self._entries.get(key)
+            if entry is None:
+                misses.append(i)
+                continue
+            self._entries.move_to_end(key)
+            locs[i], residual_costs[i], valid[i] = entry
+        self.stats['hits'] += len(keys) - len(misses)
+        self.stats['misses'] += len(misses)
+        return locs, residual_costs, valid, np.array(misses, dtype=np.int64)
+
+    def store(self, keys, locs, residual_costs, valid):
+        for key, loc, residual_cost, is_valid in zip(
+                keys, locs, residual_costs, valid):
+            self._entries[key] = (loc, residual_cost, is_valid)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+
 class MultiFusion:
-    def __init__(self, bound_min, bound_max, early_return=True):
+    def __init__(self, bound_min, bound_max, early_return=True,
+                 warm_start=False, analytic_jac=False, solver='scipy',
+                 cache=None, beam_width=None, dedup=False,
+                 max_candidates=None, time_budget=None, precision='float64',
+                 precheck=False):
+        # Float dtype of the stored candidates and measurements, one of
+        # PRECISIONS
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}")
+        self.precision = precision
+        self.dtype = PRECISIONS[precision][0]
         self.num_of_rx = 0
         self.bound_min = bound_min
         self.bound_max = bound_max
+        self.history = IntersectionHistory(dtype=self.dtype)
         self.prev = {}
         self.prev[0] = self.getBaseCase()
         self.RESIDUAL_COST_THR = 0.05
@@ -32,23 +354,108 @@ class MultiFusion:
         self.ABSOLUTE_RESIDUAL_THRESHOLD = -7.0#-10#-7.0
         self.DISTANCE_THRESHOLD = 0.1#0.32#0.1
         self.PRUNE_CLOSE_DISTANCE_THRESHOLD = 0.01
+        # Smallest k whose residual ranks the intersections.  Three
+        # ellipsoids in three unknowns are exactly determined, so every
+        # S(n, 3) intersection has a residual of about 0 and the beam and
+        # budget cuts leave those sets alone.
+        self.MIN_RANKED_K = 4
+        # Clusters are feasible if their distance is within this many
+        # meters (in bistatic distance) of a point in the bounds.  A least
+        # squares cost 0.5 * sum(r^2) below RESIDUAL_COST_THR allows a
+        # single residual r up to sqrt(2 * RESIDUAL_COST_THR), so no
+        # cluster of an accepted intersection is rejected.
+        self.FEASIBILITY_TOLERANCE = float(np.sqrt(2 * self.RESIDUAL_COST_THR))
         self.run_early_return = early_return
+        # Cumulative (previous solution, cluster) pair counts of the early
+        # rejection gate, see earlyRejection()
+        self.gate_stats = {
+            'pairs': 0,
+            'non_finite': 0,
+            'infeasible': 0,
+            'rejected': 0,
+            'far': 0,
+            'solved': 0,
+        }
+        # Gate counts per k for the most recent measurement
+        self.last_gate_stats = {}
+        # Bounding box prechecks of the clusters (see feasibility.py),
+        # see process_new_measurement() and earlyRejection()
+        self.precheck = precheck
+        # Feasible clusters of the current measurement, None when off
+        self.cluster_feasible = None
+        # Cumulative clusters checked and found outside the bounds
+        self.feasibility_stats = {
+            'clusters': 0,
+            'outside_bounds': 0,
+        }
+        # Seed least squares from the previous intersection instead of the
+        # middle of the bounds
+        self.warm_start = warm_start
+        # Use the closed-form jacobian instead of finite differences
+        self.analytic_jac = analytic_jac
+        # 'scipy' solves each intersection with single_least_squares(),
+        # 'batch' solves all intersections of a k at once with
+        # batch_least_squares()
+        if solver not in ('scipy', 'batch'):
+            raise ValueError(f"Unknown solver {solver}")
+        self.solver = solver
+        # Optional IntersectionCache shared with other runs over the same
+        # measurements
+        self.cache = cache
+        # Cumulative least squares counters, see single_least_squares()
+        self.ls_stats = {
+            'calls': 0,
+            'nfev': 0,
+            'njev': 0,
+            'residual_evals': 0,
+        }
+        # Pruning, each stage is off when None / False, see prune().
+        # beam_width: int, or {k: int}, best intersections kept per k
+        self.beam_width = beam_width
+        # dedup: drop intersections within PRUNE_CLOSE_DISTANCE_THRESHOLD
+        # of a better one
+        self.dedup = dedup
+        # max_candidates: total intersections kept across all k >=
+        # MIN_RANKED_K
+        self.max_candidates = max_candidates
+        # time_budget: seconds per measurement, lower k are carried over
+        # without intersecting once it is spent
+        self.time_budget = time_budget
+        # Cumulative intersections dropped by each stage, and measurements
+        # that ran out of time
+        self.prune_stats = {
+            'beam': 0,
+            'dedup': 0,
+            'budget': 0,
+            'time_budget_stops': 0,
+        }
+
+    def compactHistory(self):
+        """
+        Drop history nodes no longer used by any candidate in self.prev,
+        e.g. before checkpointing.
+        """
+        live = [solutions.node[:len(solutions)] for solutions in self.prev.values()]
+        remap = self.history.compact(np.concatenate(live) if live else [])
+        for solutions in self.prev.values():
+            solutions.node[:len(solutions)] = remap(solutions.node[:len(solutions)])
+
+    def cacheContext(self):
+        """
+        Inputs of every least squares solve besides its measurements, the
+        common part of this MultiFusion's IntersectionCache keys
+        """
+        return b"".join([
+            np.asarray(self.bound_min, dtype=np.float64).tobytes(),
+            np.asarray(self.bound_max, dtype=np.float64).tobytes(),
+            np.float64(self.RESIDUAL_COST_THR).tobytes(),
+            f"{self.precision}:{self.solver}:{self.analytic_jac}:".encode(),
+        ])
 
     def getBaseCase(self):
-        return [
-            {
-                'cartesian_product': [],
-                'combined_cluster_cost': np.nan,
-                'location': np.nan,
-                'residual_cost': np.nan,
-                'rx_locs': [],
-                'tx_locs': [],
-                'tx_indices': [],
-                'num_zero_cand': 0,
-                'num_one_cand': 0,
-                'num_two_cand': 0,
-            },
-        ]
+        base = CandidateSet(1, self.dtype)
+        base.append(np.nan, np.nan, np.nan, 0, IntersectionHistory.ROOT)
+        return base
 
     # Public facing function
     def process_new_measurement(
@@ -56,39 +463,94 @@ class MultiFusion:
         clusters,
         rx_loc,
         tx_loc,
+        meas_id=None,
     ):
-        """Compute localization algo based on a new measurement"""
-        self.num_of_rx = self.num_of_rx + 1
-        cur = {}
+        """
+        Compute localization algo based on a new measurement.  meas_id
+        identifies the measurement for the intersection cache, it
+        defaults to the arrival order.
+        """
+        with metrics.span('process_new_measurement'):
+            if metrics.enabled:
+                before = self.metricCounters()
+            start = time.perf_counter()
+            self.num_of_rx = self.num_of_rx + 1
+            self.history.add_measurement(rx_loc, tx_loc, meas_id)
+            self.last_gate_stats = {}
+            if self.precheck:
+                self.cluster_feasible = self.feasibleClusters(
+                    clusters, rx_loc, tx_loc)
+            cur = {}
 
-        k = self.num_of_rx
+            k = self.num_of_rx
 
-        while k >= 0:
-            if k == 0:
-                cur[0] = self.getBaseCase()
-                break
+            while k >= 0:
+                if k == 0:
+                    cur[0] = self.getBaseCase()
+                    break
 
+                if (self.time_budget is not None
+                        and time.perf_counter() - start > self.time_budget):
+                    # Out of time: S(n, k) for the remaining k keep the
+                    # intersections of S(n-1, k), without the new measurement
+                    self.prune_stats['time_budget_stops'] += 1
+                    for j in range(k, 0, -1):
+                        if j in self.prev:
+                            cur[j] = self.prev[j]
+                    cur[0] = self.getBaseCase()
+                    break
 
-            # The main recursive definition.
-            cur[k] = self.prev[k].copy() if k in self.prev else []
-            if k-1 in self.prev:
-                cur[k] += self.intersect(
-                    k,
-                    clusters,
-                    rx_loc,
-                    tx_loc,
-                    self.prev[k-1].copy(),
-                )
 
-            cur[k].sort(key=lambda p: p['residual_cost'])
+                # The main recursive definition.
+                new_solutions = None
+                if k-1 in self.prev:
+                    with metrics.span('intersect'):
+                        new_solutions = self.intersect(
+                            k,
+                            clusters,
+                            rx_loc,
+                            tx_loc,
+                            self.prev[k-1],
+                        )
+                cur[k] = CandidateSet.concatenate(
+                    [self.prev.get(k), new_solutions]).sorted_by_residual()
 
-            if self.stopCondition(k, cur[k]):
-                break
-            else:
-                k -= 1
+                if self.stopCondition(k, cur[k]):
+                    metrics.count('stop_condition.hits')
+                    break
+                else:
+                    k -= 1
+
+            # On a stop S(n-1, j) for j < k is not carried over
+            dropped = any(len(solutions) for j, solutions in self.prev.items()
+                          if j not in cur)
+            self.prev = cur
+            with metrics.span('prune'):
+                self.prune(compact=dropped)
+            if metrics.enabled:
+                self.recordMetrics(before)
+
+    def metricCounters(self):
+        """Cumulative stats reported as metrics, see recordMetrics()"""
+        return {
+            **{'gate.' + key: val for key, val in self.gate_stats.items()},
+            **{'least_squares.' + key: val for key, val in self.ls_stats.items()},
+            **{'prune.' + key: val for key, val in self.prune_stats.items()},
+            **{'feasibility.' + key: val
+               for key, val in self.feasibility_stats.items()},
+        }
 
-        self.prev = cur
-        self.prune()
+    def recordMetrics(self, before):
+        """
+        Count what changed since before = metricCounters() and the
+        candidate count of each k
+        """
+        for key, val in self.metricCounters().items():
+            metrics.count(key, val - before[key])
+        for k, solutions in self.prev.items():
+            metrics.gauge(f'candidates.k{k}', len(solutions))
+        metrics.gauge('candidates.total',
+                      sum(len(solutions) for solutions in self.prev.values()))
 
     def stopCondition(self, k, solutions):
         """
@@ -102,7 +564,7 @@ class MultiFusion:
         if not solutions:
             return False
 
-        min_p_cost = solutions[0]['residual_cost']
+        min_p_cost = solutions.residual_cost[0]
         min_p_cost = np.log(min_p_cost)
         
         if (min_p_cost < self.ABSOLUTE_RESIDUAL_THRESHOLD):
@@ -110,16 +572,26 @@ class MultiFusion:
             pass
         return (min_p_cost < self.ABSOLUTE_RESIDUAL_THRESHOLD)
 
-    def prune(self):
+    def prune(self, compact=False):
         """
         Remove unnecessary location intersections based on valid or
-        too close to each other.
+        too close to each other, then apply the beam width and the
+        candidate budget.  The history nodes of the candidates cut (or
+        of candidates already dropped, with compact) are removed, so the
+        history stays the size of the live candidates.
         """
+        n_before = sum(len(solutions) for solutions in self.prev.values())
 
         for k in self.prev.keys():
             before = len(self.prev[k])
             # self.pruneOnlyValidIntersections(k)
-            # self.pruneDeduplicateCloseIntersections(k)
+            if self.dedup:
+                self.pruneDeduplicateCloseIntersections(k)
+                self.prune_stats['dedup'] += before - len(self.prev[k])
+            if self.beam_width is not None:
+                n = len(self.prev[k])
+                self.pruneBeam(k)
+                self.prune_stats['beam'] += n - len(self.prev[k])
             # if len(self.prev[k]) > 0:
             #     print(
             #         "N ", self.num_of_rx,
@@ -129,6 +601,13 @@ class MultiFusion:
             #         "length after pruned" , len(self.prev[k]),
             #     )
 
+        if self.max_candidates is not None:
+            self.pruneBudget()
+
+        if compact or sum(len(solutions)
+                          for solutions in self.prev.values()) < n_before:
+            self.compactHistory()
+
     def pruneOnlyValidIntersections(self, k):
         if (k <=2):
             return
@@ -136,18 +615,15 @@ class MultiFusion:
         if not self.prev[k]:
             return
 
-        min_p_cost = self.prev[k][0]['residual_cost']
+        solutions = self.prev[k]
+        min_p_cost = solutions.residual_cost[0]
         min_p_cost = np.log(min_p_cost)
 
-        pruned = []
-
         # Remove solutions that are much greater than the minimum.
-        for solution in self.prev[k]:
-            cost = np.log(solution['residual_cost'])
-            if cost < self.REALLY_GOOD_RESIDUAL_PERCENTAGE * min_p_cost:
-                pruned.append(solution)
+        cost = np.log(solutions.residual_cost[:len(solutions)])
+        keep = cost < self.REALLY_GOOD_RESIDUAL_PERCENTAGE * min_p_cost
 
-        self.prev[k] = pruned
+        self.prev[k] = solutions.take(np.flatnonzero(keep))
 
     def pruneDeduplicateCloseIntersections(self, k):
         if (k <=2):
@@ -156,23 +632,86 @@ class MultiFusion:
         if not self.prev[k]:
             return
 
-        pruned = []
-
-        # Remove solutions that are close to existing solutions.
-        for solution in self.prev[k]:
-            close_found = False
-            for other_solution in pruned:
-                distance = np.linalg.norm(
-                    np.array(other_solution['location']) - np.array(solution['location'])
-                )
-                if distance < self.PRUNE_CLOSE_DISTANCE_THRESHOLD: # Less than a centimeter
-                    close_found = True
-                    break
+        solutions = self.prev[k]
+        locations = solutions.location[:len(solutions)]
+        finite = np.flatnonzero(np.all(np.isfinite(locations), axis=1))
+
+        # Remove solutions that are close to a better solution that is
+        # kept.  Only pairs closer than the threshold are visited, found
+        # with a KD-tree instead of comparing every pair.
+        import scipy.spatial
+        tree = scipy.spatial.cKDTree(locations[finite])
+        pairs = tree.query_pairs(self.PRUNE_CLOSE_DISTANCE_THRESHOLD,
+                                 output_type='ndarray')
+        if pairs.shape[0] == 0:
+            return
+        pairs = finite[pairs]
+        # Less than a centimeter (query_pairs includes the threshold)
+        distance = np.linalg.norm(
+            locations[pairs[:, 0]] - locations[pairs[:, 1]], axis=1)
+        pairs = pairs[distance < self.PRUNE_CLOSE_DISTANCE_THRESHOLD]
+
+        # Solutions are sorted, so within a pair the lower index is better.
+        # Visit the later solution of each pair in order and drop it if
+        # its better neighbour is kept.
+        pairs = np.sort(pairs, axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+        keep = np.ones(len(solutions), dtype=bool)
+        for better, worse in pairs:
+            if keep[better]:
+                keep[worse] = False
+
+        self.prev[k] = solutions.take(np.flatnonzero(keep))
 
-            if not close_found:
-                pruned.append(solution)
+    def beamWidth(self, k):
+        """Beam width for k, None if unlimited"""
+        if isinstance(self.beam_width, dict):
+            return self.beam_width.get(k)
+        return self.beam_width
 
-        self.prev[k] = pruned
+    def pruneBeam(self, k):
+        """
+        Keep the beamWidth(k) intersections with the lowest residual, for
+        k >= MIN_RANKED_K
+        """
+        if k < self.MIN_RANKED_K:
+            return
+
+        width = self.beamWidth(k)
+        if width is None or len(self.prev[k]) <= width:
+            return
+        self.prev[k] = self.prev[k].take(np.arange(width))
+
+    def pruneBudget(self):
+        """
+        Cut the largest S(n, k) (k >= MIN_RANKED_K) to a common size so
+        that at most max_candidates of their intersections are kept in
+        total.  Each set keeps its best intersections.
+        """
+        ks = [k for k in self.prev.keys() if k >= self.MIN_RANKED_K]
+        sizes = np.array([len(self.prev[k]) for k in ks], dtype=np.int64)
+        if sizes.sum() <= self.max_candidates:
+            return
+
+        # Largest cap with sum(min(size, cap)) <= max_candidates
+        low, high = 0, int(sizes.max())
+        while low < high:
+            mid = (low + high + 1) // 2
+            if np.minimum(sizes, mid).sum() <= self.max_candidates:
+                low = mid
+            else:
+                high = mid - 1
+        cap = low
+        cap_sizes = np.minimum(sizes, cap)
+        remaining = self.max_candidates - cap_sizes.sum()
+        # Sets above the cap share what is left, one more each in k order
+        for i in np.flatnonzero(sizes > cap)[:remaining]:
+            cap_sizes[i] += 1
+
+        for k, size, cap_size in zip(ks, sizes, cap_sizes):
+            if cap_size < size:
+                self.prev[k] = self.prev[k].take(np.arange(cap_size))
+                self.prune_stats['budget'] += int(size - cap_size)
 
     def intersect(
         self,
@@ -182,91 +721,211 @@ class MultiFusion:
         tx_loc,
         prev_solutions,
     ):
-        solutions = []
-
-        # Intersect with all previous solutions.
-        for prev_solution in prev_solutions:
-            prev_cartesian_product = prev_solution['cartesian_product']
-            prev_rx_locs = prev_solution['rx_locs']
-            rx_locs = prev_rx_locs.copy()
-            rx_locs.append(rx_loc)
-            prev_tx_locs = prev_solution['tx_locs']
-            tx_locs = prev_tx_locs.copy()
-            tx_locs.append(tx_loc)
-            prev_tx_indices = prev_solution['tx_indices']
-            tx_indices = prev_tx_indices.copy()
-            tx_indices.append(self.num_of_rx)
-
-            for cluster_ind, cluster in enumerate(clusters):
-                num_zero_cand = prev_solution['num_zero_cand'] + (1 if cluster_ind == 0 else 0)
-                num_one_cand = prev_solution['num_one_cand'] + (1 if cluster_ind == 1 else 0)
-                num_two_cand = prev_solution['num_two_cand'] + (1 if cluster_ind == 2 else 0)
-
-                if (not np.isfinite(cluster[0])):
-                    continue
-
-                cartesian_product = prev_cartesian_product.copy()
-                cartesian_product.append(cluster)
-                combined_cluster_cost = np.sum(cartesian_product, axis=0)[1]
-
-                # Find the intersection.
-
-                est_loc = self.findIntersection(
-                    prev_solution['location'],
-                    cluster[0],
-                    np.array(cartesian_product)[:,0],
-                    np.array(rx_locs),
-                    np.array(tx_locs),
-                )
-
-                # If valid intersection
-                if est_loc is not None:
-                    # (loc, residual_cost) = est_loc
-                    loc, residual_cost = est_loc[:-1], est_loc[-1]
-
-                    solutions.append({
-                        'cartesian_product': cartesian_product,
-                        'combined_cluster_cost': combined_cluster_cost,
-                        'location': loc,
-                        'residual_cost': residual_cost,
-                        'rx_locs': rx_locs,
-                        'tx_locs': tx_locs,
-                        'num_zero_cand': num_zero_cand,
-                        'num_one_cand': num_one_cand,
-                        'num_two_cand': num_two_cand,
-                        'tx_indices': tx_indices,
-                    })
+        n_prev = len(prev_solutions)
+        meas_index = self.history.num_meas - 1
+        clusters = np.asarray(clusters, dtype=self.dtype)
+        rx_loc = np.asarray(rx_loc, dtype=self.dtype)
+        tx_loc = np.asarray(tx_loc, dtype=self.dtype)
+
+        # Only pairs that survive the early rejection gate get a least
+        # squares solve.
+        gate = self.earlyRejection(
+            k,
+            prev_solutions.location[:n_prev],
+            clusters,
+            rx_loc,
+            tx_loc,
+        )
+        surv_prev, surv_cluster = np.nonzero(gate)
+        n_surv = surv_prev.shape[0]
+        solutions = CandidateSet(n_surv, self.dtype)
+        if n_surv == 0:
+            return solutions
+
+        # Recover the measurements used by every previous solution at once
+        # instead of carrying copied lists around.
+        path = self.history.walk(prev_solutions.node[:n_prev], k - 1)
+        prev_meas = self.history.meas_index[path[surv_prev]]
+
+        # One row per surviving (previous solution, cluster) pair, in
+        # (previous solution, cluster) order.
+        surv_clusters = clusters[surv_cluster]
+        final_dists = np.hstack((
+            self.history.cluster[path[surv_prev], 0],
+            surv_clusters[:, :1],
+        ))
+        rx_locs = np.concatenate((
+            self.history.rx_locs[prev_meas],
+            np.broadcast_to(rx_loc, (n_surv, 1, 3)),
+        ), axis=1)
+        tx_locs = np.concatenate((
+            self.history.tx_locs[prev_meas],
+            np.broadcast_to(tx_loc, (n_surv, 1, 3)),
+        ), axis=1)
+
+        cand_counts = prev_solutions.cand_counts[surv_prev]
+        counted = surv_cluster < cand_counts.shape[1]
+        cand_counts[np.flatnonzero(counted), surv_cluster[counted]] += 1
+
+        parents = prev_solutions.node[surv_prev]
+        combined_cluster_cost = np.where(
+            parents == IntersectionHistory.ROOT,
+            surv_clusters[:, 1],
+            prev_solutions.combined_cluster_cost[surv_prev] + surv_clusters[:, 1],
+        )
+
+        # Find the intersections, reusing the ones already solved for the
+        # same measurement subset.
+        prev_locations = prev_solutions.location[surv_prev]
+        # With warm_start a solution depends on the previous location it
+        # starts from, which differs between shuffles: nothing to share
+        if self.cache is not None and k > 2 and not self.warm_start:
+            meas_ids = np.hstack((
+                self.history.meas_ids[prev_meas],
+                np.full((n_surv, 1), self.history.meas_ids[meas_index]),
+            ))
+            cluster_indices = np.hstack((
+                self.history.cluster_index[path[surv_prev]],
+                surv_cluster[:, None],
+            ))
+            keys = self.cache.make_keys(meas_ids, cluster_indices,
+                                        self.cacheContext())
+            locs, residual_costs, valid, todo = self.cache.lookup(keys)
+            (locs[todo], residual_costs[todo], valid[todo]) = self.solveIntersections(
+                prev_locations[todo],
+                final_dists[todo],
+                rx_locs[todo],
+                tx_locs[todo],
+            )
+            self.cache.store(
+                [keys[i] for i in todo],
+                locs[todo],
+                residual_costs[todo],
+                valid[todo],
+            )
+        else:
+            locs, residual_costs, valid = self.solveIntersections(
+                prev_locations,
+                final_dists,
+                rx_locs,
+                tx_locs,
+            )
+
+        valid = np.flatnonzero(valid)
+        nodes = self.history.add_nodes(
+            parents[valid],
+            meas_index,
+            surv_cluster[valid],
+            surv_clusters[valid],
+        )
+        solutions.extend(
+            locs[valid],
+            residual_costs[valid],
+            combined_cluster_cost[valid],
+            cand_counts[valid],
+            nodes,
+        )
 
         return solutions
 
+    def feasibleClusters(self, clusters, rx_loc, tx_loc):
+        """
+        Clusters of a new measurement whose ellipsoid can pass through the
+        bounds, up to FEASIBILITY_TOLERANCE of bistatic distance.  No
+        intersection with the others is tried, at any k.
+
+        Returns: (n_clusters, ) bool array
+        """
+        dists = np.asarray(clusters, dtype=float)[:, 0]
+        feasible = feasibility.box_feasible(
+            tx_loc, rx_loc, dists, self.bound_min, self.bound_max,
+            tolerance=self.FEASIBILITY_TOLERANCE)
+        finite = np.isfinite(dists)
+        self.feasibility_stats['clusters'] += int(np.count_nonzero(finite))
+        self.feasibility_stats['outside_bounds'] += int(
+            np.count_nonzero(finite & ~feasible))
+        return feasible
+
+    def earlyRejection(
+        self,
+        k,
+        prev_locations,
+        clusters,
+        rx_loc,
+        tx_loc,
+    ):
+        """
+        Early return without running least_squares method, for every
+        (previous solution, cluster) pair of a new measurement at once.
+
+        A pair is rejected if the bistatic distance from the new rx/tx
+        to the previous intersection is much different from the cluster
+        distance.  Clusters with non-finite distance are skipped, and so
+        are clusters outside the bounds (see feasibleClusters()).  With
+        the precheck on, clusters whose ellipsoid passes nowhere near the
+        previous intersections are rejected for all of them at once
+        (counted as far), without computing the distances.
+
+        Returns: (n_prev, n_clusters) bool array, True where least
+        squares should run
+        """
+        dists = clusters[:, 0]
+        finite = np.isfinite(dists)
+        usable = finite
+        if self.cluster_feasible is not None:
+            usable = finite & self.cluster_feasible
+        gate = np.repeat(usable[None, :], prev_locations.shape[0], axis=0)
+
+        # Previous locations are nan below three measurements, so those
+        # pairs always pass.
+        rows = np.flatnonzero(np.all(np.isfinite(prev_locations), axis=1))
+        cols = usable
+        n_far = 0
+        if self.precheck and rows.size:
+            cols = usable & feasibility.near_locations(
+                tx_loc, rx_loc, dists, prev_locations[rows],
+                self.DISTANCE_THRESHOLD)
+            n_far = int(np.count_nonzero(usable & ~cols)) * rows.size
+            gate[np.ix_(rows, usable & ~cols)] = False
+        new_oob_to_prev = (np.linalg.norm(prev_locations[rows] - rx_loc, axis=1)
+                           + np.linalg.norm(prev_locations[rows] - tx_loc, axis=1))
+        err = np.abs(new_oob_to_prev[:, None] - dists[None, cols])
+        rejected = err > self.DISTANCE_THRESHOLD
+        gate[np.ix_(rows, np.flatnonzero(cols))] = ~rejected
+
+        stats = {
+            'pairs': gate.size,
+            'non_finite': int(np.count_nonzero(~finite)) * gate.shape[0],
+            'infeasible': int(np.count_nonzero(finite & ~usable)) * gate.shape[0],
+            'rejected': int(np.count_nonzero(rejected)) + n_far,
+            'far': n_far,
+            'solved': int(np.count_nonzero(gate)),
+        }
+        for key, val in stats.items():
+            self.gate_stats[key] += val
+        self.last_gate_stats[k] = stats
+        return gate
+
     def findIntersection(
         self,
         prev_location,
-        cluster_distance,
         final_dists,
         rx_locs,
         tx_locs,
     ):
+        """
+        Intersect a (previous solution, cluster) pair that already passed
+        earlyRejection().
+        """
         if len(final_dists) <= 2:
             return (np.nan, np.nan)
 
-        # Step 1: Early return without running least_squares method.
-        # Check if the point is much further away from previous intersection.
-        prev_location = np.array(prev_location)
-        rx_loc = np.array(rx_locs[-1])
-        tx_loc = np.array(tx_locs[-1])
-        new_oob_to_prev = np.linalg.norm(prev_location - rx_loc) + np.linalg.norm(prev_location - tx_loc)
-        err = np.abs(new_oob_to_prev - cluster_distance)
-        # if self.run_early_return and err > self.DISTANCE_THRESHOLD:
-        if err > self.DISTANCE_THRESHOLD:
-            # pass
-            # print(f'Not running intersection for {len(tx_locs)}')
-            return None
-
-        # Step 2: Actually check intersection with least square
+        # Actually check intersection with least square
         guess = (self.bound_min + self.bound_max) / 2.0
         # tx_locs = np.tile(self.tx_loc, (rx_locs.shape[0], 1))
         cal_loc = guess
+        if self.warm_start and np.all(np.isfinite(prev_location)):
+            guess = np.clip(prev_location, self.bound_min, self.bound_max)
         est_loc = single_least_squares(
             final_dists,
             guess,
@@ -275,27 +934,107 @@ class MultiFusion:
             cal_loc,
             rx_locs.shape[0],
             cost_thresh=self.RESIDUAL_COST_THR,
+            analytic_jac=self.analytic_jac,
+            stats=self.ls_stats,
             bounds=(self.bound_min, self.bound_max),
         )
-        # print("error ", err, "est_loc", est_loc)
         return est_loc
 
 
+    def solveIntersections(
+        self,
+        prev_locations,
+        final_dists,
+        rx_locs,
+        tx_locs,
+    ):
+        """
+        Solve a stack of (previous solution, cluster) pairs with the
+        configured solver, in float64 whatever the precision.
+
+        Returns: (locations, residual_costs, valid)
+        """
+        prev_locations, final_dists, rx_locs, tx_locs = (
+            np.asarray(arr, dtype=float)
+            for arr in (prev_locations, final_dists, rx_locs, tx_locs))
+        if self.solver == 'batch':
+            return self.findIntersections(
+                prev_locations,
+                final_dists,
+                rx_locs,
+                tx_locs,
+            )
+
+        n_pairs = final_dists.shape[0]
+        locs = np.full((n_pairs, 3), np.nan)
+        residual_costs = np.full(n_pairs, np.nan)
+        valid = np.zeros(n_pairs, dtype=bool)
+        for i in range(n_pairs):
+            est_loc = self.findIntersection(
+                prev_locations[i],
+                final_dists[i],
+                rx_locs[i],
+                tx_locs[i],
+            )
+            # If valid intersection
+            if est_loc is not None:
+                # (loc, residual_cost) = est_loc
+                locs[i], residual_costs[i] = est_loc[:-1], est_loc[-1]
+                valid[i] = True
+        return locs, residual_costs, valid
+
+    def findIntersections(
+        self,
+        prev_locations,
+        final_dists,
+        rx_locs,
+        tx_locs,
+    ):
+        """
+        Batched findIntersection() over a stack of pairs that all use the
+        same number of measurements.
+
+        Returns: (locations, residual_costs, valid)
+        """
+        n_pairs, k = final_dists.shape
+        if k <= 2:
+            return (np.full((n_pairs, 3), np.nan),
+                    np.full(n_pairs, np.nan),
+                    np.ones(n_pairs, dtype=bool))
+
+        guess = np.tile((self.bound_min + self.bound_max) / 2.0, (n_pairs, 1))
+        if self.warm_start:
+            warm = np.all(np.isfinite(prev_locations), axis=1)
+            guess[warm] = np.clip(prev_locations[warm], self.bound_min, self.bound_max)
+        result = batch_least_squares(
+            final_dists,
+            guess,
+            tx_locs,
+            rx_locs,
+            bounds=(self.bound_min, self.bound_max),
+        )
+        self.ls_stats['calls'] += n_pairs
+        self.ls_stats['nfev'] += int(np.sum(result['nfev']))
+        self.ls_stats['njev'] += int(np.sum(result['njev']))
+        self.ls_stats['residual_evals'] += int(np.sum(result['nfev']))
+
+        # Make sure answer not on any of the bounds (likely bad solution)
+        valid = (result['success']
+                 & (result['cost'] < self.RESIDUAL_COST_THR)
+                 & np.all(result['active_mask'] == 0, axis=1))
+        return result['x'], result['cost'], valid
+
     def get_best_location_per_k(self, k, solutions):
         if not solutions:
             return None
 
-        best = min(
-            solutions,
-            key=lambda p:
-                p['residual_cost']
-        )
+        best = np.argmin(solutions.residual_cost[:len(solutions)])
         return {
-            'location': best['location'],
-            'residual_cost': best['residual_cost'],
-            'combined_cluster_cost': best['combined_cluster_cost'],
+            'location': solutions.location[best],
+            'residual_cost': solutions.residual_cost[best],
+            'combined_cluster_cost': solutions.combined_cluster_cost[best],
             'k': k,
-            'norm_residual_cost': best['residual_cost'] / k
+            'norm_residual_cost': solutions.residual_cost[best] / k
         }
 
     # Public function.
@@ -321,30 +1060,43 @@ class MultiFusion:
         for k in self.prev.keys():
             if k < 3:
                 continue
-            for sol in self.prev[k]:
-                best_candidates.append({'location': sol['location'],
-                                        'tx_locs': sol['tx_locs'],
-                                        'num_zero_cand': sol['num_zero_cand'],
-                                        'num_one_cand': sol['num_one_cand'],
-                                        'num_two_cand': sol['num_two_cand'],
-                                        'combined_cluster_cost': sol['combined_cluster_cost'],
-                                        'residual_cost': sol['residual_cost'],
-                                        'tx_indices': sol['tx_indices']})
+            solutions = self.prev[k]
+            path = self.history.walk(solutions.node[:len(solutions)], k)
+            meas = self.history.meas_index[path]
+            for i in range(len(solutions)):
+                num_zero_cand, num_one_cand, num_two_cand = \
+                    solutions.cand_counts[i].tolist()
+                best_candidates.append({'location': solutions.location[i],
+                                        'tx_locs': list(self.history.tx_locs[meas[i]]),
+                                        'num_zero_cand': num_zero_cand,
+                                        'num_one_cand': num_one_cand,
+                                        'num_two_cand': num_two_cand,
+                                        'combined_cluster_cost': solutions.combined_cluster_cost[i],
+                                        'residual_cost': solutions.residual_cost[i],
+                                        'tx_indices': (meas[i] + 1).tolist()})
 
         return best_candidates
 
 
 
-def single_least_squares(dists, guess, tx_locs, rx_locs, cal_loc, num_oob_rx, cost_thresh=np.inf, **ls_kwargs):
+def single_least_squares(dists, guess, tx_locs, rx_locs, cal_loc, num_oob_rx, cost_thresh=np.inf,
+                         analytic_jac=False, stats=None, **ls_kwargs):
     """
         Takes the two integer wavelength distances from each OOB receiver
         and computes the most likely location
 
         dists:: n length ndarray : The distance from each OOB pair
         guess:: D length ndarray : Guessed distance to start each optimization
+        analytic_jac:: bool : Use the closed-form jacobian of the bistatic
+            distance instead of finite differences
+        stats:: dict or None : If given, 'calls', 'nfev', 'njev' and
+            'residual_evals' (every residual evaluation, including the ones
+            spent on finite differences) are accumulated into it
 
         Returns: D + 1 length ndarray:  dimensional location estimate, mean(abs(residuals))
     """
+    evals = [0]
+
     def get_dists(p):
         return np.linalg.norm(p - tx_locs[:num_oob_rx, :], axis=1) + np.linalg.norm(p - rx_locs[:num_oob_rx, :], axis=1)
 
@@ -352,15 +1104,176 @@ def single_least_squares(dists, guess, tx_locs, rx_locs, cal_loc, num_oob_rx, co
         # Returns residual function that corrects 2D estimates to work with 3D antennas location
         p_prime = cal_loc.copy()
         def residuals(p):
+            evals[0] += 1
             p_prime[:p.shape[0]] = p
             return (get_dists(p_prime) - dists)
         return residuals
 
+    def jacobian_maker():
+        # d/dp (|p - tx| + |p - rx|) = unit(p - tx) + unit(p - rx)
+        p_prime = cal_loc.copy()
+        tiny = np.finfo(float).tiny
+        def jacobian(p):
+            p_prime[:p.shape[0]] = p
+            to_tx = p_prime - tx_locs[:num_oob_rx, :]
+            to_rx = p_prime - rx_locs[:num_oob_rx, :]
+            jac = (to_tx / np.fmax(np.linalg.norm(to_tx, axis=1), tiny)[:, None]
+                   + to_rx / np.fmax(np.linalg.norm(to_rx, axis=1), tiny)[:, None])
+            return jac[:, :p.shape[0]]
+        return jacobian
+
+    if analytic_jac:
+        ls_kwargs['jac'] = jacobian_maker()
+    # Imported on first use, scipy.optimize is the slowest import of a
+    # cold start
+    import scipy.optimize
     p = scipy.optimize.least_squares(residual_maker(dists), guess, **ls_kwargs)
+    if stats is not None:
+        stats['calls'] += 1
+        stats['nfev'] += p.nfev
+        stats['njev'] += p.njev if p.njev is not None else 0
+        stats['residual_evals'] += evals[0]
     # print(p)
     # Make sure answer not on any of the bounds (likely bad solution)
     if p.success and p.cost < cost_thresh and np.all(p.active_mask == 0):
         # print(f'Success: {p.x}')
         return np.hstack((p.x, p.cost))
     else:
-        return None
\ No newline at end of file
+        return None
+
+
+def batch_least_squares(dists, guess, tx_locs, rx_locs, mask=None,
+                        bounds=(-np.inf, np.inf), ftol=1e-8, xtol=1e-8,
+                        gtol=1e-8, max_iter=200, lam0=1.0):
+    """
+        Solves a stack of bounded bistatic-distance least squares problems
+        in lockstep with a projected Levenberg-Marquardt iteration.  Each
+        problem minimizes the same cost as single_least_squares, i.e.
+        0.5 * sum((|p - tx| + |p - rx| - dist)^2).
+
+        dists:: (B, M) ndarray : The distance from each OOB pair, padded
+        guess:: (B, 3) or (3,) ndarray : Starting point of each problem
+        tx_locs, rx_locs:: (B, M, 3) ndarray : Antenna locations, padded
+        mask:: (B, M) bool ndarray or None : Which of the M measurements
+            belong to each problem, so problems with different measurement
+            counts can share one stack.  None means all of them.
+        bounds:: (lower, upper) : Box constraint, scalars or (3,) arrays
+        lam0:: float : Initial damping, relative to diag(J^T J)
+
+        Returns: dict of arrays with one row per problem
+            x:: (B, 3) location estimate
+            cost:: (B,) final cost, same definition as scipy
+            success:: (B,) converged before max_iter
+            active_mask:: (B, 3) -1 / 1 where x is on the lower / upper bound
+            status:: (B,) 1 gtol, 2 ftol, 3 xtol, 0 max_iter reached
+            nfev, njev:: (B,) residual / jacobian evaluations
+    """
+    dists = np.asarray(dists, dtype=float)
+    n_prob, n_meas = dists.shape
+    if mask is None:
+        mask = np.ones((n_prob, n_meas), dtype=bool)
+    weights = mask.astype(float)
+    dists = np.where(mask, dists, 0.0)
+    tx_locs = np.where(mask[..., None], tx_locs, 0.0)
+    rx_locs = np.where(mask[..., None], rx_locs, 0.0)
+    lb = np.broadcast_to(np.asarray(bounds[0], dtype=float), (3,))
+    ub = np.broadcast_to(np.asarray(bounds[1], dtype=float), (3,))
+    tiny = np.finfo(float).tiny
+
+    def evaluate(idx, p):
+        to_tx = p[:, None, :] - tx_locs[idx]
+        to_rx = p[:, None, :] - rx_locs[idx]
+        norm_tx = np.linalg.norm(to_tx, axis=2)
+        norm_rx = np.linalg.norm(to_rx, axis=2)
+        res = (norm_tx + norm_rx - dists[idx]) * weights[idx]
+        jac = (to_tx / np.fmax(norm_tx, tiny)[..., None]
+               + to_rx / np.fmax(norm_rx, tiny)[..., None]) * weights[idx][..., None]
+        return res, jac
+
+    x = np.clip(np.broadcast_to(guess, (n_prob, 3)), lb, ub).astype(float)
+    all_idx = np.arange(n_prob)
+    res, jac = evaluate(all_idx, x)
+    cost = 0.5 * np.sum(res ** 2, axis=1)
+    lam = np.full(n_prob, lam0)
+    lam_growth = np.full(n_prob, 2.0)
+    status = np.zeros(n_prob, dtype=np.int64)
+    nfev = np.ones(n_prob, dtype=np.int64)
+    njev = np.ones(n_prob, dtype=np.int64)
+    eye = np.eye(3)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(status == 0)
+        if idx.size == 0:
+            break
+        x_i, res_i, jac_i, cost_i = x[idx], res[idx], jac[idx], cost[idx]
+
+        grad = np.einsum('bmi,bm->bi', jac_i, res_i)
+        # Gradient components pushing out of an active bound can't be
+        # followed, so they don't count against convergence.
+        blocked = (((x_i <= lb) & (grad > 0)) | ((x_i >= ub) & (grad < 0)))
+        grad_conv = np.max(np.abs(np.where(blocked, 0.0, grad)), axis=1) < gtol
+
+        jtj = np.einsum('bmi,bmj->bij', jac_i, jac_i)
+        damping = lam[idx, None, None] * (
+            np.diagonal(jtj, axis1=1, axis2=2)[:, :, None] * eye + 1e-12 * eye)
+        # Blocked variables stay on their bound, the step is solved in the
+        # remaining free variables only.
+        free = ~blocked
+        system = np.where(free[:, :, None] & free[:, None, :], jtj + damping, eye)
+        rhs = np.where(free, -grad, 0.0)
+        step = np.linalg.solve(system, rhs[..., None])[..., 0]
+        x_new = np.clip(x_i + step, lb, ub)
+        res_new, jac_new = evaluate(idx, x_new)
+        cost_new = 0.5 * np.sum(res_new ** 2, axis=1)
+        nfev[idx] += 1
+
+        improved = cost_new < cost_i
+        # Gain ratio of the actual to the linearly predicted reduction
+        taken = x_new - x_i
+        predicted = -(np.einsum('bi,bi->b', grad, taken)
+                      + 0.5 * np.einsum('bi,bij,bj->b', taken, jtj, taken))
+        gain = np.clip((cost_i - cost_new) / np.fmax(predicted, tiny), -1.0, 2.0)
+        f_conv = improved & (cost_i - cost_new < ftol * cost_i)
+        x_conv = (improved & (np.linalg.norm(x_new - x_i, axis=1)
+                              < xtol * (xtol + np.linalg.norm(x_i, axis=1))))
+        # No step improves the cost any more, the trust region has
+        # collapsed onto x (scipy reports this as xtol).
+        stalled = ~improved & (lam[idx] > 1e12)
+
+        take = idx[improved]
+        x[take] = x_new[improved]
+        res[take] = res_new[improved]
+        jac[take] = jac_new[improved]
+        cost[take] = cost_new[improved]
+        njev[take] += 1
+        # Nielsen's damping update
+        lam[idx] = np.where(
+            improved,
+            np.fmax(lam[idx] * np.fmax(1 / 3, 1 - (2 * gain - 1) ** 3), 1e-12),
+            lam[idx] * lam_growth[idx],
+        )
+        lam_growth[idx] = np.where(improved, 2.0, lam_growth[idx] * 2.0)
+
+        new_status = np.zeros(idx.size, dtype=np.int64)
+        new_status[x_conv | stalled] = 3
+        new_status[f_conv] = 2
+        new_status[grad_conv] = 1
+        status[idx] = new_status
+
+    # Same test as scipy's find_active_constraints with rtol=xtol
+    lower_dist, upper_dist = x - lb, ub - x
+    lower_thr = xtol * np.maximum(1, np.abs(lb))
+    upper_thr = xtol * np.maximum(1, np.abs(ub))
+    active_mask = np.zeros((n_prob, 3), dtype=np.int64)
+    active_mask[np.isfinite(lb) & (lower_dist <= np.minimum(upper_dist, lower_thr))] = -1
+    active_mask[np.isfinite(ub) & (upper_dist <= np.minimum(lower_dist, upper_thr))] = 1
+
+    return {
+        'x': x,
+        'cost': cost,
+        'success': status > 0,
+        'active_mask': active_mask,
+        'status': status,
+        'nfev': nfev,
+        'njev': njev,
+    }
@@ -0,0 +1,193 @@
+"""
+Reader pose lookup for measurement timestamps.
+
+IntermediateLocationsFunction joins every measurement to the updater
+pose with its own UpdaterHistoricalTable query (+-10 ms window, latest
+pose).  A PoseIndex holds the pose stream of one device as sorted
+timestamp / position / quaternion arrays instead, and answers a whole
+batch of measurement timestamps at once: positions are interpolated
+linearly and orientations with slerp between the samples around each
+timestamp, found with a vectorized bisect (np.searchsorted).
+
+Where the samples around a timestamp are more than max_gap_ms apart,
+or it is before the first / after the last sample, the nearest sample is
+held if it is at most max_hold_ms away.  Otherwise the timestamp has no
+pose (stale).
+
+query_pose_index() fills an index with one paginated range Query per
+device and batch.
+"""
+
+import numpy as np
+
+# Defaults of PoseIndex.lookup().  Interpolate between samples at most
+# POSE_MAX_GAP_MS apart, otherwise hold the nearest sample up to
+# POSE_MAX_HOLD_MS away (the window of the Java join).
+POSE_MAX_GAP_MS = 200.0
+POSE_MAX_HOLD_MS = 10.0
+
+# Above this quaternion dot product slerp falls back to normalized lerp
+SLERP_LINEAR_DOT = 0.9995
+
+# Pose attributes of UpdaterHistoricalTable items, either in an
+# Updater_pose map or as pose_x, pose_y, ... attributes
+POSE_KEYS = ("x", "y", "z", "qx", "qy", "qz", "qw")
+
+
+def slerp(q0, q1, u):
+    """
+    Spherical linear interpolation between (n, 4) [qx,qy,qz,qw] unit
+    quaternions, u in [0, 1] of shape (n, ).  Takes the short way round.
+    """
+    q0 = np.asarray(q0, dtype=float)
+    q1 = np.asarray(q1, dtype=float)
+    u = np.asarray(u, dtype=float)[:, None]
+    dot = np.sum(q0 * q1, axis=1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+
+    linear = dot > SLERP_LINEAR_DOT
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.where(linear, 1.0, np.sin(theta))
+    w0 = np.where(linear, 1 - u, np.sin((1 - u) * theta) / sin_theta)
+    w1 = np.where(linear, u, np.sin(u * theta) / sin_theta)
+    out = w0 * q0 + w1 * q1
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+class PoseIndex:
+    """
+    Pose stream of one device in timestamp order.
+
+    times: (n, ) milliseconds
+    positions: (n, 3)
+    quats: (n, 4) unit [qx,qy,qz,qw]
+    """
+
+    def __init__(self, timestamps=(), poses=()):
+        self.times = np.empty(0)
+        self.positions = np.empty((0, 3))
+        self.quats = np.empty((0, 4))
+        self.extend(timestamps, poses)
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def extend(self, timestamps, poses):
+        """
+        Add (m, ) timestamps and (m, 7) [x,y,z,qx,qy,qz,qw] poses.  A
+        timestamp already in the index keeps its first pose.
+        """
+        timestamps = np.asarray(timestamps, dtype=float).reshape(-1)
+        poses = np.asarray(poses, dtype=float).reshape(-1, 7)
+        if timestamps.shape[0] == 0:
+            return
+        quats = poses[:, 3:] / np.linalg.norm(poses[:, 3:], axis=1, keepdims=True)
+
+        times = np.concatenate([self.times, timestamps])
+        positions = np.concatenate([self.positions, poses[:, :3]])
+        quats = np.concatenate([self.quats, quats])
+        # np.unique keeps the first of equal timestamps, the existing one
+        times, first = np.unique(times, return_index=True)
+        self.times = times
+        self.positions = positions[first]
+        self.quats = quats[first]
+
+    @classmethod
+    def from_items(cls, items):
+        """PoseIndex of UpdaterHistoricalTable items (low level format)"""
+        timestamps = []
+        poses = []
+        for item in items:
+            timestamps.append(_number(item["Timestamp"]))
+            if "Updater_pose" in item:
+                pose = item["Updater_pose"]["M"]
+                poses.append([_number(pose[key]) for key in POSE_KEYS])
+            else:
+                poses.append([_number(item["pose_" + key]) for key in POSE_KEYS])
+        return cls(timestamps, poses)
+
+    def lookup(self, timestamps, max_gap_ms=POSE_MAX_GAP_MS,
+               max_hold_ms=POSE_MAX_HOLD_MS):
+        """
+        Poses at (m, ) timestamps.
+
+        Returns: (poses, valid)
+            poses: (m, 7) [x,y,z,qx,qy,qz,qw], nan where not valid
+            valid: (m, ) False for stale timestamps
+        """
+        timestamps = np.asarray(timestamps, dtype=float).reshape(-1)
+        poses = np.full((timestamps.shape[0], 7), np.nan)
+        valid = np.zeros(timestamps.shape[0], dtype=bool)
+        n = len(self)
+        if n == 0:
+            return poses, valid
+
+        # Index of the first sample after each timestamp
+        after = np.searchsorted(self.times, timestamps, side="right")
+        before = after - 1
+
+        # Interpolate between the samples around the timestamp
+        inside = (after > 0) & (after < n)
+        rows = np.flatnonzero(inside)
+        i0, i1 = before[rows], after[rows]
+        gap = self.times[i1] - self.times[i0]
+        close = gap <= max_gap_ms
+        rows, i0, i1, gap = rows[close], i0[close], i1[close], gap[close]
+        u = (timestamps[rows] - self.times[i0]) / gap
+        poses[rows, :3] = (self.positions[i0]
+                           + u[:, None] * (self.positions[i1] - self.positions[i0]))
+        poses[rows, 3:] = slerp(self.quats[i0], self.quats[i1], u)
+        valid[rows] = True
+
+        # Otherwise hold the nearest sample, if close enough
+        prev = np.clip(before, 0, n - 1)
+        next_ = np.clip(after, 0, n - 1)
+        nearest = np.where(np.abs(timestamps - self.times[prev])
+                           <= np.abs(self.times[next_] - timestamps), prev, next_)
+        held = ~valid & (np.abs(timestamps - self.times[nearest]) <= max_hold_ms)
+        poses[held, :3] = self.positions[nearest[held]]
+        poses[held, 3:] = self.quats[nearest[held]]
+        valid |= held
+        return poses, valid
+
+
+def _number(attr):
+    """Number of an N, or S (UpdaterHistoricalTable Timestamp), attribute"""
+    (kind, val), = attr.items()
+    if kind not in ("N", "S"):
+        raise ValueError(f"Expected a number, got a {kind} attribute")
+    return float(val)
+
+
+def query_pose_index(ddb_client, table_name, device_id, start_ms, end_ms,
+                     timestamp_type="S"):
+    """
+    PoseIndex of the poses of device_id between start_ms and end_ms
+    (inclusive), read with one paginated Query.  timestamp_type is the
+    DynamoDB type of the Timestamp sort key, S (13 digit milliseconds)
+    in template.yaml.
+    """
+    def key(ms):
+        return {timestamp_type: str(int(ms))}
+
+    items = []
+    request = {
+        "TableName": table_name,
+        "KeyConditionExpression":
+            "Device_id = :device_id AND #ts BETWEEN :start AND :end",
+        "ExpressionAttributeNames": {"#ts": "Timestamp"},
+        "ExpressionAttributeValues": {
+            ":device_id": {"S": device_id},
+            ":start": key(np.floor(start_ms)),
+            ":end": key(np.ceil(end_ms)),
+        },
+        "ConsistentRead": True,
+    }
+    while True:
+        response = ddb_client.query(**request)
+        items += response.get("Items", [])
+        if not response.get("LastEvaluatedKey"):
+            break
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return PoseIndex.from_items(items)
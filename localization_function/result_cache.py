@@ -0,0 +1,244 @@
+"""
+Localization results cached by a fingerprint of their inputs.
+
+Stream retries and overlapping batches hand the same measurements of a
+tag to the handler more than once.  The result of target_localize_queue
+/ self_localize_queue only depends on the measurements, the geometry (TX
+poses, or the reference tag locations), the config and the tracking
+prior if any, so their SHA-256 fingerprint keys the location (or None,
+no location) found the first time and a repeat returns it without
+localizing again.  Measurements are hashed as they are stored (binary
+or JSON), without decoding them.
+
+ResultCache keeps results in the process for ttl_s seconds, at most
+max_entries of them (least recently used evicted first), in front of an
+optional shared backend that the workers of a function read and write.
+A backend is anything with get(key) / put(key, blob), such as the
+fusion_state stores: MemoryStateStore as the local stand-in, or
+DynamoStateStore over a DynamoDB table.  Entries carry their creation
+time, so the TTL also holds for entries read from the backend.
+"""
+
+import collections
+import hashlib
+import json
+import time
+
+import numpy as np
+
+import localize_utils
+import metrics
+
+# Results older than this are recomputed
+RESULT_CACHE_TTL_S = 600.0
+# Most results kept in the process
+RESULT_CACHE_SIZE = 1024
+
+# Changing the fingerprint or the stored format invalidates old entries
+RESULT_CACHE_VERSION = 2
+
+# Config values that do not change the location, left out of the
+# fingerprint
+IGNORED_CONFIG_KEYS = ("shuffle_workers", "intersection_cache_size",
+                       "precision_radius")
+
+
+# ---------------------------- Fingerprints ---------------------------- #
+
+def _update_array(digest, arr, dtype):
+    # Cast to a fixed dtype, so the same values hash the same whatever
+    # array type they came in
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    digest.update(repr(arr.shape).encode())
+    digest.update(arr.tobytes())
+
+
+def _update_measurement(digest, val, dtype):
+    """
+    Hash a stored measurement without decoding it: encoded bytes and JSON
+    text as they are, arrays and lists by their values.  The same values
+    in another format hash differently, which only costs a recomputation
+    (a retry delivers the same format).
+    """
+    if isinstance(val, str):
+        val = val.encode()
+    elif not isinstance(val, (bytes, bytearray, memoryview)):
+        digest.update(b"array")
+        _update_array(digest, val, dtype)
+        return
+    digest.update(f"bytes{len(val)}:".encode())
+    digest.update(val)
+
+
+def _json_default(val):
+    if isinstance(val, (np.ndarray, np.generic)):
+        return val.tolist()
+    raise TypeError(f"Cannot fingerprint {type(val)}")
+
+
+def fingerprint(kind, data_queue, geometry, config, prior=None):
+    """
+    Hex SHA-256 of a localization call.  kind names the function,
+    geometry is the (n, ...) float array of poses or tag locations it
+    uses besides the measurements.  prior is the tracking prior, or
+    None for a full search.
+    """
+    digest = hashlib.sha256(f"{RESULT_CACHE_VERSION}:{kind}".encode())
+    for data in data_queue:
+        _update_measurement(digest, data["distance_candidates"], np.float64)
+        _update_measurement(digest, data["channel_estimate"], np.complex128)
+    _update_array(digest, geometry, np.float64)
+    used = {key: val for key, val in config.items()
+            if key not in IGNORED_CONFIG_KEYS}
+    digest.update(json.dumps(used, sort_keys=True,
+                             default=_json_default).encode())
+    # A tracking search can end elsewhere than the full one
+    digest.update(json.dumps(prior, sort_keys=True,
+                             default=_json_default).encode())
+    return digest.hexdigest()
+
+
+def target_fingerprint(data_queue, self_loc_poses, config, prior=None):
+    return fingerprint("target", data_queue, self_loc_poses, config, prior)
+
+
+def self_fingerprint(data_queue, ref_locs, config):
+    """Only the locations of the reference tags in data_queue count"""
+    tag_locs = [ref_locs[data["epc"]] for data in data_queue]
+    return fingerprint("self", data_queue, np.reshape(tag_locs, (-1, 3)),
+                       config)
+
+
+# -------------------------------- Cache -------------------------------- #
+
+class ResultCache:
+    """
+    Locations by fingerprint, in an LRU of max_entries in front of the
+    optional shared backend.  Hits (in the process or from the backend),
+    misses, expirations, evictions and backend errors are counted in
+    stats and as result_cache.* metrics.  A failing backend only costs a
+    recomputation.
+    """
+
+    def __init__(self, backend=None, ttl_s=RESULT_CACHE_TTL_S,
+                 max_entries=RESULT_CACHE_SIZE, clock=time.time):
+        self.backend = backend
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        # Wall clock, the creation times are compared across processes
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'backend_errors': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.count(f"result_cache.{name}")
+
+    def _remember(self, key, location, created):
+        self._entries[key] = (location, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._count('evictions')
+
+    def _get_shared(self, key):
+        """(location, created) from the backend, None if missing"""
+        try:
+            blob = self.backend.get(key)
+            if blob is None:
+                return None
+            entry = json.loads(bytes(blob).decode())
+            location, created = entry["location"], float(entry["created"])
+        except Exception as e:
+            print(f"Reading result {key} failed: {e!r}")
+            self._count('backend_errors')
+            return None
+        if location is not None:
+            location = np.array(location, dtype=float)
+        return location, created
+
+    def get(self, key):
+        """
+        Returns: (found, location), location is None for a cached
+        localization that found no location
+        """
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[1] <= self.ttl_s:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                return True, entry[0]
+            self._count('expired')
+            del self._entries[key]
+
+        if self.backend is not None:
+            entry = self._get_shared(key)
+            if entry is not None and now - entry[1] <= self.ttl_s:
+                self._remember(key, *entry)
+                self._count('shared_hits')
+                return True, entry[0]
+
+        self._count('misses')
+        return False, None
+
+    def put(self, key, location):
+        created = self.clock()
+        if location is not None:
+            location = np.array(location, dtype=float)
+        self._remember(key, location, created)
+        if self.backend is None:
+            return
+        blob = json.dumps({
+            "location": None if location is None else location.tolist(),
+            "created": created,
+        }).encode()
+        try:
+            self.backend.put(key, blob)
+        except Exception as e:
+            print(f"Writing result {key} failed: {e!r}")
+            self._count('backend_errors')
+
+    def get_or_compute(self, key, compute):
+        """Cached location of key, compute() -> location on a miss"""
+        found, location = self.get(key)
+        if not found:
+            location = compute()
+            self.put(key, location)
+        return location
+
+    def hit_rate(self):
+        hits = self.stats['hits'] + self.stats['shared_hits']
+        lookups = hits + self.stats['misses']
+        return hits / lookups if lookups else 0.0
+
+
+def target_localize_queue(cache, data_queue, self_loc_poses, config,
+                          prior=None):
+    """
+    localize_utils.target_localize_queue through cache.  The tracking
+    search around a prior can give another location than the full
+    search, so the prior is part of the fingerprint.
+    """
+    return cache.get_or_compute(
+        target_fingerprint(data_queue, self_loc_poses, config, prior),
+        lambda: localize_utils.target_localize_queue(
+            data_queue, self_loc_poses, config, prior))
+
+
+def self_localize_queue(cache, data_queue, ref_locs, config):
+    """localize_utils.self_localize_queue through cache"""
+    return cache.get_or_compute(
+        self_fingerprint(data_queue, ref_locs, config),
+        lambda: localize_utils.self_localize_queue(
+            data_queue, ref_locs, config))
@@ -0,0 +1,169 @@
+"""
+Recent measurements of each tag, kept between Lambda invocations.
+
+A stream batch often holds only one or two records of a tag, too few to
+localize it.  The handler adds the records of a batch to the tag's
+history and localizes the tag from the whole history instead, the most
+recent max_records measurements of (Area_id, Epc).
+
+The history is a compressed .npz blob with a JSON header (timestamps and
+devices), loaded with allow_pickle=False, in any fusion_state store
+(get(key) / put(key, blob) / delete(key)).  Records are identified by
+their device and timestamp, so a redelivered record is not added twice
+and a retried batch localizes the same measurements again.
+"""
+
+import io
+import json
+import zipfile
+
+import numpy as np
+
+import fusion_state
+import metrics
+
+HISTORY_VERSION = 1
+
+# Measurements kept per tag.  target_localize_queue over 16 measurements
+# takes about as long as over 8 on the scenarios, over 24 twice as long.
+MAX_HISTORY_RECORDS = 16
+
+
+def history_key(area_id, epc):
+    # Prefixed, so a table can hold the fusion_state checkpoints too
+    return "history#" + fusion_state.state_key(area_id, epc)
+
+
+def dump_history(records):
+    """
+    Serialize records, dicts with timestamp, device_id, pose [x,y,z,qx,
+    qy,qz,qw] and data (a target_localize_queue entry).
+
+    Returns: bytes
+    """
+    header = {
+        'version': HISTORY_VERSION,
+        'timestamps': [record['timestamp'] for record in records],
+        'device_ids': [record['device_id'] for record in records],
+        'epcs': [record['data']['epc'] for record in records],
+    }
+    arrays = {
+        'header': np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+        'poses': np.array([record['pose'] for record in records],
+                          dtype=float).reshape(-1, 7),
+    }
+    for i, record in enumerate(records):
+        arrays[f'candidates_{i}'] = np.asarray(
+            record['data']['distance_candidates'], dtype=float)
+        arrays[f'channels_{i}'] = np.asarray(
+            record['data']['channel_estimate'], dtype=complex)
+
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def load_history(blob):
+    """Inverse of dump_history.  Returns: records"""
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        header = json.loads(data['header'].tobytes().decode())
+        if header.get('version') != HISTORY_VERSION:
+            raise ValueError(
+                f"Tag history version {header.get('version')}, "
+                f"expected {HISTORY_VERSION}")
+        poses = data['poses']
+        records = []
+        for i, (timestamp, device_id, epc) in enumerate(zip(
+                header['timestamps'], header['device_ids'], header['epcs'])):
+            records.append({
+                'timestamp': timestamp,
+                'device_id': device_id,
+                'pose': poses[i],
+                'data': {
+                    'epc': epc,
+                    'distance_candidates': data[f'candidates_{i}'],
+                    'channel_estimate': data[f'channels_{i}'],
+                },
+            })
+    return records
+
+
+def _record_id(record):
+    return record['device_id'], float(record['timestamp'])
+
+
+class TagHistory:
+    """
+    The measurement history of each (Area_id, Epc) in a store.
+
+    A history that fails to load (unknown version, corrupt blob) counts
+    as empty.  One larger than max_bytes is not saved and the old one is
+    deleted, like a fusion_state.FusionCheckpointer state.
+    """
+
+    def __init__(self, store, max_records=MAX_HISTORY_RECORDS,
+                 max_bytes=fusion_state.MAX_STATE_BYTES):
+        self.store = store
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.stats = {
+            'loads': 0,
+            'misses': 0,
+            'invalid': 0,
+            'saves': 0,
+            'too_large': 0,
+            'duplicates': 0,
+        }
+
+    def load(self, area_id, epc):
+        """Returns: records of the tag in timestamp order, [] if none"""
+        blob = self.store.get(history_key(area_id, epc))
+        if blob is None:
+            self.stats['misses'] += 1
+            return []
+        try:
+            records = load_history(blob)
+        except (ValueError, KeyError, OSError, EOFError, zipfile.BadZipFile):
+            self.stats['invalid'] += 1
+            return []
+        self.stats['loads'] += 1
+        return records
+
+    def extend(self, area_id, epc, records, max_records=None):
+        """
+        Add parsed records (with poses) to the tag's history and save it,
+        keeping the max_records (default self.max_records) most recent.
+        Records already in the history are skipped.
+
+        Returns: the tag's history in timestamp order
+        """
+        if max_records is None:
+            max_records = self.max_records
+        history = self.load(area_id, epc)
+        seen = {_record_id(record) for record in history}
+        added = 0
+        for record in records:
+            if _record_id(record) in seen:
+                self.stats['duplicates'] += 1
+                continue
+            seen.add(_record_id(record))
+            history.append(record)
+            added += 1
+        history.sort(key=lambda record: float(record['timestamp']))
+        history = history[-max_records:]
+        metrics.count("history.duplicates", len(records) - added)
+        if not added:
+            return history
+
+        key = history_key(area_id, epc)
+        blob = dump_history(history)
+        if len(blob) > self.max_bytes:
+            self.stats['too_large'] += 1
+            self.store.delete(key)
+        else:
+            self.store.put(key, blob)
+            self.stats['saves'] += 1
+        return history
+
+    def delete(self, area_id, epc):
+        self.store.delete(history_key(area_id, epc))
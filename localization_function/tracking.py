@@ -0,0 +1,136 @@
+"""
+Per-tag location tracks, the priors of the tracking mode of
+localize_utils.target_localize_queue.
+
+Most tags are localized again without having moved.  A TagTrack is a
+constant position Kalman filter of one tag: the location of its last
+localizations and their variance, which grows with the time since the
+last update by process_noise (m^2 / s) so an old track gives a looser
+prior.  A new location further than gate_sigmas standard deviations from
+the track means the tag moved, and the track restarts from it.
+
+Tracker keeps the tracks of recently localized tags across warm
+invocations, at most max_tags of them (least recently updated evicted
+first).
+"""
+
+import collections
+
+import numpy as np
+
+import metrics
+
+# Growth of the location variance per second, m^2 / s
+TRACK_PROCESS_NOISE = 1e-4
+# Standard deviation of one localization, meters
+TRACK_MEASUREMENT_STD = 0.01
+# New locations further than this many standard deviations restart the
+# track
+TRACK_GATE_SIGMAS = 5.0
+# Most tags tracked
+TRACK_SIZE = 4096
+
+
+class TagTrack:
+    """
+    Location and variance (meters, the same on every axis) of one tag at
+    timestamp_ms
+    """
+
+    def __init__(self, location, timestamp_ms,
+                 variance=TRACK_MEASUREMENT_STD**2):
+        self.location = np.array(location, dtype=float)
+        self.variance = float(variance)
+        self.timestamp_ms = float(timestamp_ms)
+
+    def predicted_variance(self, timestamp_ms, process_noise=TRACK_PROCESS_NOISE):
+        # Records of a retried batch may be older than the track
+        elapsed_s = max(float(timestamp_ms) - self.timestamp_ms, 0.0) / 1000
+        return self.variance + process_noise * elapsed_s
+
+    def prior(self, timestamp_ms, process_noise=TRACK_PROCESS_NOISE):
+        """target_localize_queue prior at timestamp_ms"""
+        return {
+            "location": self.location.tolist(),
+            "uncertainty": float(np.sqrt(
+                self.predicted_variance(timestamp_ms, process_noise))),
+        }
+
+    def update(self, location, timestamp_ms, process_noise=TRACK_PROCESS_NOISE,
+               measurement_std=TRACK_MEASUREMENT_STD,
+               gate_sigmas=TRACK_GATE_SIGMAS):
+        """
+        Fuse a new location.
+
+        Returns: True if it was outside the gate and the track restarted
+        """
+        location = np.asarray(location, dtype=float)
+        variance = self.predicted_variance(timestamp_ms, process_noise)
+        measurement_var = measurement_std**2
+        distance = np.linalg.norm(location - self.location)
+        moved = distance > gate_sigmas * np.sqrt(variance + measurement_var)
+        if moved:
+            self.location = location.copy()
+            self.variance = measurement_var
+        else:
+            gain = variance / (variance + measurement_var)
+            self.location = self.location + gain * (location - self.location)
+            self.variance = (1 - gain) * variance
+        self.timestamp_ms = max(self.timestamp_ms, float(timestamp_ms))
+        return moved
+
+
+class Tracker:
+    """
+    TagTracks by key (e.g. (Area_id, Epc)).  Priors given, updates and
+    restarts (the tag moved) are counted in stats and as tracking.*
+    metrics.
+    """
+
+    def __init__(self, max_tags=TRACK_SIZE, process_noise=TRACK_PROCESS_NOISE,
+                 measurement_std=TRACK_MEASUREMENT_STD,
+                 gate_sigmas=TRACK_GATE_SIGMAS):
+        self.max_tags = max_tags
+        self.process_noise = process_noise
+        self.measurement_std = measurement_std
+        self.gate_sigmas = gate_sigmas
+        self._tracks = collections.OrderedDict()
+        self.stats = {
+            'priors': 0,
+            'updates': 0,
+            'restarts': 0,
+            'evictions': 0,
+        }
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.count(f"tracking.{name}")
+
+    def prior(self, key, timestamp_ms):
+        """Prior of key at timestamp_ms, None for an untracked tag"""
+        track = self._tracks.get(key)
+        if track is None:
+            return None
+        self._count('priors')
+        return track.prior(timestamp_ms, self.process_noise)
+
+    def update(self, key, location, timestamp_ms):
+        """Fuse a new location of key, starting its track if needed"""
+        track = self._tracks.get(key)
+        if track is None:
+            self._tracks[key] = TagTrack(location, timestamp_ms,
+                                         self.measurement_std**2)
+        elif track.update(location, timestamp_ms, self.process_noise,
+                          self.measurement_std, self.gate_sigmas):
+            self._count('restarts')
+        self._count('updates')
+        self._tracks.move_to_end(key)
+        while len(self._tracks) > self.max_tags:
+            self._tracks.popitem(last=False)
+            self._count('evictions')
+
+    def forget(self, key):
+        self._tracks.pop(key, None)
@@ -0,0 +1,13 @@
+"""
+The function code is deployed as flat modules, and the tests share the
+synthetic scenarios of the benchmarks.
+"""
+
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+FUNCTION_DIR = ROOT / "localization_function"
+
+sys.path.insert(0, str(FUNCTION_DIR))
+sys.path.insert(0, str(ROOT / "benchmarks"))
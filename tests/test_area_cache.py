@@ -0,0 +1,115 @@
+import json
+
+import numpy as np
+import pytest
+
+import scenarios
+import area_cache
+import localize_utils
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingLoader:
+    def __init__(self, config, ref_locs=None):
+        self.load = area_cache.static_loader(config, ref_locs)
+        self.calls = []
+
+    def __call__(self, area_id):
+        self.calls.append(area_id)
+        return self.load(area_id)
+
+
+def test_contexts_are_cached_until_they_expire():
+    loader = CountingLoader(scenarios.default_config())
+    clock = Clock()
+    cache = area_cache.AreaCache(loader, ttl_s=10, clock=clock)
+    first = cache.get(1)
+    # Number or text, the same area
+    assert cache.get("1") is first
+    clock.now = 10
+    assert cache.get(1) is first
+    clock.now = 10.5
+    assert cache.get(1) is not first
+    assert loader.calls == [1, 1]
+    assert cache.stats == {"hits": 2, "misses": 2, "expired": 1, "evictions": 0}
+    assert cache.hit_rate() == 0.5
+
+
+def test_least_recently_used_areas_are_evicted():
+    loader = CountingLoader(scenarios.default_config())
+    cache = area_cache.AreaCache(loader, max_areas=2, clock=Clock())
+    cache.get(1)
+    cache.get(2)
+    cache.get(1)
+    cache.get(3)
+    assert len(cache) == 2 and cache.stats["evictions"] == 1
+    cache.get(1)
+    cache.get(2)
+    assert loader.calls == [1, 2, 3, 2]
+
+    cache.invalidate(1)
+    cache.get(1)
+    cache.invalidate()
+    assert len(cache) == 0
+    assert loader.calls[-1] == 1
+
+
+def test_context_arrays_are_read_only_and_localize():
+    config = scenarios.default_config(1)
+    context = area_cache.AreaCache(CountingLoader(config)).get(1)
+    for key in area_cache.ARRAY_KEYS:
+        assert context.config[key].dtype == float
+        assert not context.config[key].flags.writeable
+    # The loader's config is not changed
+    assert isinstance(config["min_bounds"], list)
+
+    scenario = scenarios.target_scenario(6, seed=1)
+    np.testing.assert_array_equal(
+        localize_utils.target_localize_queue(scenario["queue"],
+                                             scenario["poses"], context.config),
+        localize_utils.target_localize_queue(scenario["queue"],
+                                             scenario["poses"], config))
+
+
+def test_reference_locations():
+    ref_locs = area_cache.ReferenceLocations({"A": [0, 1, 2], "B": [3, 4, 5]})
+    assert len(ref_locs) == 2 and "A" in ref_locs and "C" not in ref_locs
+    np.testing.assert_array_equal(ref_locs["B"], [3, 4, 5])
+    np.testing.assert_array_equal(ref_locs.lookup(["B", "A"]),
+                                  [[3, 4, 5], [0, 1, 2]])
+    with pytest.raises(KeyError):
+        ref_locs.lookup(["C"])
+    assert area_cache.ReferenceLocations().coords.shape == (0, 3)
+
+
+class AreaTableClient:
+    """get_item of a DynamoDB client over items keyed by Area_id"""
+
+    def __init__(self, items):
+        self.items = items
+
+    def get_item(self, TableName, Key):
+        item = self.items.get(Key["Area_id"]["N"])
+        return {"Item": item} if item is not None else {}
+
+
+def test_dynamo_loader_overrides_the_default_config():
+    default = scenarios.default_config()
+    client = AreaTableClient({"2": {
+        "Area_id": {"N": "2"},
+        "Config": {"S": json.dumps({"shuffle": 7, "cal_dist": 0.25})},
+        "Reference_tags": {"M": {"REF": {"L": [{"N": "1"}, {"N": "2.5"},
+                                               {"N": "0"}]}}},
+    }})
+    loader = area_cache.DynamoAreaLoader(client, "AreaConfig", default)
+    config, ref_locs = loader(2)
+    assert config == dict(default, shuffle=7, cal_dist=0.25)
+    assert ref_locs == {"REF": [1.0, 2.5, 0.0]}
+    assert loader(1) == (default, {})
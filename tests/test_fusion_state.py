@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+import scenarios
+import fusion_state
+import localize_utils
+
+mf = localize_utils.mf
+
+
+def new_fusion(**options):
+    return mf.MultiFusion(bound_min=np.array(scenarios.BOUND_MIN, float),
+                          bound_max=np.array(scenarios.BOUND_MAX, float),
+                          analytic_jac=True, **options)
+
+
+def process(fusion, measurements, start=0):
+    for meas_id, (clusters, rx_loc, tx_loc) in enumerate(measurements, start):
+        fusion.process_new_measurement(clusters, rx_loc, tx_loc, meas_id)
+
+
+def assert_same_locations(got, expected):
+    assert [loc["tx_indices"] for loc in got] == \
+        [loc["tx_indices"] for loc in expected]
+    np.testing.assert_array_equal([loc["location"] for loc in got],
+                                  [loc["location"] for loc in expected])
+
+
+@pytest.mark.parametrize("options", ({}, {"beam_width": 5, "dedup": True},
+                                     {"precision": "float32"},
+                                     {"precheck": True}))
+def test_restored_fusion_continues_like_the_original(options):
+    measurements = scenarios.target_scenario(8, 4, seed=1)["measurements"]
+    fusion = new_fusion(**options)
+    process(fusion, measurements[:5])
+    extra = {"channels": np.arange(6, dtype=np.complex64)}
+    blob = fusion_state.dump_fusion(fusion, meta={"records": 5}, extra=extra)
+
+    restored, meta = fusion_state.load_fusion(blob)
+    assert meta["records"] == 5
+    np.testing.assert_array_equal(meta["arrays"]["channels"], extra["channels"])
+    assert restored.num_of_rx == fusion.num_of_rx
+    assert restored.precision == fusion.precision
+    assert restored.precheck == fusion.precheck
+    assert_same_locations(restored.get_all_locations(),
+                          fusion.get_all_locations())
+
+    process(fusion, measurements[5:], 5)
+    process(restored, measurements[5:], 5)
+    assert_same_locations(restored.get_all_locations(),
+                          fusion.get_all_locations())
+
+
+@pytest.fixture(params=["memory", "file", "dynamo"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return fusion_state.MemoryStateStore()
+    if request.param == "file":
+        return fusion_state.FileStateStore(tmp_path)
+    return fusion_state.DynamoStateStore(fusion_state.LocalDynamoTable())
+
+
+def test_checkpointer_stores(store):
+    measurements = scenarios.target_scenario(5, 4, seed=0)["measurements"]
+    fusion = new_fusion()
+    process(fusion, measurements)
+    checkpointer = fusion_state.FusionCheckpointer(store)
+    assert checkpointer.load(1, "TAG/1") == (None, None)
+    assert checkpointer.save(1, "TAG/1", fusion, meta={"records": 5})
+    restored, meta = checkpointer.load(1, "TAG/1")
+    assert meta == {"records": 5}
+    assert_same_locations(restored.get_all_locations(),
+                          fusion.get_all_locations())
+    checkpointer.delete(1, "TAG/1")
+    assert checkpointer.load(1, "TAG/1") == (None, None)
+    assert checkpointer.stats["saves"] == 1
+    assert checkpointer.stats["loads"] == 1
+    assert checkpointer.stats["misses"] == 2
+
+
+def test_checkpointer_drops_large_and_invalid_states():
+    measurements = scenarios.target_scenario(5, 4, seed=0)["measurements"]
+    fusion = new_fusion()
+    process(fusion, measurements)
+    store = fusion_state.MemoryStateStore()
+    checkpointer = fusion_state.FusionCheckpointer(store, max_bytes=100)
+    store.put(fusion_state.state_key(1, "TAG"), b"old state")
+    # Too large: not saved, and the old state is not left behind
+    assert not checkpointer.save(1, "TAG", fusion)
+    assert store.get(fusion_state.state_key(1, "TAG")) is None
+    assert checkpointer.stats["too_large"] == 1
+
+    store.put(fusion_state.state_key(1, "TAG"), b"not an npz")
+    assert checkpointer.load(1, "TAG") == (None, None)
+    assert checkpointer.stats["invalid"] == 1
+
+
+def test_other_state_versions_are_not_loaded(monkeypatch):
+    fusion = new_fusion()
+    process(fusion, scenarios.target_scenario(4, 4, seed=0)["measurements"])
+    blob = fusion_state.dump_fusion(fusion)
+    monkeypatch.setattr(fusion_state, "STATE_VERSION",
+                        fusion_state.STATE_VERSION + 1)
+    with pytest.raises(ValueError):
+        fusion_state.load_fusion(blob)
@@ -0,0 +1,244 @@
+import json
+import subprocess
+import sys
+
+import numpy as np
+import yaml
+
+import scenarios
+import fusion_state
+import localization_handler
+import localize_utils
+import result_cache
+import tag_history
+
+from conftest import FUNCTION_DIR, ROOT
+
+# handle_request in a fresh interpreter, with the in-memory client in
+# place of boto3 and nothing else set up
+CHILD = """
+import json
+import sys
+
+sys.path.insert(0, {function_dir!r})
+import localization_handler
+
+localization_handler.client = localization_handler.LocalDynamoClient()
+response = localization_handler.handle_request(json.load(sys.stdin), None)
+print(json.dumps({{
+    "response": response,
+    "tables": {{name: list(table.values()) for name, table
+               in localization_handler.client.tables.items()}},
+}}))
+"""
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """SafeLoader that reads the CloudFormation tags as {name: value}"""
+
+
+def _cfn_tag(loader, suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        return {suffix: loader.construct_scalar(node)}
+    if isinstance(node, yaml.SequenceNode):
+        return {suffix: loader.construct_sequence(node)}
+    return {suffix: loader.construct_mapping(node)}
+
+
+TemplateLoader.add_multi_constructor("!", _cfn_tag)
+
+
+def load_template():
+    with open(ROOT / "template.yaml") as f:
+        return yaml.load(f, Loader=TemplateLoader)
+
+
+def function_environment(template, parameter_values):
+    """
+    Environment of LocalizationFunction, parameters from
+    parameter_values or their defaults and resources by their logical id
+    """
+    parameters = template["Parameters"]
+    variables = (template["Resources"]["LocalizationFunction"]["Properties"]
+                 ["Environment"]["Variables"])
+    env = {}
+    for name, val in variables.items():
+        if isinstance(val, dict):
+            ref = val["Ref"]
+            if ref in parameter_values:
+                val = parameter_values[ref]
+            elif ref in parameters:
+                val = parameters[ref]["Default"]
+            else:
+                val = ref
+        env[name] = str(val)
+    return env
+
+
+def test_template_event_source_caps_retries():
+    template = load_template()
+    events = template["Resources"]["LocalizationFunction"]["Properties"]["Events"]
+    source = events["DynamoDBEvent"]["Properties"]
+    assert source["MaximumRetryAttempts"] > 0
+    assert source["BisectBatchOnFunctionError"]
+    destination = source["DestinationConfig"]["OnFailure"]["Destination"]
+    assert destination["GetAtt"].split(".")[0] in template["Resources"]
+
+
+def test_template_requires_the_localization_config():
+    # The area geometry is deployment specific, there is no default
+    parameter = load_template()["Parameters"]["LocalizationConfig"]
+    assert "Default" not in parameter
+
+
+def test_handle_request_with_template_environment():
+    config = scenarios.default_config()
+    env = function_environment(load_template(),
+                               {"LocalizationConfig": json.dumps(config)})
+    scenario = scenarios.target_scenario(8, seed=1)
+
+    # Records with distance candidates, and ones without them or that are
+    # not measurements at all
+    with open(ROOT / "events" / "event.json") as f:
+        malformed = json.load(f)["Records"]
+    other = scenarios.target_scenario(3, seed=2)
+    records = (malformed
+               + scenarios.stream_records(other, epc="OTHER",
+                                          distance_candidates=False)
+               + scenarios.stream_records(scenario))
+
+    child = subprocess.run(
+        [sys.executable, "-c", CHILD.format(function_dir=str(FUNCTION_DIR))],
+        input=json.dumps({"Records": records}), capture_output=True,
+        text=True, env=env, timeout=300)
+    assert child.returncode == 0, child.stderr
+    output = json.loads(child.stdout.splitlines()[-1])
+
+    assert output["response"] == {"batchItemFailures": []}
+    items = output["tables"][env["LOCALIZED_TAGS_TABLE"]]
+    assert len(items) == 1
+    location = [float(items[0][key]["N"])
+                for key in ("location_x", "location_y", "location_z")]
+    assert np.linalg.norm(location - scenario["ground_truth"]) < 0.05
+
+
+def test_malformed_records_are_skipped():
+    with open(ROOT / "events" / "event.json") as f:
+        records = json.load(f)["Records"]
+    records[0]["dynamodb"]["NewImage"] = {
+        "Device_id": {"S": "UPDATER"},
+        "Epc": {"S": "TARGET"},
+        "Area_id": {"S": "1"},
+        "Timestamp": {"N": "1643179964390"},
+        "Channel_estimates": {"L": [{"L": [{"N": "1.0"}]}]},
+    }
+    failures, stats = localization_handler.process_records(
+        records, localization_handler.LocalDynamoClient(),
+        scenarios.default_config())
+    assert failures == []
+    # The REMOVE record is not a measurement, not a malformed record
+    assert stats["malformed"] == 2
+
+
+def written_locations(client):
+    table = client.tables.get(localization_handler.LOCALIZED_TAGS_TABLE, {})
+    return {item["Epc"]["S"]: np.array([float(item[key]["N"]) for key in
+                                        ("location_x", "location_y",
+                                         "location_z")])
+            for item in table.values()}
+
+
+def interleaved_records(n_tags, n_meas):
+    scenarios_by_epc = {}
+    records = []
+    for tag in range(n_tags):
+        epc = f"TAG{tag}"
+        scenarios_by_epc[epc] = scenarios.target_scenario(n_meas, seed=tag)
+        records += scenarios.stream_records(scenarios_by_epc[epc], epc=epc,
+                                            start_ms=1643179964390 + tag)
+    records.sort(key=lambda record:
+                 int(record["dynamodb"]["NewImage"]["Timestamp"]["N"]))
+    return scenarios_by_epc, records
+
+
+def test_tags_are_localized_from_their_history():
+    scenarios_by_epc, records = interleaved_records(2, 6)
+    config = scenarios.default_config(1)
+    client = localization_handler.LocalDynamoClient()
+    histories = tag_history.TagHistory(fusion_state.MemoryStateStore())
+    # Two records per batch, one of each tag: too few to localize a tag
+    # from the batch alone
+    for start in range(0, len(records), 2):
+        failures, stats = localization_handler.process_records(
+            records[start:start + 2], client, config, histories=histories)
+        assert failures == []
+    assert stats["history"]["saves"] == len(records)
+    locations = written_locations(client)
+    assert set(locations) == set(scenarios_by_epc)
+    for epc, location in locations.items():
+        assert np.linalg.norm(location
+                              - scenarios_by_epc[epc]["ground_truth"]) < 0.05
+
+    # Without the history the same batches write nothing
+    client = localization_handler.LocalDynamoClient()
+    for start in range(0, len(records), 2):
+        localization_handler.process_records(records[start:start + 2], client,
+                                             config)
+    assert written_locations(client) == {}
+
+
+def test_redelivered_records_hit_the_result_cache():
+    _, records = interleaved_records(1, 6)
+    config = scenarios.default_config(1)
+    histories = tag_history.TagHistory(fusion_state.MemoryStateStore())
+    results = result_cache.ResultCache()
+    client = localization_handler.LocalDynamoClient()
+    localization_handler.process_records(records, client, config,
+                                         results=results, histories=histories)
+    # A retry of the last three records
+    failures, stats = localization_handler.process_records(
+        records[3:], client, config, results=results, histories=histories)
+    assert failures == [] and stats["written"] == 1
+    assert stats["history"]["duplicates"] == 3
+    assert stats["result_cache"]["hits"] == 1
+
+
+def test_bad_area_id_is_malformed():
+    scenario = scenarios.target_scenario(6, seed=1)
+    records = scenarios.stream_records(scenario)
+    bad = scenarios.stream_records(scenarios.target_scenario(6, seed=2),
+                                   epc="BAD")
+    for record in bad:
+        record["dynamodb"]["NewImage"]["Area_id"] = {"S": "north"}
+    client = localization_handler.LocalDynamoClient()
+    failures, stats = localization_handler.process_records(
+        records + bad, client, scenarios.default_config(1))
+    assert failures == []
+    assert stats["malformed"] == len(bad)
+    assert set(written_locations(client)) == {"TARGET"}
+
+
+def test_incremental_areas_use_the_checkpoints():
+    scenario = scenarios.target_scenario(6, seed=1)
+    records = scenarios.stream_records(scenario)
+    config = dict(scenarios.default_config(1), incremental=True)
+    checkpoints = fusion_state.FusionCheckpointer(
+        fusion_state.MemoryStateStore())
+    client = localization_handler.LocalDynamoClient()
+    for record in records + records[-2:]:
+        failures, _ = localization_handler.process_records(
+            [record], client, config, checkpoints=checkpoints)
+        assert failures == []
+    fusion, meta = checkpoints.load(1, "TARGET")
+    # The redelivered records were not applied again
+    assert fusion.num_of_rx == len(records)
+    direct = fusion_state.FusionCheckpointer(fusion_state.MemoryStateStore())
+    for data, pose in zip(scenario["queue"], scenario["poses"]):
+        expected, _ = localize_utils.target_localize_incremental(
+            direct, 1, "TARGET", data, pose, config)
+    np.testing.assert_allclose(written_locations(client)["TARGET"], expected)
+
+    # An incremental area without checkpoints fails its records
+    failures, _ = localization_handler.process_records(
+        records[:1], client, config)
+    assert len(failures) == 1
@@ -0,0 +1,228 @@
+import numpy as np
+import pytest
+
+import scenarios
+import fusion_state
+import localize_utils
+
+
+def queue_arrays(scenario):
+    """(clusters, tx poses, rx locations) of a target scenario's queue"""
+    clusters = np.array([localize_utils.preprocess_data(data)
+                         ["distance_candidates"][0]
+                         for data in scenario["queue"]])
+    tx_poses = scenario["poses"]
+    rx_poses = (localize_utils.rotate_by_quaternions(
+        tx_poses[:, 3:], scenarios.TX_RX_OFFSET) + tx_poses[:, :3])
+    return clusters, tx_poses, rx_poses
+
+
+def shuffle_tasks(seed, n_shuffle=3):
+    scenario = scenarios.target_scenario(8, seed=seed)
+    config = scenarios.default_config(n_shuffle, seed)
+    clusters, tx_poses, rx_poses = queue_arrays(scenario)
+    return localize_utils.shuffle_tasks(
+        clusters, tx_poses, rx_poses, scenarios.BOUND_MIN, scenarios.BOUND_MAX,
+        localize_utils.shuffle_permutations(len(clusters), config))
+
+
+def location_array(result):
+    """(n, 3) locations of a localize() result"""
+    return np.array([loc["location"] for loc in result]).reshape(-1, 3)
+
+
+def locations(outputs):
+    """Locations of each _run_shuffle_task() output"""
+    return [location_array(result) for result, _ in outputs]
+
+
+def test_shuffle_pool_failure_leaves_no_stale_replies():
+    pool = localize_utils.ShufflePool(2)
+    try:
+        # The first task fails at once while the other worker is still
+        # localizing
+        tasks = shuffle_tasks(seed=1)
+        (args, cache_spec) = tasks[0]
+        tasks[0] = ((None,) + args[1:], cache_spec)
+        with pytest.raises(RuntimeError):
+            pool.map([(task, False) for task in tasks])
+
+        tasks = shuffle_tasks(seed=2)
+        parallel = [output for output, _ in
+                    pool.map([(task, False) for task in tasks])]
+        serial = [localize_utils._run_shuffle_task(*task) for task in tasks]
+        # A stale reply would be another shuffle's candidates, not a last
+        # bit difference between the processes
+        for got, expected in zip(locations(parallel), locations(serial)):
+            np.testing.assert_allclose(got, expected, rtol=0, atol=1e-9)
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_localize_incremental_matches_localize(seed):
+    scenario = scenarios.target_scenario(8, seed=seed)
+    config = scenarios.default_config(1, seed)
+    clusters, tx_poses, rx_poses = queue_arrays(scenario)
+    checkpointer = fusion_state.FusionCheckpointer(
+        fusion_state.MemoryStateStore())
+    for n, (data, pose) in enumerate(zip(scenario["queue"], tx_poses), 1):
+        incremental, saved = localize_utils.localize_incremental(
+            checkpointer, 1, "TARGET", data, pose, config)
+        assert saved
+        full = localize_utils.localize(
+            clusters[:n], tx_poses[:n], rx_poses[:n], scenarios.BOUND_MIN,
+            scenarios.BOUND_MAX,
+            prune_options=localize_utils.prune_options_from_config(config))
+        assert [loc["tx_indices"] for loc in incremental] == \
+            [loc["tx_indices"] for loc in full]
+        np.testing.assert_array_equal(location_array(incremental),
+                                      location_array(full))
+
+
+@pytest.mark.parametrize("warm", (False, True))
+def test_target_localize_incremental_matches_aoa_tiebreaker(warm):
+    scenario = scenarios.target_scenario(8, seed=1)
+    config = scenarios.default_config(1, 1)
+    clusters, tx_poses, rx_poses = queue_arrays(scenario)
+    arr_channels = localize_utils.antenna_array_channels(
+        np.array([localize_utils.preprocess_data(data)["channel_estimate"][0]
+                  for data in scenario["queue"]]),
+        config["cal_dist"], localize_utils.WAVELENGTHS)
+    checkpointer = fusion_state.FusionCheckpointer(
+        fusion_state.MemoryStateStore())
+    # Without the warm accumulators every record restores the
+    # accumulator from the checkpoint
+    accumulators = {} if warm else None
+    for n, (data, pose) in enumerate(zip(scenario["queue"], tx_poses), 1):
+        best_loc, saved = localize_utils.target_localize_incremental(
+            checkpointer, 1, "TARGET", data, pose, config, accumulators)
+        assert saved
+        full = location_array(localize_utils.localize(
+            clusters[:n], tx_poses[:n], rx_poses[:n], scenarios.BOUND_MIN,
+            scenarios.BOUND_MAX,
+            prune_options=localize_utils.prune_options_from_config(config)))
+        expected, _ = localize_utils.aoa_tiebreaker(
+            full, tx_poses[:n, :3], rx_poses[:n], arr_channels[:n],
+            localize_utils.WAVELENGTHS)
+        if expected is None:
+            assert best_loc is None
+        else:
+            np.testing.assert_allclose(best_loc, expected, rtol=0, atol=1e-12)
+    if warm:
+        assert accumulators[(1, "TARGET")].stats["reused"] > 0
+
+
+def grid_inputs(seed=0):
+    """(tx locations, rx locations, array channels) of a target scenario"""
+    scenario = scenarios.target_scenario(4, seed=seed)
+    config = scenarios.default_config()
+    _, tx_poses, rx_poses = queue_arrays(scenario)
+    arr_channels = localize_utils.antenna_array_channels(
+        np.array([localize_utils.preprocess_data(data)["channel_estimate"][0]
+                  for data in scenario["queue"]]),
+        config["cal_dist"], localize_utils.WAVELENGTHS)
+    return tx_poses[:, :3], rx_poses, arr_channels, config
+
+
+def test_grid_localize_thin_bounds():
+    tx_locs, rx_locs, arr_channels, config = grid_inputs()
+    bound_min = np.array(scenarios.BOUND_MIN, dtype=float)
+    bound_max = np.array(scenarios.BOUND_MAX, dtype=float)
+    # The z extent is below half the coarse voxel size
+    bound_max[2] = bound_min[2] + localize_utils.GRID_RESOLUTION / 4
+    best_loc, power = localize_utils.grid_localize(
+        tx_locs, rx_locs, arr_channels, bound_min, bound_max, config)
+    assert power is not None
+    assert np.all(best_loc >= bound_min) and np.all(best_loc <= bound_max)
+
+
+def test_grid_localize_empty_bounds():
+    tx_locs, rx_locs, arr_channels, config = grid_inputs()
+    bound_min = np.array(scenarios.BOUND_MIN, dtype=float)
+    bound_max = bound_min.copy()
+    bound_max[0] -= 1.0
+    assert localize_utils.grid_localize(
+        tx_locs, rx_locs, arr_channels, bound_min, bound_max,
+        config) == (None, None)
+
+
+@pytest.mark.parametrize("options", ({"solver": "batch"}, {"warm_start": True},
+                                     {"solver": "batch", "warm_start": True}))
+def test_least_squares_options_from_config(options):
+    scenario = scenarios.target_scenario(8, seed=1)
+    config = scenarios.default_config(1, 1)
+    expected = localize_utils.target_localize_queue(
+        scenario["queue"], scenario["poses"], config)
+    config = dict(config, **options)
+    for name, val in options.items():
+        assert localize_utils.prune_options_from_config(config)[name] == val
+    location = localize_utils.target_localize_queue(
+        scenario["queue"], scenario["poses"], config)
+    np.testing.assert_allclose(location, expected, atol=1e-4)
+    assert np.linalg.norm(location - scenario["ground_truth"]) < 0.02
+
+
+def test_unknown_solver_is_rejected():
+    scenario = scenarios.target_scenario(4, seed=0)
+    config = dict(scenarios.default_config(1, 0), solver="newton")
+    with pytest.raises(ValueError):
+        localize_utils.target_localize_queue(scenario["queue"],
+                                             scenario["poses"], config)
+
+
+@pytest.mark.parametrize("target", (False, True))
+def test_incremental_skips_redelivered_records(target):
+    scenario = scenarios.target_scenario(6, seed=1)
+    config = scenarios.default_config(1, 1)
+    store = fusion_state.MemoryStateStore()
+    checkpointer = fusion_state.FusionCheckpointer(store)
+    localize = (localize_utils.target_localize_incremental if target
+                else localize_utils.localize_incremental)
+
+    def apply(n):
+        return localize(checkpointer, 1, "TARGET", scenario["queue"][n],
+                        scenario["poses"][n], config, timestamp=1000 + n)
+
+    for n in range(4):
+        expected, _ = apply(n)
+    blob = store.get(fusion_state.state_key(1, "TARGET"))
+    # The retried batch redelivers records 2 and 3
+    for n in (2, 3):
+        got, saved = apply(n)
+        assert saved
+        if target:
+            np.testing.assert_array_equal(got, expected)
+        else:
+            np.testing.assert_array_equal(location_array(got),
+                                          location_array(expected))
+    assert store.get(fusion_state.state_key(1, "TARGET")) == blob
+    fusion, meta = checkpointer.load(1, "TARGET")
+    assert fusion.num_of_rx == 4 and meta["timestamp"] == 1003
+    apply(4)
+    assert checkpointer.load(1, "TARGET")[0].num_of_rx == 5
+
+
+def test_target_localize_batch_matches_the_queue():
+    scenario = scenarios.batch_scenario(3, 6, seed=0)
+    config = scenarios.default_config(1)
+    locations = localize_utils.target_localize_batch(
+        scenario["queue"], scenario["pose_indices"], scenario["poses"], config)
+    assert locations.keys() == scenario["ground_truth"].keys()
+    for epc, location in locations.items():
+        indices = [i for i, data in enumerate(scenario["queue"])
+                   if data["epc"] == epc]
+        expected = localize_utils.target_localize_queue(
+            [scenario["queue"][i] for i in indices],
+            scenario["poses"][scenario["pose_indices"][indices]], config)
+        np.testing.assert_array_equal(location, expected)
+
+
+@pytest.mark.parametrize("key", localize_utils.BATCH_UNSUPPORTED_KEYS)
+def test_target_localize_batch_rejects_unsupported_config(key):
+    scenario = scenarios.batch_scenario(2, 4, seed=0)
+    config = dict(scenarios.default_config(1), **{key: True})
+    with pytest.raises(ValueError, match=key):
+        localize_utils.target_localize_batch(
+            scenario["queue"], scenario["pose_indices"], scenario["poses"],
+            config)
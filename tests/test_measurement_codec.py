@@ -0,0 +1,109 @@
+import struct
+
+import numpy as np
+import pytest
+
+import scenarios
+import localize_utils
+import measurement_codec
+
+
+@pytest.mark.parametrize("dtype", list(measurement_codec.DTYPES.values()))
+@pytest.mark.parametrize("shape", [(), (5,), (1, 14), (1, 4, 2), (0, 3)])
+def test_round_trip(dtype, shape):
+    rng = np.random.default_rng(0)
+    arr = rng.standard_normal(shape).astype(dtype)
+    if dtype.kind == "c":
+        arr = arr + 1j * rng.standard_normal(shape).astype(dtype)
+    buf = measurement_codec.encode_array(arr)
+    assert measurement_codec.is_encoded(buf)
+    decoded = measurement_codec.decode_array(buf)
+    assert decoded.dtype == dtype and decoded.shape == shape
+    np.testing.assert_array_equal(decoded, arr)
+    # A view on the buffer, not a copy
+    assert not decoded.flags.writeable
+    assert decoded.ctypes.data % 8 == 0 or decoded.size == 0
+
+
+def test_encode_converts_and_rejects_dtypes():
+    buf = measurement_codec.encode_array([[1.5, 0.25]], np.float32)
+    assert measurement_codec.decode_array(buf).dtype == np.float32
+    big_endian = np.arange(3, dtype=">f8")
+    np.testing.assert_array_equal(
+        measurement_codec.decode_array(measurement_codec.encode_array(big_endian)),
+        big_endian)
+    with pytest.raises(ValueError):
+        measurement_codec.encode_array(np.arange(3, dtype=np.int32))
+
+
+def test_json_and_text_are_not_encoded():
+    assert not measurement_codec.is_encoded("[[1.0, 0.1]]")
+    assert not measurement_codec.is_encoded(b"\x80\x04")
+    assert not measurement_codec.is_encoded(None)
+
+
+def corrupt(buf, offset, fmt, value):
+    buf = bytearray(buf)
+    struct.pack_into(fmt, buf, offset, value)
+    return bytes(buf)
+
+
+@pytest.mark.parametrize("mangle", [
+    lambda buf: buf[:4],                      # shorter than the header
+    lambda buf: buf[:12],                     # shorter than the shape
+    lambda buf: buf[:-1],                     # truncated data
+    lambda buf: buf + b"\0" * 8,              # trailing bytes
+    lambda buf: b"XX" + buf[2:],              # magic
+    lambda buf: corrupt(buf, 2, "<B", 2),     # version
+    lambda buf: corrupt(buf, 3, "<B", 99),    # dtype code
+    lambda buf: corrupt(buf, 8, "<I", 1000),  # shape
+], ids=["header", "shape", "truncated", "trailing", "magic", "version",
+        "dtype", "shape_mismatch"])
+def test_corrupt_buffers_raise(mangle):
+    buf = measurement_codec.encode_array(np.ones((1, 4, 2), np.float32))
+    with pytest.raises(ValueError):
+        measurement_codec.decode_array(mangle(buf))
+
+
+def test_decode_batch():
+    arrays = [np.full((1, 14), i, np.complex64) for i in range(3)]
+    batch = measurement_codec.decode_batch(
+        [measurement_codec.encode_array(arr) for arr in arrays])
+    assert batch.shape == (3, 1, 14) and batch.flags.c_contiguous
+    np.testing.assert_array_equal(batch, np.stack(arrays))
+
+    with pytest.raises(ValueError):
+        measurement_codec.decode_batch([])
+    with pytest.raises(ValueError):
+        measurement_codec.decode_batch([
+            measurement_codec.encode_array(arrays[0]),
+            measurement_codec.encode_array(np.ones((1, 13), np.complex64))])
+
+
+def test_preprocess_queue_decodes_a_batch(monkeypatch):
+    queue = scenarios.target_scenario(6, seed=0)["queue"]
+    expected = [localize_utils.preprocess_data(data) for data in queue]
+    calls = []
+    decode_batch = measurement_codec.decode_batch
+
+    def counting(bufs):
+        calls.append(len(bufs))
+        return decode_batch(bufs)
+
+    monkeypatch.setattr(measurement_codec, "decode_batch", counting)
+    processed = localize_utils.preprocess_queue(queue)
+    assert calls == [len(queue), len(queue)]
+    for got, want in zip(processed, expected):
+        assert got["epc"] == want["epc"]
+        for key in localize_utils.BATCH_DECODED_KEYS:
+            np.testing.assert_array_equal(got[key], want[key])
+
+
+def test_preprocess_queue_mixed_shapes():
+    queue = scenarios.target_scenario(3, seed=0)["queue"]
+    # One measurement with fewer clusters, decoded on its own
+    queue[1] = dict(queue[1], distance_candidates=measurement_codec.encode_array(
+        np.ones((1, 2, 2)), np.float32))
+    processed = localize_utils.preprocess_queue(queue)
+    assert processed[1]["distance_candidates"].shape == (1, 2, 2)
+    assert processed[0]["distance_candidates"].shape[1] != 2
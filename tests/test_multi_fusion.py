@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+
+import scenarios
+import feasibility
+import localize_utils
+
+mf = localize_utils.mf
+
+PRUNE_OPTIONS = ({"beam_width": 5}, {"max_candidates": 50},
+                 {"beam_width": 3, "max_candidates": 20})
+
+
+def exactly_determined_sizes(measurements, **options):
+    """Size of S(n, 3) after each measurement (0 when not kept)"""
+    fusion = mf.MultiFusion(bound_min=scenarios.BOUND_MIN,
+                            bound_max=scenarios.BOUND_MAX, analytic_jac=True,
+                            **options)
+    sizes = []
+    for meas_id, (clusters, rx_loc, tx_loc) in enumerate(measurements):
+        fusion.process_new_measurement(clusters, rx_loc, tx_loc, meas_id)
+        sizes.append(len(fusion.prev[3]) if 3 in fusion.prev else 0)
+    return sizes
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_pruned_and_unpruned_locations_agree(seed):
+    scenario = scenarios.target_scenario(10, 4, seed)
+    config = scenarios.default_config(3, seed)
+    expected = localize_utils.target_localize_queue(
+        scenario["queue"], scenario["poses"], config)
+    for options in PRUNE_OPTIONS:
+        location = localize_utils.target_localize_queue(
+            scenario["queue"], scenario["poses"], dict(config, **options))
+        np.testing.assert_allclose(location, expected, atol=1e-9,
+                                   err_msg=str(options))
+
+
+def test_prune_leaves_exactly_determined_sets_alone():
+    measurements = scenarios.target_scenario(8, 6, 1)["measurements"]
+    expected = exactly_determined_sizes(measurements)
+    assert max(expected) > 50
+    for options in PRUNE_OPTIONS:
+        assert exactly_determined_sizes(measurements, **options) == expected
+
+
+@pytest.mark.parametrize("options", PRUNE_OPTIONS)
+def test_pruned_history_stays_bounded(options):
+    measurements = scenarios.target_scenario(16, 4, 2)["measurements"]
+    fusion = mf.MultiFusion(bound_min=scenarios.BOUND_MIN,
+                            bound_max=scenarios.BOUND_MAX, analytic_jac=True,
+                            **options)
+    for meas_id, (clusters, rx_loc, tx_loc) in enumerate(measurements):
+        fusion.process_new_measurement(clusters, rx_loc, tx_loc, meas_id)
+        # Every node is on the path (one node per measurement) of a live
+        # candidate
+        assert fusion.history.num_nodes <= sum(
+            k * len(solutions) for k, solutions in fusion.prev.items())
+    # The remapped paths still walk back through distinct measurements
+    locations = fusion.get_all_locations()
+    assert locations and all(np.all(np.diff(loc["tx_indices"]) > 0)
+                             for loc in locations)
+
+
+def test_feasible_clusters_allow_the_residual_tolerance():
+    fusion = mf.MultiFusion(bound_min=np.array(scenarios.BOUND_MIN, float),
+                            bound_max=np.array(scenarios.BOUND_MAX, float))
+    tx_loc = np.array(scenarios.BOUND_MAX, float) + [2.0, 0.0, 0.0]
+    rx_loc = tx_loc + scenarios.TX_RX_OFFSET
+    smallest, largest = feasibility.bistatic_range(
+        tx_loc, rx_loc, fusion.bound_min, fusion.bound_max)
+    # Cluster distances off the bistatic range of the bounds by half and
+    # twice the single residual least squares can accept
+    residual = np.sqrt(2 * fusion.RESIDUAL_COST_THR)
+    dists = np.array([smallest - residual / 2, largest + residual / 2,
+                      smallest - 2 * residual, largest + 2 * residual])
+    clusters = np.stack([dists, np.zeros_like(dists)], axis=1)
+    feasible = fusion.feasibleClusters(clusters, rx_loc, tx_loc)
+    assert feasible.tolist() == [True, True, False, False]
+
+
+def test_early_rejection_matches_per_pair_gate():
+    rng = np.random.default_rng(0)
+    fusion = mf.MultiFusion(bound_min=np.array(scenarios.BOUND_MIN, float),
+                            bound_max=np.array(scenarios.BOUND_MAX, float))
+    clusters, rx_loc, tx_loc = scenarios.target_scenario(1, 6)["measurements"][0]
+    clusters = clusters.copy()
+    clusters[-1, 0] = np.nan
+    prev_locations = rng.uniform(fusion.bound_min, fusion.bound_max, (20, 3))
+    prev_locations[:3] = np.nan
+    gate = fusion.earlyRejection(4, prev_locations, clusters, rx_loc, tx_loc)
+
+    for i, prev in enumerate(prev_locations):
+        for j, (dist, _) in enumerate(clusters):
+            if not np.isfinite(dist):
+                expected = False
+            elif not np.all(np.isfinite(prev)):
+                expected = True
+            else:
+                expected = abs(scenarios.bistatic_distance(prev, tx_loc, rx_loc)
+                               - dist) <= fusion.DISTANCE_THRESHOLD
+            assert gate[i, j] == expected, (i, j)
+    assert fusion.last_gate_stats[4]["solved"] == np.count_nonzero(gate)
+
+
+def test_precheck_gate_is_a_subset_of_the_per_pair_gate():
+    rng = np.random.default_rng(1)
+    bounds = (np.array(scenarios.BOUND_MIN, float),
+              np.array(scenarios.BOUND_MAX, float))
+    clusters, rx_loc, tx_loc = scenarios.target_scenario(
+        1, 6, seed=1, spread=6.0)["measurements"][0]
+    prev_locations = rng.uniform(*bounds, (20, 3))
+    prev_locations[:3] = np.nan
+    gates = {}
+    for precheck in (False, True):
+        fusion = mf.MultiFusion(*bounds, precheck=precheck)
+        fusion.cluster_feasible = (fusion.feasibleClusters(clusters, rx_loc, tx_loc)
+                                   if precheck else None)
+        gates[precheck] = fusion.earlyRejection(4, prev_locations, clusters,
+                                                rx_loc, tx_loc)
+    # The prechecks only settle pairs earlier, and clusters outside the
+    # bounds are not tried against the first intersections either
+    assert not np.any(gates[True] & ~gates[False])
+    assert fusion.last_gate_stats[4]["infeasible"] > 0
+    assert np.count_nonzero(gates[True]) < np.count_nonzero(gates[False])
+
+
+@pytest.mark.parametrize("spread", [1.0, 6.0])
+def test_precheck_keeps_the_locations(spread):
+    runs = {}
+    for options in ({}, {"precheck": True}):
+        fusion = mf.MultiFusion(bound_min=scenarios.BOUND_MIN,
+                                bound_max=scenarios.BOUND_MAX,
+                                analytic_jac=True, **options)
+        for meas_id, (clusters, rx_loc, tx_loc) in enumerate(
+                scenarios.target_scenario(8, 4, seed=0,
+                                          spread=spread)["measurements"]):
+            fusion.process_new_measurement(clusters, rx_loc, tx_loc, meas_id)
+        runs[fusion.precheck] = fusion
+    # Off by default
+    assert runs[False].feasibility_stats["clusters"] == 0
+    assert runs[True].feasibility_stats["clusters"] > 0
+    assert runs[True].ls_stats["calls"] <= runs[False].ls_stats["calls"]
+    locations = [[(loc["tx_indices"], loc["location"].tolist())
+                  for loc in fusion.get_all_locations()]
+                 for fusion in runs.values()]
+    assert locations[0] == locations[1]
+
+
+def shuffle_locations(scenario, permutations, cache, bound_min, bound_max,
+                      **options):
+    """localize() locations of every permutation, sharing cache"""
+    clusters, rx_locs, tx_locs = (np.array(arrays) for arrays
+                                  in zip(*scenario["measurements"]))
+    return [np.array([loc["location"] for loc in localize_utils.localize(
+        clusters[perm], tx_locs[perm], rx_locs[perm], bound_min, bound_max,
+        meas_ids=perm, prune_options=options, cache=cache)]).reshape(-1, 3)
+        for perm in permutations]
+
+
+@pytest.mark.parametrize("options", ({}, {"warm_start": True},
+                                     {"solver": "batch", "warm_start": True}))
+def test_intersection_cache_keeps_shuffle_results(options):
+    scenario = scenarios.target_scenario(8, 4, seed=2)
+    permutations = [np.random.default_rng(i).permutation(8) for i in range(3)]
+    bounds = (np.array(scenarios.BOUND_MIN, float),
+              np.array(scenarios.BOUND_MAX, float))
+    cache = mf.IntersectionCache()
+    cached = shuffle_locations(scenario, permutations, cache, *bounds,
+                               **options)
+    # Warm started solutions depend on the shuffle, they are not shared
+    if options.get("warm_start"):
+        assert len(cache) == 0
+    else:
+        assert cache.stats["hits"] > 0
+    expected = shuffle_locations(scenario, permutations, None, *bounds,
+                                 **options)
+    for got, want in zip(cached, expected):
+        np.testing.assert_allclose(got, want, rtol=0, atol=1e-9)
+
+
+def test_intersection_cache_is_not_shared_across_bounds():
+    scenario = scenarios.target_scenario(8, 4, seed=2)
+    permutations = [np.arange(8)]
+    bounds = (np.array(scenarios.BOUND_MIN, float),
+              np.array(scenarios.BOUND_MAX, float))
+    cache = mf.IntersectionCache()
+    shuffle_locations(scenario, permutations, cache, *bounds)
+    hits = cache.stats["hits"]
+    # Half the area: the least squares bounds differ, no entry applies
+    small = (bounds[0] / 2, bounds[1] / 2)
+    got = shuffle_locations(scenario, permutations, cache, *small)
+    assert cache.stats["hits"] == hits
+    expected = shuffle_locations(scenario, permutations, None, *small)
+    np.testing.assert_allclose(got[0], expected[0], rtol=0, atol=1e-9)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation, Slerp
+
+import scenarios
+import localization_handler
+import pose_index
+
+
+def random_poses(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.hstack([rng.uniform(-2, 2, (n, 3)),
+                      Rotation.random(n, random_state=seed).as_quat()])
+
+
+def same_rotation(q0, q1):
+    # q and -q are the same rotation
+    return np.allclose(np.abs(np.sum(q0 * q1, axis=1)), 1.0)
+
+
+def test_lookup_interpolates_between_samples():
+    poses = random_poses(3)
+    index = pose_index.PoseIndex([0, 100, 200], poses)
+    timestamps = np.array([0, 25, 100, 150, 200])
+    got, valid = index.lookup(timestamps)
+    assert valid.all()
+    u = np.array([0, 0.25, 0, 0.5, 0])
+    i0 = np.array([0, 0, 1, 1, 2])
+    i1 = np.minimum(i0 + 1, 2)
+    np.testing.assert_allclose(
+        got[:, :3], poses[i0, :3] + u[:, None] * (poses[i1, :3] - poses[i0, :3]))
+    expected = Slerp([0, 100, 200], Rotation.from_quat(poses[:, 3:]))(timestamps)
+    assert same_rotation(got[:, 3:], expected.as_quat())
+
+
+def test_slerp_takes_the_short_way():
+    q = Rotation.from_euler("z", [[0], [90]], degrees=True).as_quat()
+    half = pose_index.slerp(q[:1], -q[1:], [0.5])
+    expected = Rotation.from_euler("z", [[45]], degrees=True).as_quat()
+    assert same_rotation(half, expected)
+    # Nearly equal quaternions fall back to normalized lerp
+    near = pose_index.slerp(q[:1], q[:1], [0.3])
+    np.testing.assert_allclose(near, q[:1])
+
+
+def test_gaps_and_ends_hold_the_nearest_sample():
+    poses = random_poses(3, seed=1)
+    index = pose_index.PoseIndex([0, 100, 1000], poses)
+    got, valid = index.lookup([-5, -20, 105, 500, 995, 1010, 1011],
+                              max_gap_ms=200, max_hold_ms=10)
+    np.testing.assert_array_equal(valid,
+                                  [True, False, True, False, True, True, False])
+    np.testing.assert_allclose(got[[0, 2, 4, 5], :3], poses[[0, 1, 2, 2], :3])
+    assert np.isnan(got[~valid]).all()
+
+    empty, valid = pose_index.PoseIndex().lookup([0, 1])
+    assert not valid.any() and np.isnan(empty).all()
+
+
+def test_extend_sorts_and_keeps_the_first_pose():
+    poses = random_poses(4, seed=2)
+    index = pose_index.PoseIndex([300, 100], poses[:2])
+    index.extend([200, 100], poses[2:])
+    np.testing.assert_array_equal(index.times, [100, 200, 300])
+    np.testing.assert_allclose(index.positions, poses[[1, 2, 0], :3])
+    np.testing.assert_allclose(np.linalg.norm(index.quats, axis=1), 1.0)
+
+
+@pytest.mark.parametrize("page_size", [None, 2])
+def test_query_pose_index_reads_every_page(page_size):
+    poses = random_poses(5, seed=3)
+    client = localization_handler.LocalDynamoClient(page_size=page_size)
+    for i, pose in enumerate(poses):
+        item = {"Device_id": {"S": "UPDATER"},
+                "Timestamp": {"S": str(1000 + 10 * i)}}
+        if i % 2:
+            item["Updater_pose"] = {"M": {key: {"N": repr(float(val))}
+                                          for key, val in zip(pose_index.POSE_KEYS,
+                                                              pose)}}
+        else:
+            item.update({"pose_" + key: {"N": repr(float(val))}
+                         for key, val in zip(pose_index.POSE_KEYS, pose)})
+        client.put_item("Updaters", item)
+    client.put_item("Updaters", {"Device_id": {"S": "OTHER"},
+                                 "Timestamp": {"S": "1010"},
+                                 **{"pose_" + key: {"N": "0"}
+                                    for key in pose_index.POSE_KEYS}})
+
+    index = pose_index.query_pose_index(client, "Updaters", "UPDATER",
+                                        1005, 1040)
+    np.testing.assert_array_equal(index.times, [1010, 1020, 1030, 1040])
+    np.testing.assert_allclose(index.positions, poses[1:, :3])
+
+
+def test_join_poses_fills_and_drops_records():
+    scenario = scenarios.target_scenario(4, seed=0)
+    records = scenarios.stream_records(scenario, start_ms=1000, period_ms=100)
+    client = localization_handler.LocalDynamoClient()
+    for i, record in enumerate(records):
+        image = record["dynamodb"]["NewImage"]
+        pose = image.pop("Updater_pose")["M"]
+        if i == 3:
+            # No pose sample near the last measurement
+            continue
+        for offset in (-5, 5):
+            client.put_item(localization_handler.UPDATER_TABLE, {
+                "Device_id": image["Device_id"],
+                "Timestamp": {"S": str(int(image["Timestamp"]["N"]) + offset)},
+                **{"pose_" + key: pose[key] for key in pose_index.POSE_KEYS}})
+
+    groups, _ = localization_handler.group_records(records)
+    failures, stale = localization_handler.join_poses(groups, client)
+    assert failures == [] and stale == 1
+    group = groups[(1, "TARGET")]
+    assert len(group) == 3
+    for (_, parsed), pose in zip(group, scenario["poses"]):
+        np.testing.assert_allclose(parsed["pose"][:3], pose[:3])
+        assert same_rotation(parsed["pose"][None, 3:], pose[None, 3:])
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+import scenarios
+import fusion_state
+import localize_utils
+import measurement_codec
+import result_cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Arguments of every localize_utils.target_localize_queue call"""
+    calls = []
+
+    def localize(data_queue, self_loc_poses, config, prior=None):
+        calls.append(prior)
+        return np.array([len(calls), 0.0, 0.0])
+
+    monkeypatch.setattr(localize_utils, "target_localize_queue", localize)
+    return calls
+
+
+def test_fingerprint_does_not_decode(monkeypatch):
+    scenario = scenarios.target_scenario(4, seed=0)
+    config = scenarios.default_config()
+    expected = result_cache.target_fingerprint(scenario["queue"],
+                                               scenario["poses"], config)
+
+    def fail(*args):
+        raise AssertionError("decoded")
+
+    monkeypatch.setattr(measurement_codec, "decode_array", fail)
+    monkeypatch.setattr(measurement_codec, "decode_batch", fail)
+    monkeypatch.setattr(localize_utils, "preprocess_queue", fail)
+    assert result_cache.target_fingerprint(
+        scenario["queue"], scenario["poses"], config) == expected
+
+
+def test_fingerprint_inputs():
+    scenario = scenarios.target_scenario(4, seed=0)
+    queue, poses = scenario["queue"], scenario["poses"]
+    config = scenarios.default_config()
+    key = result_cache.target_fingerprint(queue, poses, config)
+    # Values that do not change the location
+    assert result_cache.target_fingerprint(
+        queue, poses, dict(config, shuffle_workers=4,
+                           precision_radius=0.3)) == key
+    # Decoded arrays, as parsed from stream records, hash by value
+    decoded = [localize_utils.preprocess_data(data) for data in queue]
+    assert result_cache.target_fingerprint(decoded, poses, config) == \
+        result_cache.target_fingerprint(
+            [{key: np.array(val) if isinstance(val, np.ndarray) else val
+              for key, val in data.items()} for data in decoded],
+            poses, config)
+
+    changed = [
+        (queue[:3], poses[:3], config, None),
+        (queue, poses + 0.01, config, None),
+        (queue, poses, dict(config, shuffle=4), None),
+        (queue, poses, config, {"location": [0.0, 0.0, 0.0],
+                                "uncertainty": 0.1}),
+        (queue, poses, config, {"location": np.zeros(3), "uncertainty": 0.2}),
+    ]
+    keys = {result_cache.target_fingerprint(*args) for args in changed}
+    assert key not in keys and len(keys) == len(changed)
+
+    other = list(queue)
+    other[0] = dict(queue[0], distance_candidates=measurement_codec.encode_array(
+        np.asarray(decoded[0]["distance_candidates"]) + 0.001, np.float32))
+    assert result_cache.target_fingerprint(other, poses, config) != key
+
+
+def test_repeats_are_served_from_the_cache(calls):
+    scenario = scenarios.target_scenario(4, seed=0)
+    config = scenarios.default_config()
+    cache = result_cache.ResultCache()
+    args = (scenario["queue"], scenario["poses"], config)
+    first = result_cache.target_localize_queue(cache, *args)
+    np.testing.assert_array_equal(result_cache.target_localize_queue(cache, *args),
+                                  first)
+    assert len(calls) == 1 and cache.stats["hits"] == 1
+
+    # A tracking search is not served the full search's location, nor one
+    # around another prior
+    prior = {"location": first, "uncertainty": 0.1}
+    result_cache.target_localize_queue(cache, *args, prior=prior)
+    result_cache.target_localize_queue(cache, *args, prior=prior)
+    result_cache.target_localize_queue(cache, *args,
+                                       prior=dict(prior, uncertainty=0.2))
+    assert calls == [None, prior, dict(prior, uncertainty=0.2)]
+    assert cache.hit_rate() == 2 / 5
+
+
+def test_no_location_is_cached():
+    cache = result_cache.ResultCache()
+    computed = []
+    for _ in range(2):
+        location = cache.get_or_compute("key", lambda: computed.append(1))
+    assert location is None and computed == [1]
+
+
+def test_expiry_and_eviction():
+    clock = Clock()
+    cache = result_cache.ResultCache(ttl_s=10, max_entries=2, clock=clock)
+    cache.put("a", [1, 2, 3])
+    clock.now += 10.5
+    assert cache.get("a") == (False, None)
+    assert cache.stats["expired"] == 1
+
+    for key in ("a", "b", "c"):
+        cache.put(key, [0, 0, 0])
+    assert len(cache) == 2 and cache.stats["evictions"] == 1
+    assert not cache.get("a")[0] and cache.get("c")[0]
+
+
+class FailingStore:
+    def get(self, key):
+        raise OSError("unavailable")
+
+    def put(self, key, blob):
+        raise OSError("unavailable")
+
+
+def test_shared_backend():
+    clock = Clock()
+    backend = fusion_state.MemoryStateStore()
+    writer = result_cache.ResultCache(backend, ttl_s=10, clock=clock)
+    writer.put("a", [1.0, 2.0, 3.0])
+    writer.put("none", None)
+
+    reader = result_cache.ResultCache(backend, ttl_s=10, clock=clock)
+    found, location = reader.get("a")
+    assert found
+    np.testing.assert_array_equal(location, [1.0, 2.0, 3.0])
+    assert reader.get("none") == (True, None)
+    assert reader.stats["shared_hits"] == 2
+    # The creation time travels with the entry
+    clock.now += 10.5
+    assert not result_cache.ResultCache(backend, ttl_s=10, clock=clock).get("a")[0]
+
+    failing = result_cache.ResultCache(FailingStore())
+    assert failing.get_or_compute("a", lambda: [1.0, 2.0, 3.0]) == [1.0, 2.0, 3.0]
+    assert failing.stats["backend_errors"] == 2
@@ -0,0 +1,65 @@
+import numpy as np
+
+import scenarios
+import fusion_state
+import localize_utils
+import tag_history
+
+
+def history_records(n_meas, seed=0, device_id="UPDATER"):
+    scenario = scenarios.target_scenario(n_meas, seed=seed)
+    return [{"timestamp": 1000 + 10 * i, "device_id": device_id, "pose": pose,
+             "data": localize_utils.preprocess_data(data)}
+            for i, (data, pose) in enumerate(zip(scenario["queue"],
+                                                 scenario["poses"]))]
+
+
+def assert_same_records(got, expected):
+    assert len(got) == len(expected)
+    for record, want in zip(got, expected):
+        assert record["timestamp"] == want["timestamp"]
+        assert record["device_id"] == want["device_id"]
+        assert record["data"]["epc"] == want["data"]["epc"]
+        np.testing.assert_array_equal(record["pose"], want["pose"])
+        for key in ("distance_candidates", "channel_estimate"):
+            np.testing.assert_array_equal(record["data"][key],
+                                          want["data"][key])
+
+
+def test_dump_load_round_trip():
+    records = history_records(4)
+    assert_same_records(
+        tag_history.load_history(tag_history.dump_history(records)), records)
+    assert tag_history.load_history(tag_history.dump_history([])) == []
+
+
+def test_extend_merges_and_keeps_the_most_recent():
+    records = history_records(6)
+    history = tag_history.TagHistory(fusion_state.MemoryStateStore(),
+                                     max_records=3)
+    assert_same_records(history.extend(1, "TARGET", records[2:4]), records[2:4])
+    # Out of order, with a redelivered record
+    merged = history.extend(1, "TARGET", [records[5], records[3], records[0]])
+    assert_same_records(merged, records[2:4] + records[5:])
+    assert history.stats["duplicates"] == 1
+    assert_same_records(history.load(1, "TARGET"), merged)
+
+    # The same timestamp from another device is another measurement
+    other = history_records(1, seed=3, device_id="OTHER")
+    other[0]["timestamp"] = records[5]["timestamp"]
+    assert len(history.extend(1, "TARGET", other, max_records=10)) == 4
+    assert history.load(1, "OTHER") == []
+
+
+def test_invalid_and_large_histories():
+    records = history_records(3)
+    store = fusion_state.MemoryStateStore()
+    history = tag_history.TagHistory(store)
+    store.put(tag_history.history_key(1, "TARGET"), b"not an npz")
+    assert history.load(1, "TARGET") == []
+    assert history.stats["invalid"] == 1
+
+    history = tag_history.TagHistory(store, max_bytes=100)
+    assert_same_records(history.extend(1, "TARGET", records), records)
+    assert store.get(tag_history.history_key(1, "TARGET")) is None
+    assert history.stats["too_large"] == 1
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+import scenarios
+import localize_utils
+import tracking
+
+
+def test_track_fuses_nearby_locations_and_restarts_far_ones():
+    track = tracking.TagTrack([0.0, 0.0, 0.0], 0)
+    # The prior loosens with the time since the last update
+    assert track.prior(10000)["uncertainty"] > track.prior(0)["uncertainty"]
+
+    assert not track.update([0.01, 0.0, 0.0], 1000)
+    assert 0 < track.location[0] < 0.01
+    assert track.variance < tracking.TRACK_MEASUREMENT_STD**2
+
+    assert track.update([1.0, 0.0, 0.0], 2000)
+    np.testing.assert_array_equal(track.location, [1.0, 0.0, 0.0])
+    assert track.variance == tracking.TRACK_MEASUREMENT_STD**2
+    # An older record does not move the track back in time
+    track.update([1.0, 0.0, 0.0], 1500)
+    assert track.timestamp_ms == 2000
+
+
+def test_tracker_counts_and_evicts():
+    tracker = tracking.Tracker(max_tags=2)
+    assert tracker.prior("A", 0) is None
+    tracker.update("A", [0, 0, 0], 0)
+    tracker.update("B", [0, 0, 0], 0)
+    tracker.update("A", [1, 0, 0], 100)
+    tracker.update("C", [0, 0, 0], 100)
+    assert len(tracker) == 2 and tracker.prior("B", 100) is None
+    assert tracker.prior("A", 100)["location"] == [1.0, 0.0, 0.0]
+    assert tracker.stats == {"priors": 1, "updates": 4, "restarts": 1,
+                             "evictions": 1}
+    tracker.forget("A")
+    assert tracker.prior("A", 100) is None
+
+
+def test_prior_bounds():
+    config = scenarios.default_config()
+    bounds = (scenarios.BOUND_MIN, scenarios.BOUND_MAX)
+    low, high = localize_utils.prior_bounds(
+        {"location": [0.0, 0.0, 0.0], "uncertainty": 0.1}, *bounds, config)
+    np.testing.assert_allclose(low, [-0.3] * 3)
+    np.testing.assert_allclose(high, [0.3] * 3)
+    # At least tracking_min_radius, and cut down to the bounds
+    low, high = localize_utils.prior_bounds(
+        {"location": scenarios.BOUND_MAX, "uncertainty": 0.001}, *bounds, config)
+    np.testing.assert_allclose(low, scenarios.BOUND_MAX - 0.1)
+    np.testing.assert_allclose(high, scenarios.BOUND_MAX)
+    assert localize_utils.prior_bounds(
+        {"location": scenarios.BOUND_MAX + 1, "uncertainty": 0.1},
+        *bounds, config) is None
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    """Counts of the preprocess_queue and area searches of a localization"""
+    counts = {"preprocess": 0, "searches": []}
+    preprocess_queue = localize_utils.preprocess_queue
+    target_localize_queue = localize_utils._target_localize_queue
+
+    def preprocess(data_queue):
+        counts["preprocess"] += 1
+        return preprocess_queue(data_queue)
+
+    def search(processed_data, self_loc_poses, config):
+        counts["searches"].append(np.asarray(config["min_bounds"]).tolist())
+        return target_localize_queue(processed_data, self_loc_poses, config)
+
+    monkeypatch.setattr(localize_utils, "preprocess_queue", preprocess)
+    monkeypatch.setattr(localize_utils, "_target_localize_queue", search)
+    return counts
+
+
+@pytest.mark.parametrize("moved", [False, True])
+def test_tracking_preprocesses_the_queue_once(searches, moved):
+    scenario = scenarios.target_scenario(8, 4, seed=1)
+    config = scenarios.default_config()
+    full = localize_utils.target_localize_queue(scenario["queue"],
+                                                scenario["poses"], config)
+    assert searches["preprocess"] == 1
+    assert np.linalg.norm(full - scenario["ground_truth"]) < 0.05
+
+    searches.update(preprocess=0, searches=[])
+    location = full + (1.0 if moved else 0.005)
+    prior = {"location": location.tolist(), "uncertainty": 0.02}
+    tracked = localize_utils.target_localize_queue(
+        scenario["queue"], scenario["poses"], config, prior=prior)
+    assert searches["preprocess"] == 1
+    if moved:
+        # The prior box misses the tag, the whole area is searched next
+        assert len(searches["searches"]) == 2
+        assert searches["searches"][1] == config["min_bounds"]
+        np.testing.assert_array_equal(tracked, full)
+    else:
+        assert len(searches["searches"]) == 1
+        assert searches["searches"][0] != config["min_bounds"]
+        assert np.linalg.norm(tracked - full) < 0.02